@@ -1,7 +1,30 @@
-from flask import Blueprint, request, jsonify, abort
+from flask import Blueprint, request, jsonify, abort, current_app
+import os
 import json
-from models import db_drop_and_create_all, setup_db, db, Actor, Movie
-from auth import AuthError, requires_auth
+from sqlalchemy.orm import selectinload
+from models import (
+    setup_db, db, bump_version, commit, close_session, after_commit, Actor, Movie
+)
+from listing import list_response, parse_limit, get_item
+from search import parse_query, search
+from bulk import (
+    parse_ids, existing_ids, require_ids, insert_cast, delete_cast, set_cast,
+    parse_items, validate_items, insert_rows, parse_targets, target_clauses, parse_values,
+    update_rows, delete_rows
+)
+from graph import cast_graph, cast_changed
+from batch import parse_operations, run_batch
+from importer import import_stream, request_format
+from export import export_response
+from seed import seed_database, SEED_ACTORS, SEED_MOVIES, SEED_CAST_PER_MOVIE, SEED_VALUE, SEED_MAX_ROWS
+from conditional import conditional
+from cache import cached, response_cache
+from idempotency import idempotent, idempotency_store
+from rendering import row_fragments
+from auth import (
+    AuthError, requires_auth, requires_include, jwks_cache, token_cache, rejected_token_stats,
+    ROLE_PERMISSIONS
+)
 
 casting_blueprint = Blueprint('gsprod-api', __name__)
 
@@ -11,41 +34,42 @@ casting_blueprint = Blueprint('gsprod-api', __name__)
     GET /movies | GET /actors
         it should be a authorized endpoint for avialable to all roles except 'public'
         it should contain only the item's data representation
-    returns status code 200 and json {"success": True, "item": items} where items is the list of movies or actors
+        it should return one page of items ordered by id, or by ?sort=
+            ?limit= sets the page size (default DEFAULT_PAGE_SIZE, at most MAX_PAGE_SIZE)
+            ?cursor= is the opaque next_cursor of the previous page
+            ?all=true returns every item unpaginated, without limit and next_cursor
+            ?stream=true streams every item unpaginated, for exports and large listings
+            ?fields=id,title only selects and returns the listed columns
+            ?sort=year / ?sort=-year orders by a whitelisted column (see listing.SORTS)
+            movies filter on ?year=, ?year_min=, ?year_max= and ?title= (prefix)
+            actors filter on ?gender=, ?age=, ?age_min=, ?age_max= and ?name= (prefix)
+            ?include=actors (movies) / ?include=movies (actors) nests each item's cast,
+                and also requires the get: permission of the included kind
+        it should send an ETag and Last-Modified built from the table's version counter
+            and answer a matching If-None-Match with an empty 304
+        it should be served from response_cache until a write to the table invalidates it
+    returns status code 200 and json {"success": True, "item": items, "limit": limit, "next_cursor": cursor}
+        where items is the list of movies or actors and cursor is null on the last page
         or appropriate status code indicating reason for failure
 '''
 @casting_blueprint.route('/movies', methods=['GET'])
 @requires_auth('get:movies')
+@requires_include('get:actors')
+@conditional('movies', 'actors', 'cast')
+@cached('movies', depends=('actors', 'cast'))
 def get_movies(jwt):
-    """Returns a list of objects with a short-form representation of movies or actors"""
-    all_movies = Movie.query.all()
-
-    if all_movies is None:
-        abort(404, 'There are no movies available')
-
-    formatted_movies = [movie.format() for movie in all_movies]
-
-    return jsonify({
-        'success': True,
-        'movies': formatted_movies
-    }), 200
+    """Returns a page of objects with a short-form representation of movies"""
+    return list_response(Movie, 'movies')
 
 
 @casting_blueprint.route('/actors', methods=['GET'])
 @requires_auth('get:actors')
+@requires_include('get:movies')
+@conditional('actors', 'movies', 'cast')
+@cached('actors', depends=('movies', 'cast'))
 def get_actors(jwt):
-    """Returns a list of objects with a short-form representation of actors"""
-    all_actors = Actor.query.all()
-
-    if all_actors is None:
-        abort(404, 'There are no actors available')
-
-    formatted_actor = [actor.format() for actor in all_actors]
-
-    return jsonify({
-        'success': True,
-        'actors': formatted_actor
-    }), 200
+    """Returns a page of objects with a short-form representation of actors"""
+    return list_response(Actor, 'actors')
 
 
 '''
@@ -53,7 +77,10 @@ def get_actors(jwt):
         where <id> is the existing model id
         it should respond with a 404 error if <id> is not found
         it should update the corresponding row for <id>
-        it should contain the item's data representation
+        it should contain the item's data representation, read with a precompiled Core select
+        it should send an ETag and Last-Modified built from the table's version counter
+            and answer a matching If-None-Match with an empty 304
+        it should be served from response_cache until a write to the table invalidates it
     returns status code 200 and json {"success": True, "item": item} where item is dictonary containing only the requested item
         or appropriate status code indicating reason for failure
 '''
@@ -61,13 +88,15 @@ def get_actors(jwt):
 
 @casting_blueprint.route('/movies/<int:movie_id>', methods=['GET'])
 @requires_auth('get:movies')
+@conditional('movies')
+@cached('movies', id_arg='movie_id')
 def get_movie(jwt, movie_id):
     print('getting movie for id: {}'.format(movie_id))
-    movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+    movie = get_item(Movie, movie_id)
     if movie:
         return jsonify({
             'success': True,
-            'movie': movie.format()
+            'movie': movie
         }), 200
     else:
         abort(404, 'Actor with id: {} not found'.format(movie_id))
@@ -75,27 +104,265 @@ def get_movie(jwt, movie_id):
 
 @casting_blueprint.route('/actors/<int:actor_id>', methods=['GET'])
 @requires_auth('get:actors')
+@conditional('actors')
+@cached('actors', id_arg='actor_id')
 def get_actor(jwt, actor_id):
-    actor = Actor.query.get(actor_id)
+    actor = get_item(Actor, actor_id)
     if actor:
         return jsonify({
             'success': True,
-            'actor': actor.format()
+            'actor': actor
         }), 200
     else:
         abort(404, 'Actor with id: {} not found'.format(actor_id))
 
 
+'''
+    GET /movies/<id>/actors | GET /actors/<id>/movies
+        where <id> is the existing model id
+        it should respond with a 404 error if <id> is not found
+        it should require the get: permission of both kinds
+        it should list the item's cast ordered by id, loaded with a single IN query
+        it should be cached and validated like the lists, on the tables it reads
+    returns status code 200 and json {"success": True, "items": items}
+        or appropriate status code indicating reason for failure
+'''
+
+
+@casting_blueprint.route('/movies/<int:movie_id>/actors', methods=['GET'])
+@requires_auth(all_of=('get:movies', 'get:actors'))
+@conditional('movies', 'actors', 'cast')
+@cached('movies', id_arg='movie_id', depends=('actors', 'cast'))
+def get_movie_actors(jwt, movie_id):
+    movie = Movie.query.options(selectinload(Movie.actors)).get(movie_id)
+    if movie is None:
+        abort(404, 'Movie with id: {} not found'.format(movie_id))
+    return jsonify({
+        'success': True,
+        'actors': [actor.format() for actor in sorted(movie.actors, key=lambda actor: actor.id)]
+    }), 200
+
+
+@casting_blueprint.route('/actors/<int:actor_id>/movies', methods=['GET'])
+@requires_auth(all_of=('get:movies', 'get:actors'))
+@conditional('actors', 'movies', 'cast')
+@cached('actors', id_arg='actor_id', depends=('movies', 'cast'))
+def get_actor_movies(jwt, actor_id):
+    actor = Actor.query.options(selectinload(Actor.movies)).get(actor_id)
+    if actor is None:
+        abort(404, 'Actor with id: {} not found'.format(actor_id))
+    return jsonify({
+        'success': True,
+        'movies': [movie.format() for movie in sorted(actor.movies, key=lambda movie: movie.id)]
+    }), 200
+
+
+'''
+    PUT /movies/<id>/actors | POST /movies/<id>/actors | DELETE /movies/<id>/actors
+        where <id> is the existing movie id and the json body is {"actors": [actor ids]}
+        it should respond with a 404 error if <id> is not found
+        it should respond with a 422 error if any actor id does not exist
+        it should require the 'patch:movies' permission
+        PUT makes the listed actors the whole cast, POST adds them, DELETE removes them
+        it should apply the change with multi-row INSERT ... ON CONFLICT DO NOTHING
+            and DELETE ... WHERE actor_id IN (...) statements, in one transaction
+    returns status code 200 and json {"success": True, "movie_id": id, "added": count, "removed": count}
+        or appropriate status code indicating reason for failure
+'''
+
+
+@casting_blueprint.route('/movies/<int:movie_id>/actors', methods=['PUT', 'POST', 'DELETE'])
+@requires_auth('patch:movies')
+def cast_movie_actors(jwt, movie_id):
+    """Applies a list of actor ids to the cast of a Movie"""
+    if Movie.query.get(movie_id) is None:
+        abort(404, 'Movie with id: {} not found'.format(movie_id))
+    actor_ids = parse_ids('actors')
+    if request.method != 'DELETE':
+        require_ids(Actor, actor_ids)
+    try:
+        added = removed = 0
+        if request.method == 'PUT':
+            added, removed = set_cast(movie_id, actor_ids)
+        elif request.method == 'POST':
+            added = insert_cast(movie_id, actor_ids)
+        else:
+            removed = delete_cast(movie_id, actor_ids)
+        if added or removed:
+            bump_version('cast')
+        commit()
+        if added or removed:
+            after_commit(response_cache.invalidate, 'cast')
+            after_commit(cast_changed, movie_id=movie_id)
+        return jsonify({
+            'success': True,
+            'movie_id': movie_id,
+            'added': added,
+            'removed': removed
+        }), 200
+    except Exception:
+        db.session.rollback()
+        abort(422)
+    finally:
+        close_session()
+
+
+'''
+    GET /export/movies | GET /export/actors | GET /export/cast
+        it should require the get: permission of the exported kind, or of both kinds for the cast
+        it should stream every row of the table ordered by id, as csv with a header line (?format=csv,
+            the default) or one json object per line (?format=ndjson), with chunked transfer encoding
+        it should read the rows with COPY ... TO STDOUT on postgres, or a server-side cursor, without
+            ORM instances or format(), keeping memory flat whatever the size of the table
+        it should gzip the body on the fly when the client accepts gzip
+        it should send an ETag and Last-Modified like the lists, and answer a matching If-None-Match with a 304
+    returns status code 200 and the rows as an attachment
+        or appropriate status code indicating reason for failure
+'''
+@casting_blueprint.route('/export/movies', methods=['GET'])
+@requires_auth('get:movies')
+@conditional('movies')
+def export_movies(jwt):
+    """Streams every Movie"""
+    return export_response('movies')
+
+
+@casting_blueprint.route('/export/actors', methods=['GET'])
+@requires_auth('get:actors')
+@conditional('actors')
+def export_actors(jwt):
+    """Streams every Actor"""
+    return export_response('actors')
+
+
+@casting_blueprint.route('/export/cast', methods=['GET'])
+@requires_auth(all_of=('get:movies', 'get:actors'))
+@conditional('cast')
+def export_cast(jwt):
+    """Streams every cast link"""
+    return export_response('cast')
+
+
+'''
+    GET /actors/<id>/costars
+        where <id> is the existing actor id
+        it should respond with a 404 error if <id> is not found
+        it should list the actors who shared a movie with <id>, most shared movies first
+            ?limit= caps the number of co-stars (default DEFAULT_PAGE_SIZE, at most MAX_PAGE_SIZE)
+        it should be answered from cast_graph, see graph.py
+    returns status code 200 and json {"success": True, "costars": actors}
+        where each actor carries its "shared_movies" count
+        or appropriate status code indicating reason for failure
+'''
+
+
+@casting_blueprint.route('/actors/<int:actor_id>/costars', methods=['GET'])
+@requires_auth('get:actors')
+@conditional('actors', 'cast')
+def get_actor_costars(jwt, actor_id):
+    if Actor.query.get(actor_id) is None:
+        abort(404, 'Actor with id: {} not found'.format(actor_id))
+    costars = cast_graph.costars(actor_id)
+    top = sorted(costars.items(), key=lambda costar: (-costar[1], costar[0]))[:parse_limit()]
+    actors = dict(
+        (actor.id, actor) for actor in Actor.query.filter(Actor.id.in_([costar_id for costar_id, shared in top]))
+    )
+    results = []
+    for costar_id, shared in top:
+        if costar_id not in actors:
+            # deleted since cast_graph last caught up with the cast table
+            continue
+        costar = actors[costar_id].format()
+        costar['shared_movies'] = shared
+        results.append(costar)
+    return jsonify({
+        'success': True,
+        'costars': results
+    }), 200
+
+
+'''
+    GET /actors/<a>/path/<b>
+        where <a> and <b> are existing actor ids
+        it should respond with a 404 error if either actor is not found
+        it should find the shortest chain of shared movies leading from <a> to <b>
+        it should be answered from cast_graph with a bidirectional breadth first search
+    returns status code 200 and json {"success": True, "degrees": n, "actors": actors, "movies": movies}
+        where movies[i] links actors[i] to actors[i + 1], and degrees is null (with empty lists)
+        when <a> and <b> are not connected
+        or appropriate status code indicating reason for failure
+'''
+
+
+@casting_blueprint.route('/actors/<int:actor_id>/path/<int:other_id>', methods=['GET'])
+@requires_auth(all_of=('get:actors', 'get:movies'))
+@conditional('actors', 'movies', 'cast')
+def get_actor_path(jwt, actor_id, other_id):
+    found = existing_ids(Actor, [actor_id, other_id])
+    for item in (actor_id, other_id):
+        if item not in found:
+            abort(404, 'Actor with id: {} not found'.format(item))
+    chain = cast_graph.path(actor_id, other_id)
+    if chain is None:
+        return jsonify({
+            'success': True,
+            'degrees': None,
+            'actors': [],
+            'movies': []
+        }), 200
+    actor_ids, movie_ids = chain[::2], chain[1::2]
+    actors = dict((actor.id, actor) for actor in Actor.query.filter(Actor.id.in_(actor_ids)))
+    movies = dict((movie.id, movie) for movie in Movie.query.filter(Movie.id.in_(movie_ids)))
+    return jsonify({
+        'success': True,
+        'degrees': len(movie_ids),
+        'actors': [actors[item].format() for item in actor_ids],
+        'movies': [movies[item].format() for item in movie_ids]
+    }), 200
+
+
+'''
+    GET /search
+        it should be a authorized endpoint for avialable to all roles except 'public'
+        it should rank the movies whose title and the actors whose name best match ?q=
+            ?limit= caps the results of each kind (default DEFAULT_PAGE_SIZE, at most MAX_PAGE_SIZE)
+        it should only search the kinds the caller has the get: permission for
+        it should be answered from the search indexes, see search.py
+    returns status code 200 and json {"success": True, "q": q, "movies": movies, "actors": actors}
+        where movies and actors are ordered best match first, each with its "score"
+        or appropriate status code indicating reason for failure
+'''
+
+
+@casting_blueprint.route('/search', methods=['GET'])
+@requires_auth(any_of=('get:movies', 'get:actors'))
+@conditional('movies', 'actors')
+def get_search(jwt):
+    q = parse_query()
+    limit = parse_limit()
+    granted = jwt.get('permissions', [])
+    results = {
+        'success': True,
+        'q': q
+    }
+    for table in ('movies', 'actors'):
+        if 'get:' + table in granted:
+            results[table] = search(table, q, limit)
+    return jsonify(results), 200
+
+
 '''
 
     POST /movies | POST /actors
         it should create a new row in the correct table
         it should require the 'post:item' permission
+        it should replay its first response to a retry with the same Idempotency-Key header
     returns status code 200 and json {"success": True, "items": item} where items is an array containing only the newly created item
         or appropriate status code indicating reason for failure
 '''
 @casting_blueprint.route('/movies', methods=['POST'])
 @requires_auth('post:movies')
+@idempotent
 def post_movie(jwt):
     """Create a new Movie with the POST method"""
     if request.method != 'POST':
@@ -107,6 +374,7 @@ def post_movie(jwt):
     )
     try:
         movie.insert()
+        after_commit(response_cache.invalidate, 'movies')
         print('success')
         return jsonify({
             'success': True,
@@ -116,11 +384,12 @@ def post_movie(jwt):
         db.session.rollback()
         abort(422)
     finally:
-        db.session.close()
+        close_session()
 
 
 @casting_blueprint.route('/actors', methods=['POST'])
 @requires_auth('post:actors')
+@idempotent
 def post_actor(jwt):
     """Create a new Actor with the POST method"""
     if request.method != 'POST':
@@ -133,6 +402,7 @@ def post_actor(jwt):
     )
     try:
         actor.insert()
+        after_commit(response_cache.invalidate, 'actors')
         return jsonify({
             'success': True,
             'actor': actor.format()
@@ -141,7 +411,212 @@ def post_actor(jwt):
         db.session.rollback()
         abort(422)
     finally:
-        db.session.close()
+        close_session()
+
+
+'''
+    POST /movies/bulk | POST /actors/bulk
+        it should create one row per item of the json body {"movies": [items]} / {"actors": [items]}
+        it should require the 'post:item' permission
+        it should replay its first response to a retry with the same Idempotency-Key header
+        it should validate every item before writing anything, and respond with a 422 error
+            listing the {"index": i, "errors": {field: reason}} of each invalid item
+        it should insert all items in one transaction, with multi-row INSERT ... RETURNING id
+            statements on postgres
+    returns status code 200 and json {"success": True, "items": items} where items are the created
+        items, in the order they were sent
+        or appropriate status code indicating reason for failure
+'''
+
+
+def bulk_create(model, key):
+    """Creates the items of the request in model's table"""
+    rows, errors = validate_items(key, parse_items(key))
+    if errors:
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': errors
+        }), 422
+    try:
+        ids = insert_rows(model, rows)
+        bump_version(key)
+        commit()
+        after_commit(response_cache.invalidate, key)
+        return jsonify({
+            'success': True,
+            key: [dict(row, id=item_id) for item_id, row in zip(ids, rows)]
+        }), 200
+    except Exception:
+        db.session.rollback()
+        abort(422)
+    finally:
+        close_session()
+
+
+@casting_blueprint.route('/movies/bulk', methods=['POST'])
+@requires_auth('post:movies')
+@idempotent
+def post_movies_bulk(jwt):
+    """Create many Movies with one POST"""
+    return bulk_create(Movie, 'movies')
+
+
+@casting_blueprint.route('/actors/bulk', methods=['POST'])
+@requires_auth('post:actors')
+@idempotent
+def post_actors_bulk(jwt):
+    """Create many Actors with one POST"""
+    return bulk_create(Actor, 'actors')
+
+
+'''
+    POST /import/movies | POST /import/actors | POST /import/cast
+        where the request body is a csv file with a header line (Content-Type: text/csv) or
+            one json object per line (Content-Type: application/x-ndjson), or ?format=csv|ndjson
+        it should require the 'post:item' permission, or 'patch:movies' for the cast
+        it should read the body as it arrives and load it in chunks of IMPORT_CHUNK_SIZE rows,
+            with COPY ... FROM STDIN on postgres, see importer.py
+        it should skip the lines it cannot use and report them, and import the others
+            in one transaction
+    returns status code 200 and json {"success": True, "read": lines, "imported": rows, "rejected": count,
+        "rejections": [{"line": number, "reason": reason}], "seconds": time, "rows_per_second": rate}
+        or appropriate status code indicating reason for failure
+'''
+
+
+def import_response(key):
+    """Imports the request body into the table of key"""
+    fmt = request_format()
+    try:
+        # a cast import bumps the cast version, so cast_graph rebuilds on its next read
+        report = import_stream(key, request.stream, fmt)
+        report['success'] = True
+        return jsonify(report), 200
+    except Exception:
+        db.session.rollback()
+        abort(422)
+    finally:
+        close_session()
+
+
+@casting_blueprint.route('/import/movies', methods=['POST'])
+@requires_auth('post:movies')
+def import_movies(jwt):
+    """Load a catalog of Movies"""
+    return import_response('movies')
+
+
+@casting_blueprint.route('/import/actors', methods=['POST'])
+@requires_auth('post:actors')
+def import_actors(jwt):
+    """Load a catalog of Actors"""
+    return import_response('actors')
+
+
+@casting_blueprint.route('/import/cast', methods=['POST'])
+@requires_auth('patch:movies')
+def import_cast(jwt):
+    """Load cast links between existing Movies and Actors"""
+    return import_response('cast')
+
+
+'''
+    PATCH /movies/bulk | PATCH /actors/bulk | DELETE /movies/bulk | DELETE /actors/bulk
+        it should target the rows listed in the json body {"ids": [ids]}, the rows matching
+            the list filters of the query string (i.e. ?year_max=1950), or both
+        it should respond with a 400 error when neither ids nor a filter are given
+        it should require the 'patch:item' / 'delete:item' permission
+        PATCH sets the fields of the json body {"set": {field: value}} on every targeted row,
+            responding with a 422 error listing the reason of each invalid field
+        DELETE removes the targeted rows and their cast rows
+        it should write with set-based UPDATE ... WHERE id IN / DELETE ... WHERE statements
+            in one transaction
+    returns status code 200 and json {"success": True, "updated": ids} / {"success": True, "deleted": ids}
+        where ids are the affected ids in ascending order
+        or appropriate status code indicating reason for failure
+'''
+
+
+def bulk_update(model, key):
+    """Updates the rows targeted by the request in model's table"""
+    ids, condition = parse_targets(model, key)
+    values, problems = parse_values(key)
+    if problems:
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': problems
+        }), 422
+    try:
+        updated = update_rows(model, values, target_clauses(model, ids, condition))
+        if updated:
+            bump_version(key)
+        commit()
+        if updated:
+            after_commit(response_cache.invalidate, key, *updated)
+        return jsonify({
+            'success': True,
+            'updated': updated
+        }), 200
+    except Exception:
+        db.session.rollback()
+        abort(422)
+    finally:
+        close_session()
+
+
+def bulk_delete(model, key):
+    """Deletes the rows targeted by the request from model's table"""
+    ids, condition = parse_targets(model, key)
+    try:
+        deleted = delete_rows(model, key, target_clauses(model, ids, condition))
+        if deleted:
+            bump_version(key, 'cast')
+        commit()
+        if deleted:
+            after_commit(response_cache.invalidate, key, *deleted)
+            after_commit(response_cache.invalidate, 'cast')
+            # cast_graph sees the new cast version and rebuilds on its next read
+        return jsonify({
+            'success': True,
+            'deleted': deleted
+        }), 200
+    except Exception:
+        db.session.rollback()
+        abort(422)
+    finally:
+        close_session()
+
+
+@casting_blueprint.route('/movies/bulk', methods=['PATCH'])
+@requires_auth('patch:movies')
+def patch_movies_bulk(jwt):
+    """Update many Movies with one PATCH"""
+    return bulk_update(Movie, 'movies')
+
+
+@casting_blueprint.route('/actors/bulk', methods=['PATCH'])
+@requires_auth('patch:actors')
+def patch_actors_bulk(jwt):
+    """Update many Actors with one PATCH"""
+    return bulk_update(Actor, 'actors')
+
+
+@casting_blueprint.route('/movies/bulk', methods=['DELETE'])
+@requires_auth('delete:movies')
+def delete_movies_bulk(jwt):
+    """Delete many Movies with one DELETE"""
+    return bulk_delete(Movie, 'movies')
+
+
+@casting_blueprint.route('/actors/bulk', methods=['DELETE'])
+@requires_auth('delete:actors')
+def delete_actors_bulk(jwt):
+    """Delete many Actors with one DELETE"""
+    return bulk_delete(Actor, 'actors')
 
 
 '''
@@ -166,6 +641,7 @@ def patch_movie(jwt, movie_id):
         movie.title = data.get('title')
         movie.year = data.get('year')
         movie.update()
+        after_commit(response_cache.invalidate, 'movies', movie_id)
         return jsonify({
             'success': True,
             'movies': [movie.format()]
@@ -174,7 +650,7 @@ def patch_movie(jwt, movie_id):
         db.session.rollback()
         abort(422)
     finally:
-        db.session.close()
+        close_session()
 
 
 @casting_blueprint.route('/actors/<int:actor_id>', methods=['PATCH'])
@@ -191,6 +667,7 @@ def patch_actor(jwt, actor_id):
         actor.age = data.get('age')
         actor.gender = data.get('gender')
         actor.update()
+        after_commit(response_cache.invalidate, 'actors', actor_id)
         return jsonify({
             'success': True,
             'actors': [actor.format()]
@@ -199,7 +676,7 @@ def patch_actor(jwt, actor_id):
         db.session.rollback()
         abort(422)
     finally:
-        db.session.close()
+        close_session()
 
 
 '''
@@ -220,6 +697,9 @@ def delete_movie(jwt, movie_id):
         abort(404, 'Movie not found.')
     try:
         movie.delete()
+        after_commit(response_cache.invalidate, 'movies', movie_id)
+        after_commit(response_cache.invalidate, 'cast')
+        after_commit(cast_changed, movie_id=movie_id)
         return jsonify({
             'success': True,
             'delete': movie_id
@@ -228,7 +708,7 @@ def delete_movie(jwt, movie_id):
         db.session.rollback()
         abort(422)
     finally:
-        db.session.close()
+        close_session()
 
 
 @casting_blueprint.route('/actors/<int:actor_id>', methods=['DELETE'])
@@ -240,6 +720,9 @@ def delete_actor(jwt, actor_id):
         abort(404, 'Actor not found.')
     try:
         actor.delete()
+        after_commit(response_cache.invalidate, 'actors', actor_id)
+        after_commit(response_cache.invalidate, 'cast')
+        after_commit(cast_changed, actor_id=actor_id)
         return jsonify({
             'success': True,
             'delete': actor_id
@@ -248,7 +731,7 @@ def delete_actor(jwt, actor_id):
         db.session.rollback()
         abort(422)
     finally:
-        db.session.close()
+        close_session()
 
 
 # Error Handling
@@ -284,6 +767,16 @@ def method_not_allowed(error):
     }), 405
 
 
+@casting_blueprint.errorhandler(409)
+def conflict(error):
+    '''error handler for conflict'''
+    return jsonify({
+        'success': False,
+        'error': 409,
+        'message': 'conflict'
+    }), 409
+
+
 @casting_blueprint.errorhandler(500)
 def internal_sever_error(error):
     '''error handler for internal server error'''
@@ -312,38 +805,189 @@ def not_found(error):
 @casting_blueprint.errorhandler(AuthError)
 def permission_error(exception):
     '''error handler for AuthError'''
+    # the signing keys being unavailable is no fault of the token, the client may retry
+    status = 503 if exception.status_code == 503 else 401
     return jsonify({
         'error': exception.error['description'],
         'status': exception.status_code
-    }), 401
+    }), status
+
+
+'''
+    GET /seed
+        it should be a public endpoint of the local development environment (ENV=dev) only,
+            and respond with a 404 error anywhere else, where `flask seed` loads the catalog
+        it should replace every table with a generated catalog, see seed.py
+            ?actors=, ?movies=, ?cast_per_movie= (average) and ?seed= default to SEED_ACTORS,
+            SEED_MOVIES, SEED_CAST_PER_MOVIE and SEED_VALUE; the same values give the same catalog
+        it should respond with a 400 error past SEED_MAX_ROWS rows, larger catalogs are
+            loaded with `flask seed`
+        it should drop the cached responses and the cast graph of this worker
+    returns status code 200 and json {"success": 200, "message": message, "actors": count, "movies": count,
+        "cast": count, "seconds": time, "rows_per_second": rate}
+'''
+
+
+def seed_arg(name, default):
+    value = request.args.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        abort(400, '{} must be an integer'.format(name))
+    if value < 0 and name != 'seed':
+        abort(400, '{} must not be negative'.format(name))
+    return value
 
 
 @casting_blueprint.route('/seed')
 def add_dummy_data():
     '''Seed Database'''
-    db_drop_and_create_all()
-    actor1 = Actor(name="Sam Jones", age=25, gender='m')
-    actor2 = Actor(name="Cynthia Jones", age=22, gender='f')
-    actor3 = Actor(name="Vanna White", age=32, gender='f')
+    if os.environ.get('ENV') != 'dev':
+        # anyone could drop the tables
+        abort(404)
+    actors = seed_arg('actors', SEED_ACTORS)
+    movies = seed_arg('movies', SEED_MOVIES)
+    cast_per_movie = seed_arg('cast_per_movie', SEED_CAST_PER_MOVIE)
+    seed = seed_arg('seed', SEED_VALUE)
+    if actors + movies + movies * cast_per_movie > SEED_MAX_ROWS:
+        abort(400, 'at most {} rows, use `flask seed` for more'.format(SEED_MAX_ROWS))
+    try:
+        report = seed_database(actors, movies, cast_per_movie, seed)
+    except Exception:
+        db.session.rollback()
+        abort(422)
+    finally:
+        db.session.close()
+    for table in ('actors', 'movies', 'cast'):
+        response_cache.invalidate_all(table)
+    cast_graph.reset()
 
-    movie1 = Movie(title="The Movie", year=2015)
-    movie2 = Movie(title="The Movie 2", year=2016)
-    movie3 = Movie(title="The Movie 3", year=2017)
+    report.update({
+        "success": 200,
+        "message": "db populated successfully"
+    })
+    return jsonify(report)
 
-    actor1.insert()
-    actor2.insert()
-    actor3.insert()
-    movie1.insert()
-    movie2.insert()
-    movie3.insert()
 
-    db.session.commit()
-    db.session.close()
+'''
+    GET /permissions
+        it should be available to any authenticated token
+        it should list every casting_blueprint route with the permissions it declares
+        it should list the routes each Auth0 role can use, without calling the IdP
+        it should list the routes the caller's token can use
+    returns status code 200 and json {"success": True, "routes": routes, "roles": roles, "allowed": endpoints}
+'''
+
+
+def permission_registry():
+    '''Collects the permission policy declared on each casting_blueprint route, once per app'''
+    registry = current_app.extensions.get('permission_registry')
+    if registry is None:
+        registry = []
+        for rule in current_app.url_map.iter_rules():
+            if not rule.endpoint.startswith(casting_blueprint.name + '.'):
+                continue
+            view = current_app.view_functions[rule.endpoint]
+            policy = getattr(view, 'permission_policy', None)
+            if policy is not None:
+                registry.append((rule, policy))
+        registry.sort(key=lambda entry: (entry[0].rule, entry[0].endpoint))
+        current_app.extensions['permission_registry'] = registry
+    return registry
+
+
+@casting_blueprint.route('/permissions', methods=['GET'])
+@requires_auth()
+def get_permissions(jwt):
+    """Returns the permissions required by each route, and who can use them"""
+    registry = permission_registry()
+    routes = []
+    for rule, policy in registry:
+        route = policy.format()
+        route.update({
+            'endpoint': rule.endpoint.split('.', 1)[1],
+            'rule': rule.rule,
+            'methods': sorted(rule.methods - {'HEAD', 'OPTIONS'}),
+        })
+        routes.append(route)
+
+    roles = {}
+    for role, permissions in ROLE_PERMISSIONS.items():
+        roles[role] = sorted(set(
+            rule.endpoint.split('.', 1)[1] for rule, policy in registry if policy.allows(permissions)
+        ))
+
+    granted = frozenset(jwt.get('permissions', []))
+    allowed = sorted(set(
+        rule.endpoint.split('.', 1)[1] for rule, policy in registry if policy.allows(granted)
+    ))
 
     return jsonify({
-        "success": 200,
-        "message": "db populated successfully"
-    })
+        'success': True,
+        'routes': routes,
+        'roles': roles,
+        'allowed': allowed
+    }), 200
+
+
+'''
+    POST /batch
+        where the json body is {"operations": [{"method": "PATCH", "path": "/api/movies/1", "body": {...}}, ...]}
+            and optionally "atomic": true
+        it should be available to any authenticated token; each operation still needs the
+            permissions of its own route, checked against the same token
+        it should verify the token once for the whole batch
+        it should run the operations in order, in-process, on any casting_blueprint route
+            that requires authentication, but not on /batch itself
+        it should respond with a 400 error if there are more than BATCH_MAX_OPERATIONS operations
+        "atomic": true runs every write in one transaction: the first operation failing
+            rolls the whole batch back and the remaining ones are not run (status 424)
+    returns status code 200 and json {"success": True, "committed": bool, "results": results}
+        where results holds the {"status": code, "body": json} of each operation, in order
+        or appropriate status code indicating reason for failure
+'''
+@casting_blueprint.route('/batch', methods=['POST'])
+@requires_auth()
+def post_batch(jwt):
+    """Runs a list of api calls in one request"""
+    operations, atomic = parse_operations()
+    endpoints = set(rule.endpoint for rule, policy in permission_registry()) - {request.endpoint}
+    try:
+        results, committed = run_batch(operations, atomic, endpoints)
+        return jsonify({
+            'success': True,
+            'atomic': atomic,
+            'committed': committed,
+            'results': results
+        }), 200
+    except Exception:
+        db.session.rollback()
+        abort(422)
+    finally:
+        db.session.close()
+
+
+'''
+    GET /metrics
+        it should be a public endpoint, like /seed
+        it should contain the counters of the process-wide caches
+    returns status code 200 and json {"success": True, "jwks": stats, "tokens": stats, "rejected_tokens": stats,
+        "responses": hit ratio per route, "cast_graph": index size and rebuilds,
+        "idempotency": claimed, replayed and swept keys, "row_fragments": cached rows and json encoder}
+'''
+@casting_blueprint.route('/metrics')
+def get_metrics():
+    '''Expose cache counters for this worker process'''
+    return jsonify({
+        'success': True,
+        'jwks': jwks_cache.stats(),
+        'tokens': token_cache.stats(),
+        'rejected_tokens': rejected_token_stats(),
+        'responses': response_cache.stats(),
+        'cast_graph': cast_graph.stats(),
+        'idempotency': idempotency_store.stats(),
+        'row_fragments': row_fragments.stats()
+    }), 200
 
 
 @casting_blueprint.after_request
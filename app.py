@@ -3,8 +3,11 @@ from flask import Flask, jsonify
 from flask_cors import CORS
 from flask_migrate import Migrate
 from models import db, setup_db
+from auth import jwks_cache, JWKS_BACKGROUND_REFRESH
+from importer import import_command
+from seed import seed_command
 from api import (
-    casting_blueprint, unprocessable, bad_request, method_not_allowed, internal_sever_error, not_found, permission_error
+    casting_blueprint, unprocessable, bad_request, method_not_allowed, conflict, internal_sever_error, not_found, permission_error
 )
 
 
@@ -15,6 +18,7 @@ def create_app(test_config=None):
     app.register_error_handler(422, unprocessable)
     app.register_error_handler(400, bad_request)
     app.register_error_handler(405, method_not_allowed)
+    app.register_error_handler(409, conflict)
     app.register_error_handler(500, internal_sever_error)
     app.register_error_handler(404, not_found)
     app.register_error_handler(401, permission_error)
@@ -22,6 +26,14 @@ def create_app(test_config=None):
     setup_db(app)
     migrate = Migrate(app, db)
     cors = CORS(app, resources={r"/api*": {"origins": "*"}})
+    # flask import-catalog <movies|actors|cast> <file>
+    app.cli.add_command(import_command)
+    # flask seed --actors 1000000 --movies 1000000 --cast-per-movie 10
+    app.cli.add_command(seed_command)
+
+    # renew the Auth0 key set off the request path, one thread per worker process
+    if JWKS_BACKGROUND_REFRESH:
+        jwks_cache.start_refresher()
 
 
     @app.route('/')
@@ -33,7 +45,7 @@ def create_app(test_config=None):
         if environment == 'dev':
             message = message + "the local development environment, " + "you can seed and re-seed the database, by " + seed_url_html
         elif environment == 'prod':
-            message = message + "the production app, " + "you can seed and re-seed the database, by " + seed_url_html
+            message = message + "the production app, " + "the database is seeded with `flask seed`"
         return message
 
     return app
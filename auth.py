@@ -1,10 +1,16 @@
 import os
 import json
-from flask import request, _request_ctx_stack, abort
+import hashlib
+import threading
+from collections import Counter, namedtuple
+from flask import request, _request_ctx_stack, abort, g
 from jose import jwt
+from jose.exceptions import JWTError
+from jose.utils import base64url_decode
 from functools import wraps
-from urllib.request import urlopen
 from dotenv import load_dotenv
+from jwks import JWKSCache, JWKSUnavailable
+from cache import LRUCache
 # basedir = os.path.abspath(os.path.dirname(__file__))
 
 load_dotenv()
@@ -16,6 +22,56 @@ load_dotenv()
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 AUTH0_ALGORITHMS = os.environ['AUTH0_ALGORITHMS']
 AUTH0_AUDIENCE = os.environ['AUTH0_AUDIENCE']
+ALLOWED_ALGORITHMS = [alg.strip() for alg in AUTH0_ALGORITHMS.split(',')]
+AUTH0_JWKS_URL = os.getenv(
+    'AUTH0_JWKS_URL', 'https://{}/.well-known/jwks.json'.format(AUTH0_DOMAIN))
+JWKS_CACHE_TTL = int(os.getenv('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFETCH_INTERVAL = int(os.getenv('JWKS_MIN_REFETCH_INTERVAL', 5))
+JWKS_STALE_WINDOW = int(os.getenv('JWKS_STALE_WINDOW', 900))
+JWKS_BACKGROUND_REFRESH = os.getenv('JWKS_BACKGROUND_REFRESH', 'false').lower() in ('1', 'true', 'yes')
+
+# shared by every request handled by this process
+jwks_cache = JWKSCache(
+    AUTH0_JWKS_URL,
+    ttl=JWKS_CACHE_TTL,
+    min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+    algorithm=ALLOWED_ALGORITHMS[0],
+    stale_window=JWKS_STALE_WINDOW
+)
+
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_LEEWAY = int(os.getenv('TOKEN_CACHE_LEEWAY', 30))
+
+# decoded payloads of already verified tokens, keyed by token digest
+token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE)
+
+NEGATIVE_CACHE_SIZE = int(os.getenv('NEGATIVE_CACHE_SIZE', 4096))
+NEGATIVE_CACHE_TTL = int(os.getenv('NEGATIVE_CACHE_TTL', 30))
+NEGATIVE_CACHE_CODES = ('token_expired', 'invalid_claims', 'invalid_header')
+# not remembered: the kid may belong to a key the IdP is rotating in, which a
+# later JWKS refetch picks up
+UNKNOWN_KEY_ERROR = {
+    'code': 'invalid_header',
+    'description': 'Unable to find the appropriate key.'
+}
+
+# errors of recently rejected tokens, keyed by token digest
+rejected_token_cache = LRUCache(maxsize=NEGATIVE_CACHE_SIZE, ttl=NEGATIVE_CACHE_TTL)
+rejections_by_code = Counter()
+_rejections_lock = threading.Lock()
+
+# RBAC roles as configured in Auth0, see "Permissions By Role" in the README
+ROLE_PERMISSIONS = {
+    'executive_producer': frozenset([
+        'get:actors', 'get:movies', 'post:actors', 'post:movies',
+        'patch:actors', 'patch:movies', 'delete:actors', 'delete:movies'
+    ]),
+    'casting_director': frozenset([
+        'get:actors', 'get:movies', 'post:actors',
+        'patch:actors', 'patch:movies', 'delete:actors'
+    ]),
+    'casting_assistant': frozenset(['get:actors', 'get:movies']),
+}
 
 print('❌ os.environ', os.getenv('AUTH0_AUDIENCE'))
 
@@ -83,6 +139,19 @@ def get_token_auth_header():
     return token
 
 
+def verify_signature(token, unverified_header, signing_key):
+    """Checks the token signature with a key prepared by jwks_cache"""
+    if unverified_header.get('alg') not in ALLOWED_ALGORITHMS:
+        raise JWTError('The specified alg value is not allowed')
+    signing_input, _, crypto_segment = token.encode('utf-8').rpartition(b'.')
+    try:
+        signature = base64url_decode(crypto_segment)
+    except (TypeError, ValueError):
+        raise JWTError('Invalid crypto padding')
+    if not signing_key.verify(signing_input, signature):
+        raise JWTError('Signature verification failed.')
+
+
 '''
     verify_decode_jwt(token) method
     @INPUTS
@@ -90,6 +159,9 @@ def get_token_auth_header():
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        the key set is served from jwks_cache, which only refetches it when
+        the TTL has expired or the token presents an unknown kid
+        the signature is checked against the key object jwks_cache prepared for the kid
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -101,13 +173,15 @@ def get_token_auth_header():
 def verify_decode_jwt(token):
     """Uses the Auth0 secret to decode then verify the provided token"""
     # print('verifying...')
-    jsonurl = urlopen("https://{}/.well-known/jwks.json".format(AUTH0_DOMAIN))
-    # print('jsonurl', jsonurl)
-    jwks = json.loads(jsonurl.read())
-    # print('jwks', jwks)
-    unverified_header = jwt.get_unverified_header(token)
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except JWTError:
+        print('🚩 malformed token')
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
     # print('unverified_header', unverified_header)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         print("'kid' not in unverified_header")
         raise AuthError({
@@ -115,24 +189,26 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    try:
+        signing_key = jwks_cache.get_signing_key(unverified_header['kid'])
+    except JWKSUnavailable:
+        print('🚩 jwks unavailable')
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys, try again later.'
+        }, 503)
+    if signing_key:
         try:
-            # print('checking rsa key', rsa_key)
+            # the signature is checked against the prepared key, so jwt.decode
+            # only has to validate the claims
+            verify_signature(token, unverified_header, signing_key)
             payload = jwt.decode(
                 token,
-                rsa_key,
+                signing_key,
                 algorithms=AUTH0_ALGORITHMS,
                 audience=AUTH0_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer='https://' + AUTH0_DOMAIN + '/',
+                options={'verify_signature': False}
             )
             # print('✅ rsa key found', payload)
             return payload
@@ -157,10 +233,76 @@ def verify_decode_jwt(token):
                 'description': 'Unable to parse authentication token.'
             }, 400)
     print('🚩 payload unable to find key')
-    raise AuthError({
-        'code': 'invalid_header',
-        'description': 'Unable to find the appropriate key.'
-    }, 400)
+    raise AuthError(dict(UNKNOWN_KEY_ERROR), 400)
+
+
+'''
+    get_verified_payload(token) method
+    @INPUTS
+        token: a json web token (string)
+
+    it should return the cached payload if this exact token was already verified
+        entries are keyed by a sha256 digest of the token, never the raw token
+        entries expire TOKEN_CACHE_LEEWAY seconds before the token's exp claim
+        entries are ignored once the JWKS keys rotate
+    it should raise the remembered AuthError if this exact token was rejected
+        in the last NEGATIVE_CACHE_TTL seconds, without verifying it again
+    it should otherwise use verify_decode_jwt and cache the decoded payload
+        or the AuthError, when its code is one of NEGATIVE_CACHE_CODES
+            and it is not the unknown kid error; rejections are ignored once the JWKS keys rotate
+        the payload is cached alongside a frozenset of its permissions
+    return the decoded payload (get_verified_token returns the VerifiedToken)
+'''
+
+
+# a verified token, with its permissions compiled into a set for O(1) checks
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions', 'key_generation'])
+
+
+def token_digest(token):
+    """Returns the cache key for a raw token"""
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+def get_verified_token(token):
+    """Verifies the token, or returns the result of an earlier verification"""
+    digest = token_digest(token)
+    verified = token_cache.get(digest)
+    if verified is not None and verified.key_generation == jwks_cache.key_generation:
+        return verified
+
+    rejected = rejected_token_cache.get(digest)
+    if rejected is not None and rejected[2] == jwks_cache.key_generation:
+        with _rejections_lock:
+            rejections_by_code[rejected[0]['code']] += 1
+        raise AuthError(dict(rejected[0]), rejected[1])
+
+    try:
+        payload = verify_decode_jwt(token)
+    except AuthError as error:
+        if error.error.get('code') in NEGATIVE_CACHE_CODES and error.error != UNKNOWN_KEY_ERROR:
+            rejected_token_cache.set(digest, (error.error, error.status_code, jwks_cache.key_generation))
+        raise
+    permissions = None
+    if isinstance(payload.get('permissions'), list):
+        permissions = frozenset(payload['permissions'])
+    verified = VerifiedToken(payload, permissions, jwks_cache.key_generation)
+    if isinstance(payload.get('exp'), (int, float)):
+        token_cache.set(digest, verified, expires_at=payload['exp'] - TOKEN_CACHE_LEEWAY)
+    return verified
+
+
+def get_verified_payload(token):
+    """Verifies the token, or returns the payload of an earlier verification"""
+    return get_verified_token(token).payload
+
+
+def rejected_token_stats():
+    """Returns the negative cache counters, with replayed rejections per error code"""
+    stats = rejected_token_cache.stats()
+    with _rejections_lock:
+        stats['by_code'] = dict(rejections_by_code)
+    return stats
 
 
 '''
@@ -195,20 +337,104 @@ def check_permissions(permission, payload):
         }, 401)
     return True
 
+
+'''
+    @requires_include(permission) decorator method
+    @INPUTS
+        permission: the permission ?include= also needs (i.e. 'get:actors')
+
+    it should sit right below @requires_auth, which passes the decoded payload as first argument
+    it should check the permission whenever the request has ?include=, before @conditional
+        or @cached can answer with a 304 or a stored body
+'''
+
+
+def requires_include(permission):
+    """Checks the permission of the included kind before the view, its cache and validators"""
+    def requires_include_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            if 'include' in request.args:
+                check_permissions(permission, payload)
+            return f(payload, *args, **kwargs)
+        return wrapper
+    return requires_include_decorator
+
+
+'''
+    PermissionPolicy
+    a route's permission requirement, compiled once when the route is decorated
+
+    it should be satisfied when the token holds every permission in `all_of`
+        and, if `any_of` is not empty, at least one permission in `any_of`
+    each permission is checked with a single set lookup
+'''
+
+
+class PermissionPolicy(object):
+    """Frozen all-of / any-of permission requirement for a route"""
+
+    def __init__(self, all_of=(), any_of=()):
+        self.all_of = frozenset(all_of)
+        self.any_of = frozenset(any_of)
+
+    def allows(self, permissions):
+        """True if the set of granted permissions satisfies the policy"""
+        if not self.all_of <= permissions:
+            return False
+        return not self.any_of or not self.any_of.isdisjoint(permissions)
+
+    def format(self):
+        return {
+            'all_of': sorted(self.all_of),
+            'any_of': sorted(self.any_of),
+        }
+
+    def __repr__(self):
+        return f'<PermissionPolicy all_of: {sorted(self.all_of)}, any_of: {sorted(self.any_of)}>'
+
+
+def check_policy(policy, verified):
+    """Checks a compiled PermissionPolicy against a VerifiedToken"""
+    if verified.permissions is None:
+        print("❌ 'permissions' not in payload for:", policy)
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Permission not included in JWT.'
+        }, 400)
+    if not policy.allows(verified.permissions):
+        print("❌ matching permission not found in payload['permissions'] for:", policy)
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found.'
+        }, 401)
+    return True
+
+
 '''
     @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
+        all_of: optional permissions that are all required as well
+        any_of: optional permissions of which at least one is required
 
+    it should compile the requirement into a PermissionPolicy once, at decoration time
+        and expose it as `permission_policy` on the decorated view
+        (requires_auth() with no permissions accepts any verified token)
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
-    it should use the check_permissions method validate claims and check the requested permission
+    it should use the get_verified_token method to decode the jwt
+        unless the same token was already verified in this app context, which is how
+        the operations of a POST /batch reuse the batch's verification
+    it should use the check_policy method validate claims and check the requested permissions
     return the decorator which passes the decoded payload to the decorated method
 '''
 
 
-def requires_auth(permission=''):  # defaults permission to empty string
+def requires_auth(permission='', all_of=(), any_of=()):  # defaults permission to empty string
     """Defines a decorator specifically used for Authentication"""
+    required = [permission] if permission else []
+    policy = PermissionPolicy(all_of=required + list(all_of), any_of=any_of)
+
     def requires_auth_decorator(f):  # wraps auth decorator
         @wraps(f)
         def wrapper(*args, **kwargs):
@@ -216,12 +442,15 @@ def requires_auth(permission=''):  # defaults permission to empty string
             # print('🚧 validating token in header')
             token = get_token_auth_header()
             # print('verifying header payload')
-            payload = verify_decode_jwt(token)
-            # print('payload', payload)
+            reused = g.get('verified_token')
+            if reused is not None and reused[0] == token:
+                verified = reused[1]
+            else:
+                verified = get_verified_token(token)
+                g.verified_token = (token, verified)
             # check permissions
-            print('🧐 checking permission for', permission)
-            check_permissions(permission, payload)
-            print('permitted')
-            return f(payload, *args, **kwargs)
+            check_policy(policy, verified)
+            return f(verified.payload, *args, **kwargs)
+        wrapper.permission_policy = policy
         return wrapper
     return requires_auth_decorator
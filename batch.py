@@ -0,0 +1,111 @@
+import os
+import json
+from flask import request, abort, current_app, g
+from models import db
+
+BATCH_MAX_OPERATIONS = int(os.getenv('BATCH_MAX_OPERATIONS', 50))
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+
+'''
+    POST /batch helpers
+
+    every operation is dispatched in-process through the app's own routing, error
+    handlers and decorators, under a request context that reuses the batch's app
+    context: no WSGI round trip, and requires_auth finds the batch's verified token
+    on `g` instead of verifying it again
+    in an atomic batch `g.atomic_batch` collects the after_commit callbacks of the
+    operations while models.commit() only flushes, and `g.atomic_rollback` their
+    after_rollback callbacks, see models.py
+'''
+
+
+def parse_operations():
+    """Reads {"operations": [{"method", "path", "body"}], "atomic": bool} from the json body,
+    aborts with 400 if it is malformed"""
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        abort(400, 'operations must be a non empty list')
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        abort(400, 'at most {} operations per batch'.format(BATCH_MAX_OPERATIONS))
+    parsed = []
+    for operation in operations:
+        if not isinstance(operation, dict):
+            abort(400, 'each operation must be an object')
+        method = str(operation.get('method', '')).upper()
+        path = operation.get('path')
+        if method not in BATCH_METHODS or not isinstance(path, str) or not path.startswith('/'):
+            abort(400, 'each operation needs a method and an absolute path')
+        parsed.append({'method': method, 'path': path, 'body': operation.get('body')})
+    atomic = data.get('atomic', False)
+    if not isinstance(atomic, bool):
+        abort(400, 'atomic must be a boolean')
+    return parsed, atomic
+
+
+def error_result(status, message):
+    return {'status': status, 'body': {'success': False, 'error': status, 'message': message}}
+
+
+def dispatch(operation, endpoints, headers):
+    """Runs one operation through the app and returns {"status": code, "body": json}"""
+    body = {}
+    if operation['body'] is not None:
+        # not json=: Flask 1.0 serializes it in an app context of its own, whose teardown
+        # removes the session and the rows an atomic batch has flushed so far
+        body = {'data': json.dumps(operation['body']), 'content_type': 'application/json'}
+    with current_app.test_request_context(
+            operation['path'], method=operation['method'], headers=headers, **body):
+        if request.routing_exception is None and request.url_rule.endpoint not in endpoints:
+            return error_result(400, 'not allowed in a batch')
+        try:
+            response = current_app.full_dispatch_request()
+        except Exception:
+            # no error handler took it: report it like the 500 handler would
+            current_app.logger.exception('batch operation %s %s failed', operation['method'], operation['path'])
+            db.session.rollback()
+            return error_result(500, 'internal server error')
+        # read while the request context is still there, streamed bodies need it
+        response.get_data()
+        return {'status': response.status_code, 'body': response.get_json(silent=True)}
+
+
+def run_batch(operations, atomic, endpoints):
+    """Dispatches operations in order; returns (results, committed)
+
+    an atomic batch stops at the first operation failing with a status >= 400, rolls
+    everything back and reports the remaining operations as 424; otherwise it commits
+    once, after the last operation, then runs the deferred after_commit callbacks"""
+    headers = {'Authorization': request.headers.get('Authorization', '')}
+    if not atomic:
+        return [dispatch(operation, endpoints, headers) for operation in operations], True
+
+    results = []
+    committed = False
+    g.atomic_batch = []
+    g.atomic_rollback = []
+    try:
+        for operation in operations:
+            results.append(dispatch(operation, endpoints, headers))
+            if results[-1]['status'] >= 400:
+                break
+        committed = len(results) == len(operations) and results[-1]['status'] < 400
+        if committed:
+            db.session.commit()
+        else:
+            db.session.rollback()
+    except Exception:
+        committed = False
+        db.session.rollback()
+        raise
+    finally:
+        callbacks = g.atomic_batch if committed else g.atomic_rollback
+        g.atomic_batch = None
+        g.atomic_rollback = None
+        # outside the batch now, so the callbacks act right away
+        for callback, args, kwargs in callbacks:
+            callback(*args, **kwargs)
+    results.extend(error_result(424, 'not run, an earlier operation failed')
+                   for _ in operations[len(results):])
+    return results, committed
@@ -0,0 +1,78 @@
+"""
+Rows per second through POST /api/movies (one movie per request) against
+POST /api/movies/bulk (every movie in one request).
+
+    python benchmarks/bench_bulk_create.py [rows] [batch size]
+
+Requests go through the flask test client with a locally signed token, so the
+numbers include routing, auth and json handling but no network; over a real
+network every single-row request also pays a round trip. Runs against a
+temporary sqlite file unless BENCH_DATABASE_URL points to a postgres database,
+whose tables are dropped and recreated.
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+os.environ.setdefault('AUTH0_ALGORITHMS', 'RS256')
+os.environ.setdefault('AUTH0_AUDIENCE', 'casting')
+os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL') or (
+    'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_bulk_create.db'))
+
+from jose import jwt  # noqa: E402
+import auth  # noqa: E402
+from app import create_app  # noqa: E402
+from models import db, db_drop_and_create_all, Movie  # noqa: E402
+from bench_jwt_verify import StaticJWKSCache, make_jwks  # noqa: E402
+
+
+def make_headers():
+    private_pem, jwks = make_jwks(1)
+    auth.jwks_cache = StaticJWKSCache(jwks)
+    now = int(time.time())
+    token = jwt.encode({
+        'iss': 'https://' + auth.AUTH0_DOMAIN + '/', 'aud': auth.AUTH0_AUDIENCE,
+        'sub': 'bench', 'iat': now, 'exp': now + 3600, 'permissions': ['post:movies'],
+    }, private_pem, algorithm='RS256', headers={'kid': jwks['keys'][0]['kid']})
+    return {'Authorization': 'Bearer ' + token}
+
+
+def main(rows=5000, batch_size=1000):
+    app = create_app()
+    client = app.test_client()
+    headers = make_headers()
+    movies = [{'title': 'Movie {}'.format(index), 'year': 1900 + index % 120} for index in range(rows)]
+
+    with app.app_context():
+        db_drop_and_create_all()
+
+    started = time.perf_counter()
+    for movie in movies:
+        assert client.post('/api/movies', headers=headers, json=movie).status_code == 200
+    single = time.perf_counter() - started
+
+    with app.app_context():
+        db_drop_and_create_all()
+
+    started = time.perf_counter()
+    for start in range(0, rows, batch_size):
+        res = client.post('/api/movies/bulk', headers=headers, json={'movies': movies[start:start + batch_size]})
+        assert res.status_code == 200
+    bulk = time.perf_counter() - started
+
+    with app.app_context():
+        assert Movie.query.count() == rows
+        print('backend: {}, rows: {}, bulk batch size: {}'.format(db.engine.dialect.name, rows, batch_size))
+        db.session.remove()
+        db.drop_all()
+
+    print('single-row POST /movies:     {:8.0f} rows/s ({:.2f}s)'.format(rows / single, single))
+    print('bulk POST /movies/bulk:      {:8.0f} rows/s ({:.2f}s)'.format(rows / bulk, bulk))
+    print('speedup: {:.1f}x'.format(single / bulk))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,89 @@
+"""
+Build time, memory and query latency of the co-star graph index.
+
+    python benchmarks/bench_cast_graph.py [actors] [movies] [cast per movie]
+
+The default synthetic catalog has 500k actors and 200k movies with 10 actors
+each, i.e. 2M cast edges. Cast members are drawn with a skew towards low
+actor ids, so a few prolific actors appear in thousands of movies and most
+in a handful, as in real casts.
+Everything runs in memory, no database involved.
+"""
+import os
+import sys
+import time
+import random
+import statistics
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+os.environ.setdefault('AUTH0_ALGORITHMS', 'RS256')
+os.environ.setdefault('AUTH0_AUDIENCE', 'casting')
+
+from graph import CastGraph  # noqa: E402
+
+
+class StaticCastGraph(CastGraph):
+    """Cast graph that is never stale, so no database is needed"""
+
+    def state(self):
+        return self._state
+
+
+def make_cast(actor_count, movie_count, per_movie, rng):
+    actors = array('i')
+    movies = array('i')
+    for movie_id in range(1, movie_count + 1):
+        cast = set()
+        while len(cast) < per_movie:
+            cast.add(1 + int(actor_count * rng.random() ** 2))
+        for actor_id in cast:
+            actors.append(actor_id)
+            movies.append(movie_id)
+    return actors, movies
+
+
+def main(actor_count=500000, movie_count=200000, per_movie=10):
+    rng = random.Random(1942)
+    actors, movies = make_cast(actor_count, movie_count, per_movie, rng)
+
+    graph = StaticCastGraph()
+    started = time.perf_counter()
+    graph._build(1, actors, movies)
+    built = time.perf_counter() - started
+    memory = sum(
+        sys.getsizeof(side.index) + side.offsets.itemsize * len(side.offsets) + side.targets.itemsize * len(side)
+        for side in (graph._state.movies_of, graph._state.actors_of))
+    stats = graph.stats()
+    print('edges: {}, actors: {}, movies: {}'.format(stats['edges'], stats['actors'], stats['movies']))
+    print('build: {:.2f}s, index size: {:.1f} MB (arrays and id dicts)'.format(built, memory / 1e6))
+
+    known = list(graph._state.movies_of.index)
+    pairs = [(rng.choice(known), rng.choice(known)) for _ in range(200)]
+    costars = []
+    paths = []
+    degrees = []
+    for source, target in pairs:
+        started = time.perf_counter()
+        graph.costars(source)
+        costars.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        chain = graph.path(source, target)
+        paths.append(time.perf_counter() - started)
+        if chain is not None:
+            degrees.append(len(chain) // 2)
+
+    for name, samples in (('costars', costars), ('path', paths)):
+        samples.sort()
+        print('{:>8}: median {:7.2f}ms  p95 {:7.2f}ms  max {:7.2f}ms'.format(
+            name,
+            statistics.median(samples) * 1000,
+            samples[int(len(samples) * 0.95)] * 1000,
+            samples[-1] * 1000))
+    print('connected pairs: {}/{}, mean degrees: {:.2f}'.format(
+        len(degrees), len(pairs), statistics.mean(degrees) if degrees else 0))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,95 @@
+"""
+Per-verify cost of verify_decode_jwt, before and after prepared keys.
+
+    python benchmarks/bench_jwt_verify.py [iterations]
+
+"before" replays the old request path: scan jwks['keys'] for the kid, build an
+rsa_key dict and let jwt.decode parse the modulus and exponent on every call.
+"after" is the current verify_decode_jwt, which checks the signature against
+the key object jwks_cache prepared once for the kid.
+Everything runs against a locally generated RSA keypair, no network involved.
+"""
+import os
+import sys
+import time
+import base64
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+os.environ.setdefault('AUTH0_ALGORITHMS', 'RS256')
+os.environ.setdefault('AUTH0_AUDIENCE', 'casting')
+
+from Crypto.PublicKey import RSA  # noqa: E402
+from jose import jwt  # noqa: E402
+import auth  # noqa: E402
+from jwks import JWKSCache  # noqa: E402
+
+
+class StaticJWKSCache(JWKSCache):
+    """JWKS cache that 'fetches' a key set held in memory"""
+
+    def __init__(self, jwks):
+        super(StaticJWKSCache, self).__init__(url=None)
+        self.jwks = jwks
+
+    def fetch(self):
+        return self.jwks
+
+
+def b64_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def make_jwks(count):
+    """Returns (private pem of the last key, jwks with `count` keys)"""
+    keys = []
+    for index in range(count):
+        private_key = RSA.generate(2048)
+        keys.append({
+            'kty': 'RSA', 'kid': 'key-{}'.format(index), 'use': 'sig', 'alg': 'RS256',
+            'n': b64_uint(private_key.n), 'e': b64_uint(private_key.e),
+        })
+    return private_key.exportKey().decode(), {'keys': keys}
+
+
+def decode_before(token, jwks):
+    unverified_header = jwt.get_unverified_header(token)
+    rsa_key = {}
+    for key in jwks['keys']:
+        if key['kid'] == unverified_header['kid']:
+            rsa_key = {
+                'kty': key['kty'], 'kid': key['kid'], 'use': key['use'],
+                'n': key['n'], 'e': key['e']
+            }
+    return jwt.decode(
+        token, rsa_key,
+        algorithms=auth.AUTH0_ALGORITHMS,
+        audience=auth.AUTH0_AUDIENCE,
+        issuer='https://' + auth.AUTH0_DOMAIN + '/'
+    )
+
+
+def main(iterations=2000):
+    private_pem, jwks = make_jwks(2)
+    kid = jwks['keys'][-1]['kid']
+    now = int(time.time())
+    token = jwt.encode({
+        'iss': 'https://' + auth.AUTH0_DOMAIN + '/', 'aud': auth.AUTH0_AUDIENCE,
+        'sub': 'bench', 'iat': now, 'exp': now + 3600, 'permissions': ['get:movies'],
+    }, private_pem, algorithm='RS256', headers={'kid': kid})
+
+    auth.jwks_cache = StaticJWKSCache(jwks)
+    assert decode_before(token, jwks) == auth.verify_decode_jwt(token)
+
+    before = timeit.timeit(lambda: decode_before(token, jwks), number=iterations)
+    after = timeit.timeit(lambda: auth.verify_decode_jwt(token), number=iterations)
+    print('iterations: {}'.format(iterations))
+    print('before (jwk dict per call): {:8.1f} us/verify'.format(before / iterations * 1e6))
+    print('after  (prepared key):      {:8.1f} us/verify'.format(after / iterations * 1e6))
+    print('speedup: {:.2f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
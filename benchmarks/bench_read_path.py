@@ -0,0 +1,112 @@
+"""
+Latency and peak allocations of the list and item reads, through ORM instances and
+format() against the Core rows the api now serializes.
+
+    python benchmarks/bench_read_path.py [rows ...]
+
+For each table size (default 1k, 10k and 100k movies) it times:
+
+    list    every movie, ordered by id, encoded to json (GET /movies?all=true)
+    item    200 single movie lookups by id, encoded to json (GET /movies/<id>)
+
+once the old way (Movie.query ... .all() / .get() then format()) and once through
+listing.fetch / listing.get_item, checking both give the same json. Peak allocations
+are measured in a separate run under tracemalloc, which would skew the timings.
+
+Runs against a temporary sqlite file unless BENCH_DATABASE_URL points to a postgres
+database, whose movies table is dropped and recreated.
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import statistics
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+os.environ.setdefault('AUTH0_ALGORITHMS', 'RS256')
+os.environ.setdefault('AUTH0_AUDIENCE', 'casting')
+
+from flask import Flask  # noqa: E402
+from models import db, setup_db, Movie  # noqa: E402
+from listing import list_query, ordered, fetch, get_item  # noqa: E402
+
+REPEAT = 5
+LOOKUPS = 200
+
+
+def orm_list():
+    return json.dumps([movie.format() for movie in Movie.query.order_by(Movie.id).all()])
+
+
+def core_list():
+    query, serialize, sort = list_query(Movie, 'movies')
+    return json.dumps([serialize(row) for row in fetch(ordered(query, Movie, sort))])
+
+
+def orm_items(ids):
+    return [json.dumps(Movie.query.get(movie_id).format()) for movie_id in ids]
+
+
+def core_items(ids):
+    return [json.dumps(get_item(Movie, movie_id)) for movie_id in ids]
+
+
+def measure(read):
+    """Returns (median seconds, peak bytes) of read(), the session emptied before each run"""
+    samples = []
+    for _ in range(REPEAT):
+        db.session.remove()
+        started = time.perf_counter()
+        read()
+        samples.append(time.perf_counter() - started)
+    db.session.remove()
+    tracemalloc.start()
+    read()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(samples), peak
+
+
+def main(sizes=(1000, 10000, 100000)):
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_read_path.db')
+    app = Flask(__name__)
+    setup_db(app, database_path=database_url)
+    rng = random.Random(1942)
+
+    with app.test_request_context('/api/movies?all=true'):
+        db.drop_all()
+        db.create_all()
+        print('backend: {}'.format(db.engine.dialect.name))
+        print('{:>7} {:>5} {:>11} {:>11} {:>8} {:>12} {:>12} {:>8}'.format(
+            'rows', 'read', 'orm', 'core', 'speedup', 'orm peak', 'core peak', 'saved'))
+        rows = 0
+        for size in sizes:
+            db.session.execute(Movie.__table__.insert(), [
+                {'title': 'Movie {}'.format(index), 'year': rng.randint(1920, 2020)}
+                for index in range(rows, size)])
+            db.session.commit()
+            rows = size
+            ids = [rng.randint(1, size) for _ in range(LOOKUPS)]
+            assert orm_list() == core_list()
+            assert orm_items(ids[:10]) == core_items(ids[:10])
+
+            for name, orm, core in (
+                    ('list', orm_list, core_list),
+                    ('item', lambda: orm_items(ids), lambda: core_items(ids))):
+                orm_time, orm_peak = measure(orm)
+                core_time, core_peak = measure(core)
+                print('{:>7} {:>5} {:>9.2f}ms {:>9.2f}ms {:>7.1f}x {:>10.1f}MB {:>10.1f}MB {:>7.0%}'.format(
+                    size, name, orm_time * 1000, core_time * 1000, orm_time / core_time,
+                    orm_peak / 1e6, core_peak / 1e6, 1 - core_peak / orm_peak))
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main(*[[int(arg) for arg in sys.argv[1:]]] if sys.argv[1:] else [])
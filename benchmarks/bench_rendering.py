@@ -0,0 +1,84 @@
+"""
+Time to encode a list response: jsonify of the row dicts against the rendering layer,
+with each json encoder, cold (every row encoded) and warm (rows from the fragment cache).
+
+    python benchmarks/bench_rendering.py [rows ...]
+
+For each list size (default 50, 500 and 10k movies, the default page, the largest page
+and a ?all=true list) it checks every variant gives the same document, then reports
+the median of REPEAT runs.
+"""
+import os
+import sys
+import json
+import time
+import random
+import statistics
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+os.environ.setdefault('AUTH0_ALGORITHMS', 'RS256')
+os.environ.setdefault('AUTH0_AUDIENCE', 'casting')
+
+from flask import Flask, jsonify  # noqa: E402
+import rendering  # noqa: E402
+from rendering import RowFragments, StdlibEncoder, build_encoder, envelope_response  # noqa: E402
+
+REPEAT = 20
+Row = namedtuple('Row', ('id', 'title', 'year'))
+
+
+def serialize(row):
+    return dict(zip(Row._fields, row))
+
+
+def with_jsonify(rows):
+    return jsonify({'success': True, 'movies': [serialize(row) for row in rows]}).get_data()
+
+
+def with_encoder(encoder, fragments):
+    def render(rows):
+        rendering.json_encoder = encoder
+        return envelope_response('movies', fragments.encode('movies', (1, None), rows, serialize, encoder)).get_data()
+    return render
+
+
+def measure(render, rows):
+    samples = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        render(rows)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def main(sizes=(50, 500, 10000)):
+    app = Flask(__name__)
+    rng = random.Random(1942)
+    encoders = [StdlibEncoder()]
+    fast = build_encoder('auto')
+    if fast.name != 'stdlib':
+        encoders.append(fast)
+    else:
+        print('orjson is not installed, only the stdlib encoder is measured')
+
+    with app.app_context():
+        print('{:>6} {:>12} {:>11} {:>8}'.format('rows', 'encoder', 'median', 'speedup'))
+        for size in sizes:
+            rows = [Row(index, 'Movie {}'.format(index), rng.randint(1920, 2020)) for index in range(1, size + 1)]
+            expected = json.loads(with_jsonify(rows))
+            baseline = measure(with_jsonify, rows)
+            print('{:>6} {:>12} {:>9.3f}ms {:>7.1f}x'.format(size, 'jsonify', baseline * 1000, 1.0))
+            for encoder in encoders:
+                cold = with_encoder(encoder, RowFragments(maxsize=0))
+                warm = with_encoder(encoder, RowFragments(maxsize=size))
+                assert json.loads(cold(rows)) == expected and json.loads(warm(rows)) == expected
+                for name, render in (('', cold), ('+cache', warm)):
+                    median = measure(render, rows)
+                    print('{:>6} {:>12} {:>9.3f}ms {:>7.1f}x'.format(
+                        size, encoder.name + name, median * 1000, baseline / median))
+
+
+if __name__ == '__main__':
+    main(*[[int(arg) for arg in sys.argv[1:]]] if sys.argv[1:] else [])
@@ -0,0 +1,128 @@
+"""
+Latency of search() as the catalog grows to 1M rows.
+
+    python benchmarks/bench_search.py [rows ...]
+
+The catalog (half movies, half actors) is grown to each size in turn, default
+10k, 100k and 1M rows, and after each step the same queries are timed:
+
+    rare    a word carried by a fixed 10 rows whatever the catalog size
+    prefix  a partial word, as typed in a search box
+    typo    a misspelt word (only matches on postgres, FTS5 has no fuzzy match)
+    scan    LIKE '%word%' over both tables for the rare word, the full scan
+            search() avoids
+
+The indexed queries read the rows matching the query rather than the catalog:
+the rare query stays flat, the prefix query grows with its number of matches
+(which grows with a fixed vocabulary, far slower than the catalog), while the
+scan grows with the catalog. The last line gives each query's slowdown between
+the smallest and the largest catalog.
+
+Runs against a temporary sqlite file unless BENCH_DATABASE_URL points to a
+postgres database, whose movies and actors tables are dropped and recreated.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from models import db, setup_db, Actor, Movie  # noqa: E402
+from search import search  # noqa: E402
+
+BATCH_SIZE = 20000
+REPEAT = 20
+LIMIT = 20
+SYLLABLES = ['ka', 'ro', 'mi', 'te', 'sun', 'val', 'dor', 'li', 'zen', 'pa', 'qua', 'ber', 'no', 'shi', 'tor']
+
+
+def make_words(count, rng):
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def grow(start, stop, words, rng):
+    """Adds the rows start..stop of the catalog, alternating movies and actors"""
+    for offset in range(start, stop, BATCH_SIZE):
+        count = min(BATCH_SIZE, stop - offset)
+        movies = [{'title': ' '.join(rng.sample(words, 3)), 'year': rng.randint(1920, 2020)}
+                  for _ in range(count // 2)]
+        actors = [{'name': ' '.join(rng.sample(words, 2)).title(), 'age': rng.randint(5, 90),
+                   'gender': rng.choice('mf')} for _ in range(count - count // 2)]
+        db.session.execute(Movie.__table__.insert(), movies)
+        db.session.execute(Actor.__table__.insert(), actors)
+        db.session.commit()
+
+
+def timed(query):
+    samples = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        query()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+def scan(word):
+    pattern = '%{}%'.format(word)
+    for table, column in (('movies', 'title'), ('actors', 'name')):
+        db.session.execute(text(
+            'SELECT id FROM {} WHERE {} LIKE :pattern ORDER BY id LIMIT :limit'.format(table, column)),
+            {'pattern': pattern, 'limit': LIMIT}).fetchall()
+
+
+def main(sizes=(10000, 100000, 1000000)):
+    rng = random.Random(1942)
+    words = make_words(20000, rng)
+    needle = 'zyzzogeton'
+    typo = needle[:4] + needle[5:]
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_search.db')
+    app = Flask(__name__)
+    setup_db(app, database_path=database_url)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(Movie.__table__.insert(), [
+            {'title': '{} {}'.format(needle, rng.choice(words)), 'year': 2000} for _ in range(5)])
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': '{} {}'.format(rng.choice(words), needle), 'age': 30, 'gender': 'f'}
+            for _ in range(5)])
+        db.session.commit()
+
+        queries = [
+            ('rare', lambda: (search('movies', needle, LIMIT), search('actors', needle, LIMIT))),
+            ('prefix', lambda: (search('movies', words[0][:4], LIMIT), search('actors', words[0][:4], LIMIT))),
+            ('typo', lambda: (search('movies', typo, LIMIT), search('actors', typo, LIMIT))),
+            ('scan', lambda: scan(needle)),
+        ]
+        print('backend: {}'.format(db.engine.dialect.name))
+        print('{:>9} {}'.format('rows', ' '.join('{:>10}'.format(name) for name, query in queries)))
+        rows = 0
+        latencies = []
+        for size in sizes:
+            grow(rows, size, words, rng)
+            rows = size
+            if db.engine.dialect.name == 'postgresql':
+                db.session.execute(text('ANALYZE'))
+                db.session.commit()
+            latencies.append([timed(query) for name, query in queries])
+            print('{:>9} {}'.format(size, ' '.join('{:>8.2f}ms'.format(ms) for ms in latencies[-1])))
+        print('{:>8}x {}'.format(sizes[-1] // sizes[0], ' '.join(
+            '{:>9.1f}x'.format(last / first) for first, last in zip(latencies[0], latencies[-1]))))
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main(*[[int(arg) for arg in sys.argv[1:]]] if sys.argv[1:] else [])
@@ -0,0 +1,264 @@
+import os
+from flask import request, abort
+from sqlalchemy import and_, false
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from models import db, cast
+from listing import apply_filters
+
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 1000))
+BULK_MAX_IDS = int(os.getenv('BULK_MAX_IDS', 10000))
+BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', 10000))
+
+# sqlite builds may cap a statement at 999 bound parameters
+SQLITE_MAX_PARAMETERS = 999
+
+
+'''
+    set-based helpers for writes touching many rows at once
+
+    every helper issues one statement per chunk of BULK_CHUNK_SIZE rows
+    (fewer on sqlite, see chunk_size) and leaves the version bump and the commit
+    to the caller, so a whole bulk request is applied in a single transaction
+'''
+
+
+def chunk_size(params_per_row=1):
+    """Returns how many rows fit in one statement on the current database"""
+    if db.engine.dialect.name == 'sqlite':
+        # one parameter is left for the rest of the WHERE clause
+        return max(1, min(BULK_CHUNK_SIZE, (SQLITE_MAX_PARAMETERS - 1) // params_per_row))
+    return BULK_CHUNK_SIZE
+
+
+def chunks(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def parse_ids(key):
+    """Reads the list of ids under `key` in the json body, aborts with 400 if it is not one"""
+    data = request.get_json(silent=True) or {}
+    ids = data.get(key)
+    if not isinstance(ids, list) or not all(isinstance(item, int) and not isinstance(item, bool) for item in ids):
+        abort(400, '{} must be a list of ids'.format(key))
+    if len(ids) > BULK_MAX_IDS:
+        abort(400, 'at most {} {} per request'.format(BULK_MAX_IDS, key))
+    # keeps the request order, without duplicates
+    return list(dict.fromkeys(ids))
+
+
+def existing_ids(model, ids):
+    """Returns the subset of ids that exist in model's table"""
+    found = set()
+    for chunk in chunks(ids, chunk_size()):
+        found.update(row[0] for row in db.session.execute(
+            db.select([model.id]).where(model.id.in_(chunk))))
+    return found
+
+
+def require_ids(model, ids):
+    """Aborts with 422 unless every id exists in model's table"""
+    found = existing_ids(model, ids)
+    missing = [item for item in ids if item not in found]
+    if missing:
+        abort(422, 'Unknown {} ids: {}'.format(model.__tablename__, ', '.join(str(item) for item in missing[:20])))
+
+
+def cast_actor_ids(movie_id):
+    """Returns the ids of the actors cast in movie_id"""
+    return set(row[0] for row in db.session.execute(
+        db.select([cast.c.actor_id]).where(cast.c.movie_id == movie_id)))
+
+
+def insert_cast(movie_id, actor_ids):
+    """Casts actor_ids in movie_id, skipping the pairs that already exist; returns rows added"""
+    added = 0
+    for chunk in chunks(actor_ids, chunk_size(params_per_row=2)):
+        rows = [{'movie_id': movie_id, 'actor_id': actor_id} for actor_id in chunk]
+        if db.engine.dialect.name == 'postgresql':
+            statement = pg_insert(cast).values(rows).on_conflict_do_nothing()
+        else:
+            statement = cast.insert().prefix_with('OR IGNORE').values(rows)
+        added += db.session.execute(statement).rowcount
+    return added
+
+
+def delete_cast(movie_id, actor_ids):
+    """Removes actor_ids from the cast of movie_id; returns rows removed"""
+    removed = 0
+    for chunk in chunks(actor_ids, chunk_size()):
+        removed += db.session.execute(
+            cast.delete().where(cast.c.movie_id == movie_id).where(cast.c.actor_id.in_(chunk))
+        ).rowcount
+    return removed
+
+
+def set_cast(movie_id, actor_ids):
+    """Makes actor_ids the exact cast of movie_id; returns (rows added, rows removed)"""
+    current = cast_actor_ids(movie_id)
+    wanted = set(actor_ids)
+    removed = delete_cast(movie_id, [item for item in current if item not in wanted])
+    added = insert_cast(movie_id, [item for item in actor_ids if item not in current])
+    return added, removed
+
+
+'''
+    bulk create
+
+    CREATE_FIELDS lists the required fields of each kind and their type
+    every item is validated before anything is written, so a batch is either
+    inserted whole or rejected with the errors of each bad item
+'''
+CREATE_FIELDS = {
+    'movies': (('title', str), ('year', int)),
+    'actors': (('name', str), ('age', int), ('gender', str)),
+}
+
+
+def parse_items(key):
+    """Reads the list of items under `key` in the json body, aborts with 400 if it is not one"""
+    data = request.get_json(silent=True) or {}
+    items = data.get(key)
+    if not isinstance(items, list) or not items:
+        abort(400, '{} must be a non empty list'.format(key))
+    if len(items) > BULK_MAX_ITEMS:
+        abort(400, 'at most {} {} per request'.format(BULK_MAX_ITEMS, key))
+    return items
+
+
+def validate_items(key, items):
+    """Returns (rows, errors) where errors lists {"index": i, "errors": {field: reason}}
+    for each invalid item"""
+    fields = CREATE_FIELDS[key]
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({'index': index, 'errors': {'item': 'must be an object'}})
+            continue
+        problems = {}
+        for name, kind in fields:
+            value = item.get(name)
+            if value is None:
+                problems[name] = 'is required'
+            elif not isinstance(value, kind) or isinstance(value, bool):
+                problems[name] = 'must be an integer' if kind is int else 'must be a string'
+        for name in item:
+            if name not in dict(fields):
+                problems[name] = 'is not a field of {}'.format(key)
+        if problems:
+            errors.append({'index': index, 'errors': problems})
+        else:
+            rows.append(dict((name, item[name]) for name, kind in fields))
+    return rows, errors
+
+
+def insert_rows(model, rows):
+    """Inserts rows into model's table and returns their new ids, in order"""
+    table = model.__table__
+    ids = []
+    if db.engine.dialect.name == 'postgresql':
+        for chunk in chunks(rows, chunk_size(params_per_row=len(rows[0]))):
+            result = db.session.execute(table.insert().values(chunk).returning(table.c.id))
+            ids.extend(row[0] for row in result)
+    else:
+        # no RETURNING here, and sqlite runs in process so a statement per row costs no round trip
+        for row in rows:
+            ids.append(db.session.execute(table.insert(), row).inserted_primary_key[0])
+    return ids
+
+
+'''
+    bulk update and delete
+
+    the targeted rows are given by an {"ids": [...]} json body, by the list filters of
+    the query string (i.e. ?year_max=1950, see listing.FILTERS), or both
+    postgres updates / deletes them with one `... WHERE ... RETURNING id` statement
+    per chunk of ids; elsewhere the matching ids are selected first and the rows
+    are written by id, so the affected ids reported are exactly the rows written
+'''
+CAST_COLUMNS = {
+    'movies': cast.c.movie_id,
+    'actors': cast.c.actor_id,
+}
+
+
+def parse_targets(model, key):
+    """Returns (ids, condition) selecting the rows of a bulk write, either may be None;
+    aborts with 400 when neither is given"""
+    data = request.get_json(silent=True) or {}
+    ids = parse_ids('ids') if 'ids' in data else None
+    condition = apply_filters(model.query, model, key).whereclause
+    if ids is None and condition is None:
+        abort(400, 'ids or a filter is required')
+    return ids, condition
+
+
+def target_clauses(model, ids, condition):
+    """Yields the WHERE clauses covering the targeted rows, one per chunk of ids"""
+    if ids is None:
+        yield condition
+        return
+    if not ids:
+        yield false()
+        return
+    for chunk in chunks(ids, chunk_size()):
+        clause = model.id.in_(chunk)
+        yield clause if condition is None else and_(clause, condition)
+
+
+def parse_values(key):
+    """Reads the {"set": {field: value}} json body of a bulk update, aborts with 422
+    listing the reason of each invalid field"""
+    data = request.get_json(silent=True) or {}
+    values = data.get('set')
+    if not isinstance(values, dict) or not values:
+        abort(400, 'set must be an object of the fields to update')
+    fields = dict(CREATE_FIELDS[key])
+    problems = {}
+    for name, value in values.items():
+        if name not in fields:
+            problems[name] = 'is not a field of {}'.format(key)
+        elif not isinstance(value, fields[name]) or isinstance(value, bool):
+            problems[name] = 'must be an integer' if fields[name] is int else 'must be a string'
+    return values, problems
+
+
+def matching_ids(table, clause):
+    return [row[0] for row in db.session.execute(db.select([table.c.id]).where(clause))]
+
+
+def update_rows(model, values, clauses):
+    """Sets values on the rows matching clauses; returns their ids"""
+    table = model.__table__
+    ids = []
+    for clause in clauses:
+        if db.engine.dialect.name == 'postgresql':
+            result = db.session.execute(table.update().where(clause).values(values).returning(table.c.id))
+            ids.extend(row[0] for row in result)
+            continue
+        matched = matching_ids(table, clause)
+        for chunk in chunks(matched, chunk_size()):
+            db.session.execute(table.update().where(table.c.id.in_(chunk)).values(values))
+        ids.extend(matched)
+    return sorted(ids)
+
+
+def delete_rows(model, key, clauses):
+    """Deletes the rows matching clauses along with their cast rows; returns their ids"""
+    table = model.__table__
+    cast_column = CAST_COLUMNS[key]
+    ids = []
+    for clause in clauses:
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(cast.delete().where(cast_column.in_(db.select([table.c.id]).where(clause))))
+            result = db.session.execute(table.delete().where(clause).returning(table.c.id))
+            ids.extend(row[0] for row in result)
+            continue
+        matched = matching_ids(table, clause)
+        for chunk in chunks(matched, chunk_size()):
+            db.session.execute(cast.delete().where(cast_column.in_(chunk)))
+            db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+        ids.extend(matched)
+    return sorted(ids)
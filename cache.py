@@ -0,0 +1,354 @@
+import os
+import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response, Response
+from models import in_atomic_batch
+from conditional import validators
+
+
+_missing = object()
+
+
+'''
+    LRUCache
+    a thread-safe, size-bounded least-recently-used mapping
+
+    it should evict the least recently used entry once `maxsize` is exceeded
+    it should never return an entry past its expiry
+        entries expire `ttl` seconds after being set, or at an explicit `expires_at`
+    it should count hits, misses and evictions
+'''
+
+
+class LRUCache(object):
+    """Size-bounded LRU mapping with optional per-entry expiry"""
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, default=None):
+        """Returns the live value for key, or default"""
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is not _missing:
+                value, expires_at = entry
+                if expires_at is None or expires_at > self.clock():
+                    self._data.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return value
+                del self._data[key]
+            self._stats['misses'] += 1
+            return default
+
+    def get_many(self, keys):
+        """Returns the live value for each key, None where there is none, under one lock"""
+        now = self.clock()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key, _missing)
+                if entry is not _missing:
+                    value, expires_at = entry
+                    if expires_at is None or expires_at > now:
+                        self._data.move_to_end(key)
+                        self._stats['hits'] += 1
+                        values.append(value)
+                        continue
+                    del self._data[key]
+                self._stats['misses'] += 1
+                values.append(None)
+        return values
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        """Stores value under key, evicting the oldest entries if full; returns the evicted keys"""
+        if expires_at is None:
+            ttl = self.ttl if ttl is None else ttl
+            if ttl is not None:
+                expires_at = self.clock() + ttl
+        evicted = []
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False)[0])
+                self._stats['evictions'] += 1
+        return evicted
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _missing)
+        return default if entry is _missing else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def purge_expired(self):
+        """Drops every expired entry now rather than when it is next read; returns how many"""
+        now = self.clock()
+        with self._lock:
+            expired = [key for key, (value, expires_at) in self._data.items()
+                       if expires_at is not None and expires_at <= now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Returns a snapshot of the cache counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._data)
+        stats['maxsize'] = self.maxsize
+        return stats
+
+
+'''
+    response cache backends
+    a backend stores opaque bytes under string keys, and keeps integer generations
+    that are bumped to invalidate every entry built on top of them
+
+    MemoryBackend keeps entries in an LRUCache of this worker process
+    RedisBackend shares entries between gunicorn workers through a redis client
+        (anything exposing get, set(ex=) and incr, i.e. redis.Redis)
+'''
+
+
+class MemoryBackend(object):
+    """Response cache backend local to this process, bounded in size and age"""
+
+    def __init__(self, maxsize=1024, ttl=60, max_item_generations=10000):
+        self.entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        # list and resource wide generations are few and must never be evicted,
+        # or an invalidation would be lost
+        self.generations = {}
+        # one per item ever written, so bounded; see bump
+        self.item_generations = LRUCache(maxsize=max_item_generations)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, ttl):
+        self.entries.set(key, value, ttl=ttl)
+
+    def generation(self, name):
+        if ':item:' in name:
+            return self.item_generations.get(name, 0)
+        return self.generations.get(name, 0)
+
+    def bump(self, name):
+        with self._lock:
+            if ':item:' not in name:
+                self.generations[name] = self.generations.get(name, 0) + 1
+                return
+            evicted = self.item_generations.set(name, self.item_generations.get(name, 0) + 1)
+            for item in evicted:
+                # the evicted item reads as generation 0 again, which entries cached under
+                # its older generations could match: item entries also carry <res>:items
+                resource = item.split(':item:')[0] + ':items'
+                self.generations[resource] = self.generations.get(resource, 0) + 1
+
+
+class RedisBackend(object):
+    """Response cache backend shared by every worker through redis"""
+
+    def __init__(self, client, prefix='casting:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def generation(self, name):
+        return int(self.client.get(self.prefix + 'gen:' + name) or 0)
+
+    def bump(self, name):
+        self.client.incr(self.prefix + 'gen:' + name)
+
+
+'''
+    ResponseCache
+    caches the 200 responses of GET views
+
+    it should key entries on the route, the query string and the caller's permission scope
+    it should key list entries on the resource's list generation,
+        and item entries on that item's generation, so invalidate(resource, *ids)
+        drops exactly the list and the affected items
+        (or every item of the resource, past RESPONSE_CACHE_MAX_ITEM_BUMPS ids)
+        and invalidate_all(resource) the list and every item, when the table is replaced
+    it should count hits and misses per route
+'''
+
+
+class ResponseCache(object):
+    """Serves repeated GET requests from a pluggable backend"""
+
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def key(self, endpoint, generations, scope):
+        """Builds the entry key for the current request"""
+        query = '&'.join(sorted(
+            '{}={}'.format(name, value)
+            for name, values in request.args.lists() for value in values
+        ))
+        raw = '|'.join([endpoint, request.path, query, scope, generations])
+        return 'response:' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def generations(self, names):
+        return ','.join(str(self.backend.generation(name)) for name in names)
+
+    def get(self, key):
+        data = self.backend.get(key)
+        if data is None:
+            return None
+        meta, _, body = data.partition(b'\n')
+        meta = json.loads(meta.decode('utf-8'))
+        return Response(body, status=meta['status'], headers=meta['headers'])
+
+    def set(self, key, response):
+        meta = json.dumps({
+            'status': response.status_code,
+            'headers': [[name, value] for name, value in response.headers.items()
+                        if name.lower() != 'content-length']
+        }).encode('utf-8')
+        self.backend.set(key, meta + b'\n' + response.get_data(), self.ttl)
+
+    def invalidate(self, resource, *ids):
+        """Drops the cached list of resource and the cached items with the given ids"""
+        if self.backend is None:
+            # RESPONSE_CACHE_BACKEND=none, nothing was cached
+            return
+        self.backend.bump(resource + ':list')
+        if len(ids) > RESPONSE_CACHE_MAX_ITEM_BUMPS:
+            # one bump drops every cached item, rather than thousands of round trips to redis
+            self.backend.bump(resource + ':items')
+            return
+        for item_id in ids:
+            self.backend.bump('{}:item:{}'.format(resource, item_id))
+
+    def invalidate_all(self, resource):
+        """Drops the cached list of resource and every cached item of it"""
+        if self.backend is None:
+            return
+        self.backend.bump(resource + ':list')
+        self.backend.bump(resource + ':items')
+
+    def count(self, endpoint, outcome):
+        with self._stats_lock:
+            stats = self._stats.setdefault(endpoint, {'hits': 0, 'misses': 0})
+            stats[outcome] += 1
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
+
+    def stats(self):
+        """Returns hits, misses and hit ratio per route"""
+        with self._stats_lock:
+            stats = dict((endpoint, dict(counts)) for endpoint, counts in self._stats.items())
+        for counts in stats.values():
+            total = counts['hits'] + counts['misses']
+            counts['hit_ratio'] = round(counts['hits'] / total, 4) if total else 0.0
+        return stats
+
+
+def build_backend(name, redis_url=None, maxsize=1024, ttl=60, max_item_generations=10000):
+    """Returns the response cache backend selected by RESPONSE_CACHE_BACKEND"""
+    if name == 'memory':
+        return MemoryBackend(maxsize=maxsize, ttl=ttl, max_item_generations=max_item_generations)
+    if name == 'redis':
+        # optional dependency, only needed when the shared backend is selected
+        import redis
+        return RedisBackend(redis.Redis.from_url(redis_url))
+    return None
+
+
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory').lower()
+RESPONSE_CACHE_REDIS_URL = os.getenv('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 60))
+RESPONSE_CACHE_ITEM_GENERATIONS = int(os.getenv('RESPONSE_CACHE_ITEM_GENERATIONS', 10000))
+RESPONSE_CACHE_MAX_ITEM_BUMPS = int(os.getenv('RESPONSE_CACHE_MAX_ITEM_BUMPS', 100))
+
+response_cache = ResponseCache(
+    build_backend(
+        RESPONSE_CACHE_BACKEND,
+        redis_url=RESPONSE_CACHE_REDIS_URL,
+        maxsize=RESPONSE_CACHE_SIZE,
+        ttl=RESPONSE_CACHE_TTL,
+        max_item_generations=RESPONSE_CACHE_ITEM_GENERATIONS
+    ),
+    ttl=RESPONSE_CACHE_TTL
+)
+
+
+'''
+    @cached(resource, id_arg=None, depends=()) decorator method
+    @INPUTS
+        resource: the table the view reads (i.e. 'movies')
+        id_arg: the view argument holding the item id, for single item views
+        depends: other tables the response may be built from (i.e. ('actors', 'cast')),
+            any write to them drops it too
+
+    it should sit below @requires_auth, which passes the decoded payload as first argument
+    it should key entries on the versions of resource and depends too, like the ETag of
+        @conditional, so no worker serves a body older than the ETag it is sent with
+    it should return the stored response when one exists for this request
+    it should otherwise call the view and store its response if it is a complete 200
+    it should do nothing when no backend is configured (RESPONSE_CACHE_BACKEND=none)
+        or inside an atomic POST /batch, whose reads may see writes not yet committed
+'''
+
+
+def cached(resource, id_arg=None, depends=()):
+    """Caches a GET view's responses in response_cache"""
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            if response_cache.backend is None or in_atomic_batch():
+                # an atomic batch reads its own uncommitted writes, which must not be cached
+                return f(payload, *args, **kwargs)
+            if id_arg is None:
+                generations = [resource + ':list']
+            else:
+                generations = ['{}:item:{}'.format(resource, kwargs[id_arg]), resource + ':items']
+            generations.extend(table + ':list' for table in depends)
+            scope = ' '.join(sorted(payload.get('permissions', [])))
+            # the tables' versions, the ones the ETag of @conditional was built from: a write
+            # this worker's generations never heard of (another worker's, with the memory
+            # backend) still misses every entry built before it
+            etag, _ = validators((resource,) + tuple(depends))
+            key = response_cache.key(
+                request.endpoint, response_cache.generations(generations) + '|' + etag, scope)
+
+            response = response_cache.get(key)
+            if response is not None:
+                response_cache.count(request.endpoint, 'hits')
+                return response
+            response_cache.count(request.endpoint, 'misses')
+
+            response = make_response(f(payload, *args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.set(key, response)
+            return response
+        return wrapper
+    return cached_decorator
@@ -0,0 +1,70 @@
+from functools import wraps
+from flask import request, make_response
+from models import get_versions
+
+
+'''
+    @conditional(*tables) decorator method
+    @INPUTS
+        tables: names of the tables the response is built from (i.e. 'movies')
+
+    it should build a weak ETag and a Last-Modified date from the tables' version counters
+        and update times, which costs one primary key lookup per table, whatever the size
+        of the response
+    it should answer a matching If-None-Match (or a fresh If-Modified-Since)
+        with an empty 304, before the view queries or serializes any rows
+    it should otherwise call the view and attach the validators to its 200 response
+'''
+
+
+def request_versions(tables):
+    """Returns get_versions(*tables), read once per request: @cached keys its entries
+    on the very values the ETag is built from"""
+    versions = request.environ.setdefault('conditional.versions', {})
+    missing = [table for table in tables if table not in versions]
+    if missing:
+        versions.update(get_versions(*missing))
+    return dict((table, versions[table]) for table in tables)
+
+
+def validators(tables):
+    """Returns (etag, last_modified) for the current versions of tables"""
+    versions = request_versions(tables)
+    # updated_at tells apart the counters starting over after every drop and recreate (/seed)
+    etag = '-'.join('{}.{}.{}'.format(
+        table, versions[table][0],
+        versions[table][1].strftime('%Y%m%d%H%M%S%f') if versions[table][1] else 0
+    ) for table in tables)
+    modified = [updated_at for version, updated_at in versions.values() if updated_at]
+    return etag, max(modified) if modified else None
+
+
+def not_modified(etag, last_modified):
+    """True if the client's cached copy is still current"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def conditional(*tables):
+    """Adds ETag / Last-Modified validators and 304 responses to a GET view"""
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # read before the rows: a write landing in between can only make
+            # the body newer than its ETag, which just costs a later 200
+            etag, last_modified = validators(tables)
+            if not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return conditional_decorator
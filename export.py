@@ -0,0 +1,212 @@
+import os
+import io
+import csv
+import json
+import zlib
+import queue
+import threading
+from flask import request, abort, Response
+from models import db, cast, Actor, Movie
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 5000))
+EXPORT_BUFFER_SIZE = int(os.getenv('EXPORT_BUFFER_SIZE', 64 * 1024))
+EXPORT_QUEUE_SIZE = 64
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+'''
+    bulk export
+
+    rows go from the database to the client without ORM instances or format(), in
+    chunks of about EXPORT_BUFFER_SIZE bytes, so memory stays flat whatever the table size
+
+    postgres writes them with COPY ... TO STDOUT on a connection of its own, from a thread
+        feeding a bounded queue: COPY only stops when the client is gone or the table is done
+    elsewhere they are read through a server-side cursor, EXPORT_BATCH_SIZE rows at a time,
+        and encoded here
+
+    csv has a header line; ndjson has one json object per row
+    both are gzipped on the fly for clients sending Accept-Encoding: gzip
+'''
+EXPORT_TABLES = {
+    'movies': (Movie.__table__, ('id', 'title', 'year'), ('id',)),
+    'actors': (Actor.__table__, ('id', 'name', 'age', 'gender'), ('id',)),
+    'cast': (cast, ('movie_id', 'actor_id'), ('movie_id', 'actor_id')),
+}
+
+
+class Buffer(object):
+    """Collects small writes and hands them on in chunks of at least `size` bytes"""
+
+    def __init__(self, size=EXPORT_BUFFER_SIZE):
+        self.size = size
+        self.parts = []
+        self.length = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.length += len(data)
+        if self.length >= self.size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.length = 0
+        return data
+
+
+def export_format():
+    """Returns ?format= (csv by default), aborts with 400 if it is not one of FORMATS"""
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in FORMATS:
+        abort(400, 'format must be one of {}'.format(', '.join(sorted(FORMATS))))
+    return fmt
+
+
+def copy_statement(key, fmt):
+    table, columns, order = EXPORT_TABLES[key]
+    select = 'SELECT {} FROM "{}" ORDER BY {}'.format(', '.join(columns), table.name, ', '.join(order))
+    if fmt == 'csv':
+        return 'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)'.format(select)
+    return 'COPY (SELECT row_to_json(row) FROM ({}) AS row) TO STDOUT'.format(select)
+
+
+class QueueWriter(object):
+    """File object COPY writes its rows to, one row per write"""
+
+    def __init__(self, rows, fmt):
+        self.rows = rows
+        self.fmt = fmt
+        self.cancelled = False
+
+    def write(self, data):
+        if self.cancelled:
+            raise IOError('export cancelled')
+        if self.fmt == 'ndjson':
+            # COPY's text format doubles the backslashes of the json escapes,
+            # the only escape sequences a row_to_json line can contain
+            data = data.replace(b'\\\\', b'\\')
+        self.rows.put(data)
+
+
+def copy_chunks(engine, key, fmt):
+    """Yields the rows of COPY ... TO STDOUT, read from a thread on a connection of its own"""
+    rows = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+    writer = QueueWriter(rows, fmt)
+    done = object()
+    failure = []
+    connection = engine.raw_connection()
+
+    def run():
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert(copy_statement(key, fmt), writer)
+            cursor.close()
+            connection.rollback()
+        except Exception as error:
+            failure.append(error)
+        finally:
+            rows.put(done)
+
+    thread = threading.Thread(target=run, name='export-' + key, daemon=True)
+    thread.start()
+    buffer = Buffer()
+    finished = False
+    try:
+        while True:
+            data = rows.get()
+            if data is done:
+                finished = not failure
+                break
+            chunk = buffer.write(bytes(data))
+            if chunk:
+                yield chunk
+        if failure:
+            raise failure[0]
+        chunk = buffer.flush()
+        if chunk:
+            yield chunk
+    finally:
+        writer.cancelled = True
+        # unblock a COPY waiting on the full queue, then wait for it to give up
+        while thread.is_alive():
+            try:
+                rows.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if not finished:
+            # a COPY cut short leaves the connection mid protocol, it cannot go back to the pool
+            connection.invalidate()
+        else:
+            connection.close()
+
+
+def cursor_chunks(engine, key, fmt):
+    """Yields the rows of the table read through a server-side cursor, encoded here"""
+    table, columns, order = EXPORT_TABLES[key]
+    select = db.select([table.c[name] for name in columns]).order_by(*[table.c[name] for name in order])
+    connection = engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True).execute(select)
+        buffer = Buffer()
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator='\n')
+        if fmt == 'csv':
+            writer.writerow(columns)
+        while True:
+            batch = result.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+            if fmt == 'csv':
+                writer.writerows(batch)
+            else:
+                for row in batch:
+                    text.write(json.dumps(dict(zip(columns, row))))
+                    text.write('\n')
+            chunk = buffer.write(text.getvalue().encode('utf-8'))
+            text.seek(0)
+            text.truncate()
+            if chunk:
+                yield chunk
+        buffer.write(text.getvalue().encode('utf-8'))
+        chunk = buffer.flush()
+        if chunk:
+            yield chunk
+    finally:
+        connection.close()
+
+
+def gzipped(chunks):
+    """Compresses a stream of byte chunks into one gzip member, on the fly"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(key):
+    """Streams every row of the table of key as csv or ndjson"""
+    fmt = export_format()
+    # the body is produced after the view returns, on connections of its own: no session involved
+    engine = db.engine
+    if engine.dialect.name == 'postgresql':
+        chunks = copy_chunks(engine, key, fmt)
+    else:
+        chunks = cursor_chunks(engine, key, fmt)
+    headers = {
+        'Content-Disposition': 'attachment; filename="{}.{}"'.format(key, fmt),
+        'Vary': 'Accept-Encoding',
+    }
+    if 'gzip' in request.accept_encodings:
+        chunks = gzipped(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    # no Content-Length, so the body goes out with chunked transfer encoding
+    return Response(chunks, status=200, mimetype=FORMATS[fmt], headers=headers)
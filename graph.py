@@ -0,0 +1,318 @@
+import os
+import threading
+from array import array
+from collections import Counter, namedtuple
+from models import db, cast, get_versions
+
+GRAPH_MAX_DELTA = int(os.getenv('GRAPH_MAX_DELTA', 10000))
+GRAPH_BATCH_SIZE = int(os.getenv('GRAPH_BATCH_SIZE', 10000))
+
+
+'''
+    Adjacency
+    one side of the cast table in compressed sparse row form
+
+    the neighbours of the node at `index[id]` are `targets[offsets[i]:offsets[i + 1]]`,
+    two flat int arrays plus one dict, instead of a python object per edge
+'''
+
+
+class Adjacency(object):
+    """CSR adjacency from node ids to the ids of their neighbours"""
+    __slots__ = ('index', 'offsets', 'targets')
+
+    def __init__(self, index, offsets, targets):
+        self.index = index
+        self.offsets = offsets
+        self.targets = targets
+
+    def neighbours(self, node):
+        position = self.index.get(node)
+        if position is None:
+            return ()
+        return self.targets[self.offsets[position]:self.offsets[position + 1]]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def build_adjacency(sources, targets):
+    """Builds the Adjacency of the edges sources[i] -> targets[i]"""
+    index = dict((node, position) for position, node in enumerate(sorted(set(sources))))
+    offsets = array('i', bytes(array('i').itemsize * (len(index) + 1)))
+    for source in sources:
+        offsets[index[source] + 1] += 1
+    for position in range(len(index)):
+        offsets[position + 1] += offsets[position]
+    free = offsets[:-1]
+    neighbours = array('i', bytes(array('i').itemsize * len(sources)))
+    for source, target in zip(sources, targets):
+        position = index[source]
+        neighbours[free[position]] = target
+        free[position] += 1
+    return Adjacency(index, offsets, neighbours)
+
+
+'''
+    CastGraph
+    the actor <-> movie graph of the cast table, for co-star and degrees of separation queries
+
+    it should be built from the cast table once, then kept current by the writers of this
+        process through replace_movie / drop_actor (the delta overlay), without reading
+        the cast table again
+    it should compact the overlay into new arrays once it holds GRAPH_MAX_DELTA changes
+    it should rebuild from the cast table when the table's version moved on without it,
+        i.e. after a write made by another worker
+        the version is the counter and updated_at (see models.get_versions): the counter
+        starts over when the tables are dropped and seeded again
+    it should never block readers: every change swaps in a new immutable GraphState
+'''
+GraphState = namedtuple('GraphState', [
+    'version', 'movies_of', 'actors_of', 'added_movies', 'added_actors', 'removed', 'delta'
+])
+
+
+class CastGraph(object):
+    """In-memory index of who played in what, versioned on the cast table"""
+
+    def __init__(self, max_delta=GRAPH_MAX_DELTA):
+        self.max_delta = max_delta
+        self._state = None
+        self._lock = threading.Lock()
+        self._stats = {'rebuilds': 0, 'compactions': 0, 'deltas': 0}
+
+    def state(self):
+        """Returns the GraphState of the current cast table, rebuilding it if needed"""
+        version = get_versions('cast')['cast']
+        state = self._state
+        if state is None or state.version != version:
+            state = self.rebuild(version)
+        return state
+
+    def rebuild(self, version):
+        """Reads the whole cast table into new arrays"""
+        with self._lock:
+            state = self._state
+            if state is not None and state.version == version:
+                # another request rebuilt it while we waited for the lock
+                return state
+            # version is read before the rows: a write landing in between is
+            # included under the older version, and only costs another rebuild
+            actors = array('i')
+            movies = array('i')
+            rows = db.session.execute(
+                db.select([cast.c.actor_id, cast.c.movie_id])
+                .order_by(cast.c.actor_id, cast.c.movie_id)
+                .execution_options(stream_results=True)
+            )
+            while True:
+                batch = rows.fetchmany(GRAPH_BATCH_SIZE)
+                if not batch:
+                    break
+                for actor_id, movie_id in batch:
+                    actors.append(actor_id)
+                    movies.append(movie_id)
+            state = self._build(version, actors, movies)
+            self._stats['rebuilds'] += 1
+            return state
+
+    def _build(self, version, actors, movies):
+        state = GraphState(
+            version=version,
+            movies_of=build_adjacency(actors, movies),
+            actors_of=build_adjacency(movies, actors),
+            added_movies={}, added_actors={}, removed=frozenset(), delta=0
+        )
+        self._state = state
+        return state
+
+    def movies_of(self, state, actor_id):
+        """Returns the ids of the movies actor_id played in"""
+        movies = state.movies_of.neighbours(actor_id)
+        if state.removed:
+            movies = [movie_id for movie_id in movies if (actor_id, movie_id) not in state.removed]
+        added = state.added_movies.get(actor_id)
+        if added:
+            movies = list(movies) + list(added)
+        return movies
+
+    def actors_of(self, state, movie_id):
+        """Returns the ids of the actors cast in movie_id"""
+        actors = state.actors_of.neighbours(movie_id)
+        if state.removed:
+            actors = [actor_id for actor_id in actors if (actor_id, movie_id) not in state.removed]
+        added = state.added_actors.get(movie_id)
+        if added:
+            actors = list(actors) + list(added)
+        return actors
+
+    def costars(self, actor_id):
+        """Returns a Counter of the actors who shared a movie with actor_id, by shared movies"""
+        state = self.state()
+        costars = Counter()
+        for movie_id in self.movies_of(state, actor_id):
+            costars.update(self.actors_of(state, movie_id))
+        costars.pop(actor_id, None)
+        return costars
+
+    def path(self, source, target):
+        """Returns the shortest [actor, movie, actor, ..., actor] chain from source to target,
+        or None when they are not connected"""
+        state = self.state()
+        if source == target:
+            return [source]
+        # a bidirectional breadth first search over actors, always expanding by one full
+        # layer the frontier with fewer movies to read; each side expands a movie at most once
+        parents = ({source: None}, {target: None})
+        depths = ({source: 0}, {target: 0})
+        expanded = (set(), set())
+        frontiers = [[source], [target]]
+        while frontiers[0] and frontiers[1]:
+            side = 0 if self._work(state, frontiers[0]) <= self._work(state, frontiers[1]) else 1
+            mine, theirs = parents[side], parents[1 - side]
+            best = None
+            layer = []
+            for actor_id in frontiers[side]:
+                for movie_id in self.movies_of(state, actor_id):
+                    if movie_id in expanded[side]:
+                        continue
+                    expanded[side].add(movie_id)
+                    for costar_id in self.actors_of(state, movie_id):
+                        if costar_id in mine:
+                            continue
+                        mine[costar_id] = (actor_id, movie_id)
+                        depths[side][costar_id] = depths[side][actor_id] + 1
+                        layer.append(costar_id)
+                        if costar_id in theirs and (
+                                best is None or depths[1 - side][costar_id] < depths[1 - side][best]):
+                            best = costar_id
+            if best is not None:
+                return self._join(parents, best)
+            frontiers[side] = layer
+        return None
+
+    def _work(self, state, frontier):
+        """Counts the movies expanding frontier would read"""
+        index, offsets = state.movies_of.index, state.movies_of.offsets
+        work = 0
+        for actor_id in frontier:
+            position = index.get(actor_id)
+            if position is not None:
+                work += offsets[position + 1] - offsets[position]
+        return work
+
+    def _join(self, parents, meeting):
+        chain = [meeting]
+        node = meeting
+        while parents[0][node] is not None:
+            node, movie_id = parents[0][node]
+            chain[:0] = [node, movie_id]
+        node = meeting
+        while parents[1][node] is not None:
+            node, movie_id = parents[1][node]
+            chain.extend([movie_id, node])
+        return chain
+
+    def replace_movie(self, movie_id, actor_ids, version):
+        """Records that the committed cast of movie_id is now actor_ids, as of cast `version`"""
+        with self._lock:
+            state = self._state
+            if state is None or state.version[0] != version[0] - 1:
+                # never built, or another worker wrote in between: the next read rebuilds
+                return
+            current = set(self.actors_of(state, movie_id))
+            wanted = set(actor_ids)
+            removed = set(state.removed)
+            added_movies = dict(state.added_movies)
+            added_actors = dict(state.added_actors)
+            for actor_id in current - wanted:
+                added = added_actors.get(movie_id, frozenset())
+                if actor_id in added:
+                    added_actors[movie_id] = added - {actor_id}
+                    added_movies[actor_id] = added_movies[actor_id] - {movie_id}
+                else:
+                    removed.add((actor_id, movie_id))
+            for actor_id in wanted - current:
+                if (actor_id, movie_id) in removed:
+                    removed.discard((actor_id, movie_id))
+                else:
+                    added_actors[movie_id] = added_actors.get(movie_id, frozenset()) | {actor_id}
+                    added_movies[actor_id] = added_movies.get(actor_id, frozenset()) | {movie_id}
+            self._apply(state._replace(
+                version=version,
+                added_movies=added_movies,
+                added_actors=added_actors,
+                removed=frozenset(removed),
+                delta=state.delta + len(current ^ wanted)
+            ))
+
+    def drop_actor(self, actor_id, version):
+        """Records that actor_id and its cast rows were deleted, as of cast `version`"""
+        with self._lock:
+            state = self._state
+            if state is None or state.version[0] != version[0] - 1:
+                return
+            movie_ids = self.movies_of(state, actor_id)
+            removed = set(state.removed)
+            removed.update((actor_id, movie_id) for movie_id in state.movies_of.neighbours(actor_id))
+            added_movies = dict(state.added_movies)
+            added_actors = dict(state.added_actors)
+            for movie_id in added_movies.pop(actor_id, ()):
+                added_actors[movie_id] = added_actors[movie_id] - {actor_id}
+            self._apply(state._replace(
+                version=version,
+                added_movies=added_movies,
+                added_actors=added_actors,
+                removed=frozenset(removed),
+                delta=state.delta + len(movie_ids)
+            ))
+
+    def _apply(self, state):
+        self._stats['deltas'] += 1
+        if state.delta < self.max_delta:
+            self._state = state
+            return
+        # fold the overlay into new arrays, without going back to the database
+        actors = array('i')
+        movies = array('i')
+        for movie_id in set(state.actors_of.index) | set(state.added_actors):
+            for actor_id in self.actors_of(state, movie_id):
+                actors.append(actor_id)
+                movies.append(movie_id)
+        self._build(state.version, actors, movies)
+        self._stats['compactions'] += 1
+
+    def reset(self):
+        """Forgets the index and its counters, the next read rebuilds it"""
+        with self._lock:
+            self._state = None
+            self._stats = dict((name, 0) for name in self._stats)
+
+    def stats(self):
+        """Returns the size of the index and its maintenance counters"""
+        state = self._state
+        stats = dict(self._stats)
+        if state is not None:
+            stats.update({
+                'version': state.version[0],
+                'actors': len(state.movies_of.index),
+                'movies': len(state.actors_of.index),
+                'edges': len(state.movies_of),
+                'delta': state.delta
+            })
+        return stats
+
+
+cast_graph = CastGraph()
+
+
+def cast_changed(movie_id=None, actor_id=None):
+    """Brings cast_graph up to date after a committed write to the cast of movie_id,
+    or the deletion of actor_id"""
+    version = get_versions('cast')['cast']
+    if actor_id is not None:
+        cast_graph.drop_actor(actor_id, version)
+    else:
+        actor_ids = [row[0] for row in db.session.execute(
+            db.select([cast.c.actor_id]).where(cast.c.movie_id == movie_id))]
+        cast_graph.replace_movie(movie_id, actor_ids, version)
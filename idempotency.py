@@ -0,0 +1,281 @@
+import os
+import time
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from collections import namedtuple
+from functools import wraps
+from flask import request, abort, make_response, Response
+from sqlalchemy.exc import IntegrityError
+from models import db, idempotency_keys, after_commit, after_rollback
+from cache import LRUCache
+
+IDEMPOTENCY_BACKEND = os.getenv('IDEMPOTENCY_BACKEND', 'database').lower()
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_SIZE = int(os.getenv('IDEMPOTENCY_SIZE', 10000))
+IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 10))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+IDEMPOTENCY_SWEEP_INTERVAL = int(os.getenv('IDEMPOTENCY_SWEEP_INTERVAL', 60))
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+
+
+# a response kept for replay, with the fingerprint of the request that produced it
+StoredResponse = namedtuple('StoredResponse', ['fingerprint', 'status', 'content_type', 'body'])
+
+
+class KeyInFlight(Exception):
+    """Another request still holds the idempotency key"""
+
+
+'''
+    idempotency backends
+    a backend maps idempotency keys to the StoredResponse of the first request sent with them
+
+    claim(key, fingerprint, wait) returns the StoredResponse of a completed request, or None once
+        the caller holds the key; a caller finding the key held waits up to `wait` seconds
+        for its holder to complete or release it, then raises KeyInFlight
+    complete(key, stored) keeps the response for IDEMPOTENCY_TTL seconds and wakes the waiters
+    release(key) gives the key up without a response, so a retry runs the request again
+    sweep() deletes the expired entries and returns how many
+
+    MemoryIdempotencyBackend keeps responses in an LRUCache of this worker process
+    DatabaseIdempotencyBackend keeps them in the idempotency_keys table, shared by every worker,
+        a key being held by inserting its row: the primary key lets only one request in
+'''
+
+
+class MemoryIdempotencyBackend(object):
+    """Idempotency backend local to this process, bounded in size and age"""
+
+    def __init__(self, maxsize=10000, ttl=86400):
+        self.responses = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key, fingerprint, wait):
+        deadline = time.monotonic() + wait
+        while True:
+            with self._lock:
+                stored = self.responses.get(key)
+                if stored is not None:
+                    return stored
+                event = self._pending.get(key)
+                if event is None:
+                    self._pending[key] = threading.Event()
+                    return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not event.wait(remaining):
+                raise KeyInFlight(key)
+
+    def complete(self, key, stored):
+        with self._lock:
+            self.responses.set(key, stored)
+            event = self._pending.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def release(self, key):
+        with self._lock:
+            event = self._pending.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def sweep(self):
+        return self.responses.purge_expired()
+
+
+class DatabaseIdempotencyBackend(object):
+    """Idempotency backend shared by every worker through the idempotency_keys table"""
+
+    def __init__(self, ttl=86400, lock_timeout=60, poll_interval=0.05):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+    def claim(self, key, fingerprint, wait):
+        deadline = time.monotonic() + wait
+        while True:
+            now = datetime.utcnow()
+            # each step runs on its own connection and transaction, apart from the request's session
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(idempotency_keys.insert().values(
+                        key=key, fingerprint=fingerprint,
+                        expires_at=now + timedelta(seconds=self.lock_timeout)))
+                return None
+            except IntegrityError:
+                pass
+            with db.engine.begin() as connection:
+                row = connection.execute(
+                    db.select([idempotency_keys]).where(idempotency_keys.c.key == key)).first()
+                if row is not None and row.expires_at <= now:
+                    # an expired response, or a request that died holding the key
+                    connection.execute(idempotency_keys.delete().where(idempotency_keys.c.key == key)
+                                       .where(idempotency_keys.c.expires_at <= now))
+                    continue
+            if row is None:
+                continue
+            if row.status is not None:
+                return StoredResponse(row.fingerprint, row.status, row.content_type, bytes(row.body))
+            if time.monotonic() >= deadline:
+                raise KeyInFlight(key)
+            time.sleep(self.poll_interval)
+
+    def complete(self, key, stored):
+        with db.engine.begin() as connection:
+            connection.execute(idempotency_keys.update().where(idempotency_keys.c.key == key).values(
+                status=stored.status, content_type=stored.content_type, body=stored.body,
+                expires_at=datetime.utcnow() + timedelta(seconds=self.ttl)))
+
+    def release(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(idempotency_keys.delete().where(idempotency_keys.c.key == key)
+                               .where(idempotency_keys.c.status.is_(None)))
+
+    def sweep(self):
+        with db.engine.begin() as connection:
+            return connection.execute(
+                idempotency_keys.delete().where(idempotency_keys.c.expires_at <= datetime.utcnow())).rowcount
+
+
+'''
+    IdempotencyStore
+    replays the response of a POST request when a client retries it with the same Idempotency-Key
+
+    it should scope keys to the route and the token's subject, so clients never share a key
+    it should fingerprint the request, and refuse a key reused for a different request
+    it should sweep expired entries from the backend at most once every IDEMPOTENCY_SWEEP_INTERVAL seconds
+    it should count claims, replays, conflicts and swept entries
+'''
+
+
+class IdempotencyStore(object):
+    """Front of the pluggable idempotency backend"""
+
+    def __init__(self, backend, wait=10, sweep_interval=60):
+        self.backend = backend
+        self.wait = wait
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0
+        self._stats = {'claims': 0, 'replays': 0, 'in_flight': 0, 'mismatches': 0, 'swept': 0}
+        self._lock = threading.Lock()
+
+    def key(self, endpoint, subject, key):
+        raw = '\n'.join([endpoint, subject, key])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def fingerprint(self):
+        """Hashes the method, path, query string and body of the current request"""
+        digest = hashlib.sha256('{} {}\n'.format(request.method, request.full_path).encode('utf-8'))
+        digest.update(request.get_data())
+        return digest.hexdigest()
+
+    def claim(self, key, fingerprint):
+        self.maybe_sweep()
+        try:
+            stored = self.backend.claim(key, fingerprint, self.wait)
+        except KeyInFlight:
+            self.count('in_flight')
+            raise
+        self.count('claims' if stored is None else 'replays')
+        return stored
+
+    def maybe_sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + self.sweep_interval
+        self.count('swept', self.backend.sweep())
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = dict((name, 0) for name in self._stats)
+            self._next_sweep = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def build_backend(name, maxsize=10000, ttl=86400, lock_timeout=60):
+    """Returns the idempotency backend selected by IDEMPOTENCY_BACKEND"""
+    if name == 'memory':
+        return MemoryIdempotencyBackend(maxsize=maxsize, ttl=ttl)
+    if name == 'database':
+        return DatabaseIdempotencyBackend(ttl=ttl, lock_timeout=lock_timeout)
+    return None
+
+
+idempotency_store = IdempotencyStore(
+    build_backend(
+        IDEMPOTENCY_BACKEND,
+        maxsize=IDEMPOTENCY_SIZE,
+        ttl=IDEMPOTENCY_TTL,
+        lock_timeout=IDEMPOTENCY_LOCK_TIMEOUT
+    ),
+    wait=IDEMPOTENCY_WAIT,
+    sweep_interval=IDEMPOTENCY_SWEEP_INTERVAL
+)
+
+
+'''
+    @idempotent decorator method
+
+    it should sit below @requires_auth, which passes the decoded payload as first argument
+    it should call the view as usual when the request has no Idempotency-Key header,
+        or when no backend is configured (IDEMPOTENCY_BACKEND=none)
+    it should replay the stored response of a repeated key without calling the view,
+        marked with an Idempotent-Replayed: true header
+    it should make a request repeating a key still in flight wait for the first one,
+        and respond with a 409 error if it is still running after IDEMPOTENCY_WAIT seconds
+    it should respond with a 422 error when the key was used for a different request
+    it should only keep 2xx responses; any other outcome releases the key for a retry
+        inside an atomic POST /batch the response is kept once the batch commits, and the
+        key released if it rolls back
+'''
+
+
+def idempotent(f):
+    """Makes a POST view safe to retry with an Idempotency-Key header"""
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        header = request.headers.get('Idempotency-Key')
+        if header is None or idempotency_store.backend is None:
+            return f(payload, *args, **kwargs)
+        if not header or len(header) > IDEMPOTENCY_MAX_KEY_LENGTH:
+            abort(400, 'Idempotency-Key must be 1 to {} characters'.format(IDEMPOTENCY_MAX_KEY_LENGTH))
+
+        key = idempotency_store.key(request.endpoint, str(payload.get('sub', '')), header)
+        fingerprint = idempotency_store.fingerprint()
+        try:
+            stored = idempotency_store.claim(key, fingerprint)
+        except KeyInFlight:
+            abort(409, 'A request with this Idempotency-Key is still in progress')
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                idempotency_store.count('mismatches')
+                abort(422, 'Idempotency-Key was already used for a different request')
+            response = Response(stored.body, status=stored.status, content_type=stored.content_type)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except Exception:
+            idempotency_store.backend.release(key)
+            raise
+        if 200 <= response.status_code < 300 and not response.is_streamed:
+            # the response is only kept once its writes are committed: inside an atomic
+            # batch that rolls back, the key is released instead
+            after_commit(idempotency_store.backend.complete, key, StoredResponse(
+                fingerprint, response.status_code, response.content_type, response.get_data()))
+            after_rollback(idempotency_store.backend.release, key)
+        else:
+            idempotency_store.backend.release(key)
+        return response
+    return wrapper
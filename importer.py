@@ -0,0 +1,234 @@
+import os
+import io
+import csv
+import json
+import time
+import click
+from flask import request, abort
+from flask.cli import with_appcontext
+from models import db, cast, bump_version, commit, after_commit, Actor, Movie
+from bulk import CREATE_FIELDS, existing_ids
+from cache import response_cache
+
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 5000))
+IMPORT_MAX_REJECTIONS_LISTED = 100
+
+FORMATS = ('csv', 'ndjson')
+CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+}
+
+
+'''
+    catalog import
+
+    rows are read from a csv file (with a header line) or from newline delimited json, one
+    object per line, and loaded IMPORT_CHUNK_SIZE rows at a time: the source is parsed as it
+    is read, so memory depends on the chunk size and not on the size of the catalog
+
+    movies rows need title and year, actors rows name, age and gender, cast rows movie_id
+    and actor_id; a line that cannot be used is skipped and reported as rejected, with its
+    line number and reason, and the rest of the import goes on
+
+    postgres loads every chunk with COPY ... FROM STDIN, elsewhere with one executemany INSERT
+    the cast ids of a chunk are checked with one IN query per table, and the links are
+    inserted skipping the ones that already exist
+    everything is committed at the end, in one transaction, with one version bump
+'''
+IMPORT_FIELDS = {
+    'movies': CREATE_FIELDS['movies'],
+    'actors': CREATE_FIELDS['actors'],
+    'cast': (('movie_id', int), ('actor_id', int)),
+}
+
+
+def detect_format(fmt=None, content_type=None, filename=None):
+    """Returns 'csv' or 'ndjson' from an explicit format, a content type or a file name"""
+    if fmt:
+        return fmt if fmt in FORMATS else None
+    if content_type:
+        return CONTENT_TYPES.get(content_type.split(';')[0].strip().lower())
+    if filename:
+        extension = os.path.splitext(filename)[1].lower()
+        return {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}.get(extension)
+    return None
+
+
+def read_records(stream, fmt):
+    """Yields (line number, record or None, reason) for each line of a binary stream"""
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            if None in record or None in record.values():
+                yield reader.line_num, None, 'does not have {} columns'.format(len(reader.fieldnames))
+            else:
+                yield reader.line_num, record, None
+        return
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, None, 'is not valid json'
+            continue
+        if isinstance(record, dict):
+            yield line_number, record, None
+        else:
+            yield line_number, None, 'is not a json object'
+
+
+def coerce(kind, record):
+    """Returns (row, reason): the record's fields with their types, or why it cannot be used"""
+    row = {}
+    for name, field_type in IMPORT_FIELDS[kind]:
+        value = record.get(name)
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == '':
+            return None, '{} is required'.format(name)
+        if field_type is int:
+            if isinstance(value, str):
+                try:
+                    value = int(value)
+                except ValueError:
+                    return None, '{} must be an integer'.format(name)
+            elif not isinstance(value, int) or isinstance(value, bool):
+                return None, '{} must be an integer'.format(name)
+        elif not isinstance(value, str):
+            return None, '{} must be a string'.format(name)
+        row[name] = value
+    return row, None
+
+
+def copy_rows(table_name, columns, rows):
+    """Loads rows, tuples of the values of columns, into a postgres table with COPY ... FROM STDIN"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table_name, ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+def load_chunk(kind, chunk, reject):
+    """Writes one chunk of (line number, row) pairs; returns how many rows were written"""
+    if kind == 'cast':
+        return load_cast(chunk, reject)
+    table = (Movie if kind == 'movies' else Actor).__table__
+    rows = [row for line, row in chunk]
+    if db.engine.dialect.name == 'postgresql':
+        columns = [name for name, field_type in IMPORT_FIELDS[kind]]
+        copy_rows(table.name, columns, ([row[name] for name in columns] for row in rows))
+    else:
+        db.session.execute(table.insert(), rows)
+    return len(rows)
+
+
+def load_cast(chunk, reject):
+    """Links the pairs of the chunk whose movie and actor exist; returns how many links are new"""
+    movies = existing_ids(Movie, set(row['movie_id'] for line, row in chunk))
+    actors = existing_ids(Actor, set(row['actor_id'] for line, row in chunk))
+    links = {}
+    for line, row in chunk:
+        if row['movie_id'] not in movies:
+            reject(line, 'movie {} does not exist'.format(row['movie_id']))
+        elif row['actor_id'] not in actors:
+            reject(line, 'actor {} does not exist'.format(row['actor_id']))
+        else:
+            links[(row['movie_id'], row['actor_id'])] = row
+    if not links:
+        return 0
+    links = list(links.values())
+    if db.engine.dialect.name == 'postgresql':
+        # COPY cannot skip existing links, so it fills a scratch table merged in one statement
+        db.session.execute('CREATE TEMP TABLE IF NOT EXISTS cast_import '
+                           '(movie_id integer, actor_id integer) ON COMMIT DROP')
+        db.session.execute('TRUNCATE cast_import')
+        copy_rows('cast_import', ['movie_id', 'actor_id'], ((row['movie_id'], row['actor_id']) for row in links))
+        return db.session.execute(
+            'INSERT INTO "cast" (movie_id, actor_id) SELECT movie_id, actor_id FROM cast_import '
+            'ON CONFLICT DO NOTHING').rowcount
+    return db.session.execute(cast.insert().prefix_with('OR IGNORE'), links).rowcount
+
+
+def import_stream(kind, stream, fmt):
+    """Imports every line of a binary stream into kind's table; returns the import report"""
+    started = time.perf_counter()
+    report = {'read': 0, 'imported': 0, 'rejected': 0, 'rejections': []}
+
+    def reject(line, reason):
+        report['rejected'] += 1
+        if len(report['rejections']) < IMPORT_MAX_REJECTIONS_LISTED:
+            report['rejections'].append({'line': line, 'reason': reason})
+
+    chunk = []
+    for line, record, reason in read_records(stream, fmt):
+        report['read'] += 1
+        if record is not None:
+            row, reason = coerce(kind, record)
+        if reason is not None:
+            reject(line, reason)
+            continue
+        chunk.append((line, row))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            report['imported'] += load_chunk(kind, chunk, reject)
+            chunk = []
+    if chunk:
+        report['imported'] += load_chunk(kind, chunk, reject)
+
+    if report['imported']:
+        bump_version(kind)
+    commit()
+    if report['imported']:
+        after_commit(response_cache.invalidate, kind)
+
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    report['rows_per_second'] = round(report['imported'] / report['seconds']) if report['seconds'] else 0
+    return report
+
+
+def request_format():
+    """Returns the format of the request body from ?format= or its Content-Type, aborts with 400"""
+    fmt = detect_format(request.args.get('format'), request.content_type)
+    if fmt is None:
+        abort(400, 'send text/csv or application/x-ndjson, or set ?format=csv|ndjson')
+    return fmt
+
+
+'''
+    flask import-catalog <movies|actors|cast> <path> [--format csv|ndjson]
+        imports a csv or ndjson file (- reads stdin), the format being guessed from the extension
+        prints the rows per second and the rejected lines
+'''
+
+
+@click.command('import-catalog')
+@click.argument('kind', type=click.Choice(sorted(IMPORT_FIELDS)))
+@click.argument('source', type=click.File('rb'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+              help='Format of the file, guessed from its extension by default.')
+@with_appcontext
+def import_command(kind, source, fmt):
+    """Imports movies, actors or cast links from a csv or ndjson file"""
+    fmt = detect_format(fmt, filename=source.name)
+    if fmt is None:
+        raise click.UsageError('cannot guess the format of {}, use --format'.format(source.name))
+    try:
+        report = import_stream(kind, source, fmt)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.close()
+    click.echo('imported {} of {} {} rows in {:.2f}s ({} rows/s), {} rejected'.format(
+        report['imported'], report['read'], kind, report['seconds'],
+        report['rows_per_second'], report['rejected']))
+    for rejection in report['rejections']:
+        click.echo('  line {}: {}'.format(rejection['line'], rejection['reason']), err=True)
@@ -0,0 +1,220 @@
+import json
+import random
+import threading
+import time
+from urllib.request import urlopen
+from jose import jwk
+from jose.exceptions import JWKError
+
+
+'''
+    JWKSCache
+    a process-wide cache of the Auth0 JSON Web Key Set (/.well-known/jwks.json)
+
+    it should only go to the network when the cached key set is older than `ttl` seconds
+        or when a token presents a `kid` that is not in the cached key set
+    it should collapse concurrent refetches into a single request to the IdP,
+        whether it succeeds or fails
+    it should count cache hits, misses and refreshes
+    it should bump `key_generation` whenever the published keys change (rotation)
+    it should build a ready-to-verify key object per kid once per key set,
+        so the request path never re-parses the modulus and exponent
+    it can run a background refresher that renews the key set before the TTL expires
+        while it runs, requests keep using the last good keys for up to
+        `stale_window` seconds past the TTL instead of refetching inline
+        failed refreshes are retried with exponential backoff and jitter
+    it should keep serving the last good keys when a refetch made on the request path fails,
+        and raise JWKSUnavailable when it has never fetched a key set at all
+        without a live refresher, the stale keys are served for `min_refetch_interval`
+        seconds after a failed refetch instead of every request waiting on the IdP again
+    it should never serve keys older than `ttl` + `stale_window` seconds: past that it
+        raises JWKSUnavailable until a refetch succeeds, revoked keys can't stay trusted
+'''
+
+
+class JWKSUnavailable(Exception):
+    """Raised when the IdP can't be reached and no key set recent enough is cached"""
+
+
+class JWKSCache(object):
+    """Caches the signing keys published by the IdP, indexed by key id (kid)"""
+
+    def __init__(self, url, ttl=600, min_refetch_interval=5, timeout=5, clock=time.monotonic,
+                 algorithm='RS256', stale_window=900, min_backoff=1, max_backoff=300):
+        self.url = url
+        self.ttl = ttl
+        self.stale_window = stale_window
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # unknown kids trigger a refetch, but never more often than this,
+        # so a flood of tokens with made-up kids can't hammer the IdP
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.clock = clock
+        self.algorithm = algorithm
+        self.version = 0
+        self.key_generation = 0
+        self._keys = {}
+        # kid -> (jwk dict, prepared key), swapped as a whole on every refresh
+        self._index = {}
+        self._fetched_at = None
+        self._failed_at = None
+        self._refresh_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'stale_hits': 0, 'refresh_errors': 0}
+        self._refresher = None
+        self._stop = threading.Event()
+        self.last_error = None
+
+    def fetch(self):
+        """Downloads and parses the key set from the IdP"""
+        jsonurl = urlopen(self.url, timeout=self.timeout)
+        return json.loads(jsonurl.read())
+
+    def prepare(self, key):
+        """Builds the key object used for signature checks, None if unsupported"""
+        try:
+            return jwk.construct(key, key.get('alg', self.algorithm))
+        except JWKError:
+            return None
+
+    def refresh(self, seen_version=None):
+        """Refetches the key set, unless another thread already did (or just failed to)
+        while we waited"""
+        with self._refresh_lock:
+            if seen_version is not None and self.version != seen_version:
+                return False
+            failed_at = self._failed_at
+            if (seen_version is not None and failed_at is not None
+                    and self.clock() - failed_at < self.min_refetch_interval):
+                # the refetch we waited on just failed, the IdP won't answer us any better
+                return False
+            jwks = self.fetch()
+            keys = {key['kid']: key for key in jwks.get('keys', []) if 'kid' in key}
+            if keys != self._keys:
+                self.key_generation += 1
+            index = {}
+            for kid, key in keys.items():
+                previous = self._index.get(kid)
+                if previous is not None and previous[0] == key:
+                    index[kid] = previous
+                else:
+                    index[kid] = (key, self.prepare(key))
+            self._index = index
+            self._keys = keys
+            self._fetched_at = self.clock()
+            self._failed_at = None
+            self.version += 1
+            self._count('refreshes')
+            return True
+
+    def get_key(self, kid):
+        """Returns the JWK for `kid`, or None if the IdP doesn't publish it"""
+        entry = self._lookup(kid)
+        return entry[0] if entry else None
+
+    def get_signing_key(self, kid):
+        """Returns the prepared key for `kid`, or None if it can't be used"""
+        entry = self._lookup(kid)
+        return entry[1] if entry else None
+
+    def _lookup(self, kid):
+        index, fetched_at, version = self._index, self._fetched_at, self.version
+        now = self.clock()
+        age = None if fetched_at is None else now - fetched_at
+        if age is not None and kid in index:
+            if age < self.ttl:
+                self._count('hits')
+                return index[kid]
+            if age < self.ttl + self.stale_window:
+                if self.refreshing:
+                    # the refresher is already renewing the keys, don't block on it
+                    self._count('stale_hits')
+                    return index[kid]
+                failed_at = self._failed_at
+                if failed_at is not None and now - failed_at < self.min_refetch_interval:
+                    # the IdP just failed to answer, don't make this request wait on it too
+                    self._count('stale_hits')
+                    return index[kid]
+
+        self._count('misses')
+        if age is None or age >= self.ttl or age >= self.min_refetch_interval:
+            try:
+                self.refresh(seen_version=version)
+            except Exception as error:
+                self._refresh_failed(error)
+            if self.expired():
+                raise JWKSUnavailable(self.last_error)
+        return self._index.get(kid)
+
+    def expired(self):
+        """True when there are no keys recent enough to be served, even stale"""
+        fetched_at = self._fetched_at
+        return fetched_at is None or self.clock() - fetched_at >= self.ttl + self.stale_window
+
+    def _refresh_failed(self, error):
+        """Records a failed refetch, the last good keys stay in place"""
+        self.last_error = repr(error)
+        self._failed_at = self.clock()
+        self._count('refresh_errors')
+        print('🚩 jwks refresh failed:', self.last_error)
+
+    @property
+    def refreshing(self):
+        """True while the background refresher thread is running"""
+        return self._refresher is not None and self._refresher.is_alive()
+
+    def start_refresher(self, refresh_ahead=None):
+        """Starts renewing the key set in a daemon thread, once per process"""
+        if self.refreshing:
+            return False
+        if refresh_ahead is None:
+            refresh_ahead = self.ttl * 0.2
+        self._stop.clear()
+        self._refresher = threading.Thread(
+            target=self._refresh_loop, args=(refresh_ahead,), name='jwks-refresher')
+        self._refresher.daemon = True
+        self._refresher.start()
+        return True
+
+    def stop_refresher(self):
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+        self._refresher = None
+
+    def _refresh_loop(self, refresh_ahead):
+        failures = 0
+        while not self._stop.is_set():
+            if failures:
+                backoff = min(self.max_backoff, self.min_backoff * 2 ** (failures - 1))
+                delay = backoff * random.uniform(0.5, 1.5)
+            elif self._fetched_at is None:
+                delay = 0
+            else:
+                delay = self._fetched_at + self.ttl - refresh_ahead - self.clock()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            try:
+                self.refresh()
+                failures = 0
+                self.last_error = None
+            except Exception as error:
+                # keep serving the last good keys, within the stale window
+                failures += 1
+                self._refresh_failed(error)
+
+    def stats(self):
+        """Returns a snapshot of the cache counters"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['keys'] = len(self._keys)
+        stats['version'] = self.version
+        stats['key_generation'] = self.key_generation
+        stats['refreshing'] = self.refreshing
+        stats['last_error'] = self.last_error
+        return stats
+
+    def _count(self, counter):
+        with self._stats_lock:
+            self._stats[counter] += 1
@@ -0,0 +1,373 @@
+import os
+import json
+import base64
+import binascii
+import operator
+from flask import request, abort, Response, stream_with_context
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import load_only, selectinload
+from models import db, get_versions, in_atomic_batch
+from rendering import stream_envelope, envelope_response, row_fragments
+
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 500))
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 1000))
+
+
+'''
+    keyset pagination helpers shared by GET /movies and GET /actors
+
+    pages are ordered by id and the cursor carries the last id of the previous page,
+    so every page is a `WHERE id > :last_id ORDER BY id LIMIT :n` index range scan
+    and deep pages cost the same as the first one (no OFFSET)
+
+    ?sort=year (or -year) orders by that column, then id, and the cursor carries both
+    ?stream=true skips pagination and streams every row instead, see stream_response
+    items are selected as plain columns and run as Core statements, the rows going
+        straight to dicts without ORM instances, identity map or format() (see fetch);
+        ?fields=id,title narrows the SELECT to those columns
+    ?include=actors (movies) / ?include=movies (actors) nests each item's cast, loaded
+        with one extra `WHERE id IN (...)` query per page (or stream batch) whatever its size
+'''
+
+
+def encode_cursor(last_id, sort='id', value=None):
+    """Returns the opaque cursor pointing after the row (value, last_id) in sort order"""
+    data = {'id': last_id}
+    if sort != 'id':
+        data['sort'] = sort
+        data['value'] = value
+    data = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor, sort='id'):
+    """Returns (last_id, value) carried by a cursor, aborts with 400 if it was tampered with
+    or was issued for another sort order"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        last_id = data['id']
+        value = data.get('value')
+        cursor_sort = data.get('sort', 'id')
+    except (ValueError, TypeError, KeyError, AttributeError, binascii.Error):
+        abort(400, 'Invalid cursor')
+    if not isinstance(last_id, int) or cursor_sort != sort:
+        abort(400, 'Invalid cursor')
+    if value is not None and not isinstance(value, (int, str)):
+        abort(400, 'Invalid cursor')
+    return last_id, value
+
+
+def parse_limit():
+    """Reads ?limit= from the request, between 1 and MAX_PAGE_SIZE"""
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        abort(400, 'limit must be an integer')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        abort(400, 'limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    return limit
+
+
+def page_query(query, model, limit, cursor=None, sort='id'):
+    """Returns query narrowed to the page after cursor, plus one row"""
+    if cursor:
+        query = after_cursor(query, model, sort, cursor)
+    # one extra row tells us whether there is a next page, without a COUNT(*)
+    return ordered(query, model, sort).limit(limit + 1)
+
+
+def paginate(query, model, limit, cursor=None, sort='id'):
+    """Returns (rows, next_cursor) for the page of query after cursor"""
+    rows = fetch(page_query(query, model, limit, cursor, sort))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.id, sort, getattr(last, sort.lstrip('-')))
+    return rows, next_cursor
+
+
+def wants_all():
+    """True when the caller explicitly asked for the unpaginated list with ?all=true"""
+    return request.args.get('all', '').lower() in ('1', 'true', 'yes')
+
+
+def wants_stream():
+    """True when the caller asked for a streamed export with ?stream=true"""
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def parse_fields(model):
+    """Reads ?fields= into column names of model, None when every column is wanted"""
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    names = []
+    for name in fields.split(','):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    columns = model.__table__.columns
+    unknown = [name for name in names if name not in columns]
+    if not names or unknown:
+        abort(400, 'fields must be a comma separated list of: {}'.format(
+            ', '.join(columns.keys())))
+    return names
+
+
+INCLUDES = {
+    'movies': 'actors',
+    'actors': 'movies',
+}
+
+
+def parse_include(key):
+    """Reads ?include= from the request, None when no relationship is wanted"""
+    include = request.args.get('include')
+    if include is None:
+        return None
+    if include != INCLUDES[key]:
+        abort(400, 'include must be: {}'.format(INCLUDES[key]))
+    return include
+
+
+def projection(model, fields, sort='id', include=None):
+    """Returns (query, serialize) for the requested fields and relationship of model"""
+    if include is not None:
+        return included(model, fields, sort, include)
+    if fields is None:
+        # format() returns exactly the table's columns, so the rows serialize the same
+        fields = model.__table__.columns.keys()
+    names = list(fields)
+    for name in ('id', sort.lstrip('-')):
+        if name not in names:
+            # pagination needs the id and the sort value, they are selected
+            # but left out of the response
+            names.append(name)
+    query = model.query.with_entities(*[getattr(model, name) for name in names])
+    return query, lambda row: dict(zip(fields, row))
+
+
+def included(model, fields, sort, include):
+    """Returns (query, serialize) for model items nesting their `include` relationship"""
+    # selectin loads the relationship of a whole page in one IN query,
+    # where touching it on each instance would cost one query per row
+    options = [selectinload(getattr(model, include))]
+    if fields is not None:
+        # relationships need ORM instances, load_only keeps the SELECT sparse
+        options.append(load_only(*sorted(set(fields + ['id', sort.lstrip('-')]))))
+
+    def serialize(row):
+        if fields is None:
+            item = row.format()
+        else:
+            item = dict((name, getattr(row, name)) for name in fields)
+        related = sorted(getattr(row, include), key=lambda other: other.id)
+        item[include] = [other.format() for other in related]
+        return item
+    return model.query.options(*options), serialize
+
+
+'''
+    filters and sort
+
+    FILTERS maps the query parameters of each list to (column, operator, type)
+        eq: column = value
+        min / max: inclusive bounds of a range
+        prefix: column starts with value (case sensitive)
+    every filtered column is indexed, see the list filter indexes migration
+    SORTS whitelists the columns ?sort= accepts, a leading - sorts in descending order
+        rows with no value in the sort column come last in both directions
+'''
+FILTERS = {
+    'movies': {
+        'year': ('year', 'eq', int),
+        'year_min': ('year', 'min', int),
+        'year_max': ('year', 'max', int),
+        'title': ('title', 'prefix', str),
+    },
+    'actors': {
+        'gender': ('gender', 'eq', str),
+        'age': ('age', 'eq', int),
+        'age_min': ('age', 'min', int),
+        'age_max': ('age', 'max', int),
+        'name': ('name', 'prefix', str),
+    },
+}
+
+SORTS = {
+    'movies': ('id', 'title', 'year'),
+    'actors': ('id', 'name', 'age'),
+}
+
+
+def prefix_filter(column, prefix):
+    """Returns an index friendly `column starts with prefix` condition"""
+    if db.engine.dialect.name == 'postgresql':
+        # served by the text_pattern_ops index
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return column.like(escaped + '%', escape='\\')
+    # sqlite's LIKE ignores case and skips the index, a range on it does not
+    last = ord(prefix[-1])
+    if last == 0x10ffff:
+        return column >= prefix
+    return and_(column >= prefix, column < prefix[:-1] + chr(last + 1))
+
+
+def apply_filters(query, model, key):
+    """Narrows query to the filters given in the request, aborts with 400 on bad values"""
+    for param, (name, op, kind) in FILTERS[key].items():
+        value = request.args.get(param)
+        if value is None or value == '':
+            continue
+        try:
+            value = kind(value)
+        except ValueError:
+            abort(400, '{} must be an integer'.format(param))
+        column = getattr(model, name)
+        if op == 'eq':
+            query = query.filter(column == value)
+        elif op == 'min':
+            query = query.filter(column >= value)
+        elif op == 'max':
+            query = query.filter(column <= value)
+        else:
+            query = query.filter(prefix_filter(column, value))
+    return query
+
+
+def parse_sort(key):
+    """Reads ?sort= from the request, aborts with 400 unless the column is whitelisted"""
+    sort = request.args.get('sort', 'id')
+    if sort.lstrip('-') not in SORTS[key] or sort.startswith('--'):
+        abort(400, 'sort must be one of: {}'.format(
+            ', '.join(SORTS[key] + tuple('-' + name for name in SORTS[key]))))
+    return sort
+
+
+def ordered(query, model, sort='id'):
+    """Orders query by the sort column, then by id to break ties"""
+    column = getattr(model, sort.lstrip('-'))
+    descending = sort.startswith('-')
+    order = [model.id.desc() if descending else model.id.asc()]
+    if column is not model.id:
+        order.insert(0, column.desc().nullslast() if descending else column.asc().nullslast())
+    return query.order_by(*order)
+
+
+def after_cursor(query, model, sort, cursor):
+    """Narrows query to the rows after cursor in sort order"""
+    last_id, value = decode_cursor(cursor, sort)
+    column = getattr(model, sort.lstrip('-'))
+    beyond = operator.lt if sort.startswith('-') else operator.gt
+    if column is model.id:
+        return query.filter(beyond(model.id, last_id))
+    if value is None:
+        # the page ended among the rows without a value, which come last
+        return query.filter(column.is_(None), beyond(model.id, last_id))
+    return query.filter(or_(
+        beyond(column, value),
+        and_(column == value, beyond(model.id, last_id)),
+        column.is_(None)
+    ))
+
+
+def list_query(model, key):
+    """Returns (query, serialize, sort) for the fields, filters, sort and include of the request"""
+    sort = parse_sort(key)
+    query, serialize = projection(model, parse_fields(model), sort, parse_include(key))
+    return apply_filters(query, model, key), serialize, sort
+
+
+'''
+    rows without the ORM
+
+    a query of plain columns runs as the Core select it compiles to: the result rows are
+    read as they come from the driver, without the ORM building a keyed tuple per row
+    get_item reuses one select per table, compiled once per dialect thanks to COMPILED_CACHE
+'''
+COMPILED_CACHE = {}
+ITEM_SELECTS = {}
+
+
+def selects_columns(query):
+    """True when query selects plain columns rather than ORM entities"""
+    return not any(isinstance(column['type'], type) for column in query.column_descriptions)
+
+
+def fetch(query):
+    """Returns every row of query"""
+    if selects_columns(query):
+        return db.session.execute(query.statement).fetchall()
+    return query.all()
+
+
+def iterate(query):
+    """Yields every row of query, read through a server-side cursor STREAM_BATCH_SIZE rows at a time"""
+    if not selects_columns(query):
+        for row in query.execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE):
+            yield row
+        return
+    result = db.session.execute(query.statement.execution_options(stream_results=True))
+    while True:
+        rows = result.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def get_item(model, item_id):
+    """Returns the row of model with id item_id as the dict format() would build, or None"""
+    table = model.__table__
+    select = ITEM_SELECTS.get(table.name)
+    if select is None:
+        select = ITEM_SELECTS[table.name] = db.select(list(table.columns)).where(
+            table.c.id == db.bindparam('item_id'))
+    connection = db.session.connection().execution_options(compiled_cache=COMPILED_CACHE)
+    row = connection.execute(select, item_id=item_id).first()
+    return None if row is None else dict(row)
+
+
+def stream_response(query, key, serialize):
+    """Streams every row of query, fetched through a server-side cursor in batches"""
+    body = stream_envelope(key, (serialize(row) for row in iterate(query)))
+    return Response(stream_with_context(body), status=200, mimetype='application/json')
+
+
+def whole_rows():
+    """True when the items are the table's whole rows, without ?fields= or ?include="""
+    return request.args.get('fields') is None and request.args.get('include') is None
+
+
+def row_version(model):
+    """Returns the version the fragments of model's rows are cached under, None to skip the cache"""
+    if not whole_rows() or in_atomic_batch():
+        # uncommitted writes of the batch could be rolled back after their rows were cached
+        return None
+    return get_versions(model.__tablename__)[model.__tablename__]
+
+
+def list_response(model, key):
+    """Builds the GET list response for model, under `key` in the json body"""
+    query, serialize, sort = list_query(model, key)
+    if wants_stream():
+        return stream_response(ordered(query, model, sort), key, serialize)
+
+    # read before the rows, see RowFragments
+    version = row_version(model)
+    if wants_all():
+        rows = fetch(ordered(query, model, sort))
+        return envelope_response(key, row_fragments.encode(model.__tablename__, version, rows, serialize))
+
+    limit = parse_limit()
+    rows, next_cursor = paginate(query, model, limit, request.args.get('cursor'), sort)
+    return envelope_response(
+        key,
+        row_fragments.encode(model.__tablename__, version, rows, serialize),
+        limit=limit,
+        next_cursor=next_cursor
+    )
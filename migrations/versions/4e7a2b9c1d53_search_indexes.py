@@ -0,0 +1,57 @@
+"""add search indexes for GET /search
+
+Revision ID: 4e7a2b9c1d53
+Revises: 9b1f0c7e4a2d
+Create Date: 2026-10-18 13:26:51.804117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e7a2b9c1d53'
+down_revision = '9b1f0c7e4a2d'
+branch_labels = None
+depends_on = None
+
+SEARCHED_COLUMNS = (('movies', 'title'), ('actors', 'name'))
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, column in SEARCHED_COLUMNS:
+            op.create_index('ix_{}_{}_trgm'.format(table, column), table, [column], unique=False,
+                            postgresql_using='gist', postgresql_ops={column: 'gist_trgm_ops'})
+    elif dialect == 'sqlite':
+        for table, column in SEARCHED_COLUMNS:
+            op.execute(
+                "CREATE VIRTUAL TABLE {0}_fts USING fts5({1}, content='{0}', content_rowid='id')"
+                .format(table, column))
+            op.execute(
+                'CREATE TRIGGER {0}_fts_insert AFTER INSERT ON {0} BEGIN '
+                'INSERT INTO {0}_fts (rowid, {1}) VALUES (new.id, new.{1}); END'.format(table, column))
+            op.execute(
+                'CREATE TRIGGER {0}_fts_delete AFTER DELETE ON {0} BEGIN '
+                "INSERT INTO {0}_fts ({0}_fts, rowid, {1}) VALUES ('delete', old.id, old.{1}); END"
+                .format(table, column))
+            op.execute(
+                'CREATE TRIGGER {0}_fts_update AFTER UPDATE OF {1} ON {0} BEGIN '
+                "INSERT INTO {0}_fts ({0}_fts, rowid, {1}) VALUES ('delete', old.id, old.{1}); "
+                'INSERT INTO {0}_fts (rowid, {1}) VALUES (new.id, new.{1}); END'.format(table, column))
+            # index the rows that already exist
+            op.execute("INSERT INTO {0}_fts ({0}_fts) VALUES ('rebuild')".format(table))
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        for table, column in SEARCHED_COLUMNS:
+            op.drop_index('ix_{}_{}_trgm'.format(table, column), table_name=table)
+    elif dialect == 'sqlite':
+        for table, column in SEARCHED_COLUMNS:
+            for action in ('insert', 'delete', 'update'):
+                op.execute('DROP TRIGGER {}_fts_{}'.format(table, action))
+            op.execute('DROP TABLE {}_fts'.format(table))
@@ -0,0 +1,35 @@
+"""add table_versions for ETag validators
+
+Revision ID: 638c5ce37fe1
+Revises: 35d63a553761
+Create Date: 2026-10-18 09:12:41.208113
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '638c5ce37fe1'
+down_revision = '35d63a553761'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_versions, [
+        {'table_name': name, 'version': 0, 'updated_at': now}
+        for name in ('actors', 'movies', 'cast')
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,41 @@
+"""add indexes for list filters and sorting
+
+Revision ID: 9b1f0c7e4a2d
+Revises: 638c5ce37fe1
+Create Date: 2026-10-18 11:04:27.519348
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b1f0c7e4a2d'
+down_revision = '638c5ce37fe1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_movies_year'), 'movies', ['year'], unique=False)
+    op.create_index(op.f('ix_movies_title'), 'movies', ['title'], unique=False)
+    op.create_index(op.f('ix_actors_name'), 'actors', ['name'], unique=False)
+    op.create_index(op.f('ix_actors_age'), 'actors', ['age'], unique=False)
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'], unique=False)
+    if op.get_bind().dialect.name == 'postgresql':
+        # LIKE 'prefix%' can only use an index that compares bytes
+        op.create_index('ix_movies_title_pattern', 'movies', ['title'], unique=False,
+                        postgresql_ops={'title': 'text_pattern_ops'})
+        op.create_index('ix_actors_name_pattern', 'actors', ['name'], unique=False,
+                        postgresql_ops={'name': 'text_pattern_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_actors_name_pattern', table_name='actors')
+        op.drop_index('ix_movies_title_pattern', table_name='movies')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index(op.f('ix_actors_age'), table_name='actors')
+    op.drop_index(op.f('ix_actors_name'), table_name='actors')
+    op.drop_index(op.f('ix_movies_title'), table_name='movies')
+    op.drop_index(op.f('ix_movies_year'), table_name='movies')
@@ -1,5 +1,8 @@
 import os
+from datetime import datetime
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, DDL
 import dateutil.parser
 from flask_migrate import Migrate
 
@@ -24,6 +27,7 @@ def db_drop_and_create_all():
     """helper function used to drop current and create a fresh database"""
     db.drop_all()
     db.create_all()
+    seed_table_versions()
 
 
 def setup_db(app, database_path=database_path):
@@ -47,14 +51,126 @@ cast = db.Table(
 )
 
 
+'''
+table_versions
+    one row per versioned table, bumped in the same transaction as every write to it
+    so the api can build ETag / Last-Modified validators with a primary key lookup
+    instead of reading or hashing the rows themselves
+'''
+table_versions = db.Table(
+    'table_versions',
+    db.Column('table_name', db.String, primary_key=True),
+    db.Column('version', db.Integer, nullable=False, default=0),
+    db.Column('updated_at', db.DateTime, nullable=False),
+)
+
+VERSIONED_TABLES = ('actors', 'movies', 'cast')
+
+
+'''
+idempotency_keys
+    the responses of POST requests sent with an Idempotency-Key header, replayed when
+    a client retries the same request, see idempotency.py
+    a row without status is a request still in flight, holding the key until expires_at
+'''
+idempotency_keys = db.Table(
+    'idempotency_keys',
+    db.Column('key', db.String(64), primary_key=True),
+    db.Column('fingerprint', db.String(64), nullable=False),
+    db.Column('status', db.Integer),
+    db.Column('content_type', db.String),
+    db.Column('body', db.LargeBinary),
+    db.Column('expires_at', db.DateTime, nullable=False, index=True),
+)
+
+
+def seed_table_versions():
+    """Creates the version row of each versioned table"""
+    now = datetime.utcnow()
+    db.session.execute(table_versions.insert(), [
+        {'table_name': name, 'version': 0, 'updated_at': now} for name in VERSIONED_TABLES
+    ])
+    db.session.commit()
+
+
+def bump_version(*table_names):
+    """Bumps the version of each table, committed along with the pending write"""
+    now = datetime.utcnow()
+    for name in table_names:
+        result = db.session.execute(
+            table_versions.update()
+            .where(table_versions.c.table_name == name)
+            .values(version=table_versions.c.version + 1, updated_at=now)
+        )
+        if result.rowcount == 0:
+            db.session.execute(table_versions.insert().values(
+                table_name=name, version=1, updated_at=now))
+
+
+def get_versions(*table_names):
+    """Returns {table_name: (version, updated_at)}, (0, None) for tables never written to"""
+    rows = db.session.execute(
+        db.select([table_versions.c.table_name, table_versions.c.version, table_versions.c.updated_at])
+        .where(table_versions.c.table_name.in_(table_names))
+    )
+    versions = dict((name, (0, None)) for name in table_names)
+    for name, version, updated_at in rows:
+        versions[name] = (version, updated_at)
+    return versions
+
+
+'''
+deferred commits
+    POST /batch with "atomic": true runs several views in one transaction; while it does
+    commit() only flushes, close_session() keeps the session open and after_commit()
+    callbacks (cache invalidation, cast_graph updates) wait until the batch commits
+    after_rollback() callbacks only run if the batch rolls back instead
+'''
+
+
+def in_atomic_batch():
+    return has_app_context() and g.get('atomic_batch') is not None
+
+
+def commit():
+    """Commits the session, or only flushes it inside an atomic batch"""
+    if in_atomic_batch():
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def close_session():
+    """Closes the session, unless an atomic batch still needs it"""
+    if not in_atomic_batch():
+        db.session.close()
+
+
+def after_commit(callback, *args, **kwargs):
+    """Runs callback now, or once the atomic batch in progress has committed"""
+    if in_atomic_batch():
+        g.atomic_batch.append((callback, args, kwargs))
+    else:
+        callback(*args, **kwargs)
+
+
+def after_rollback(callback, *args, **kwargs):
+    """Runs callback if the atomic batch in progress rolls back; outside one, never"""
+    if in_atomic_batch():
+        g.atomic_rollback.append((callback, args, kwargs))
+
+
 class Actor(db.Model):
     __tablename__ = 'actors'
 
     id = db.Column(db.Integer, primary_key=True, nullable=False)
-    name = db.Column(db.String)
-    age = db.Column(db.Integer)
+    name = db.Column(db.String, index=True)
+    age = db.Column(db.Integer, index=True)
     gender = db.Column(db.String)
 
+    # ?gender=f&age_min=20 is answered from one range scan of this index
+    __table_args__ = (db.Index('ix_actors_gender_age', 'gender', 'age'),)
+
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
@@ -62,14 +178,18 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        bump_version(self.__tablename__)
+        commit()
 
     def update(self):
-        db.session.commit()
+        bump_version(self.__tablename__)
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        # the cast rows of the deleted record go with it
+        bump_version(self.__tablename__, 'cast')
+        commit()
 
     def format(self):
         return {
@@ -87,8 +207,8 @@ class Movie(db.Model):
     __tablename__ = 'movies'
 
     id = db.Column(db.Integer, primary_key=True, nullable=False)
-    title = db.Column(db.String)
-    year = db.Column(db.Integer)
+    title = db.Column(db.String, index=True)
+    year = db.Column(db.Integer, index=True)
     actors = db.relationship('Actor', secondary=cast,
                              backref=db.backref('movies', lazy=True))
 
@@ -98,14 +218,18 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        bump_version(self.__tablename__)
+        commit()
 
     def update(self):
-        db.session.commit()
+        bump_version(self.__tablename__)
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        # the cast rows of the deleted record go with it
+        bump_version(self.__tablename__, 'cast')
+        commit()
 
     def format(self):
         return {
@@ -116,3 +240,53 @@ class Movie(db.Model):
 
     def __repr__(self):
         return f'<Movie id: "{self.id}", title: "{self.title}", year: "{self.year}">'
+
+
+'''
+prefix indexes
+    postgres only uses a b-tree index for `LIKE 'abc%'` when the index compares bytes,
+    so ?title= and ?name= prefix filters get a text_pattern_ops index next to the
+    collation ordered one that serves ?sort=
+    sqlite filters prefixes with a range on the plain index and needs nothing more
+'''
+for table, column in ((Movie.__table__, 'title'), (Actor.__table__, 'name')):
+    event.listen(table, 'after_create', DDL(
+        'CREATE INDEX ix_%(table)s_{0}_pattern ON %(table)s ({0} text_pattern_ops)'.format(column)
+    ).execute_if(dialect='postgresql'))
+
+
+'''
+search indexes
+    postgres: a pg_trgm GiST index per searched column, so GET /search reads the
+        best matches in rank order straight from the index (word similarity distance)
+    sqlite: an external content FTS5 table per searched column, kept in sync with
+        its table by triggers and dropped along with it
+'''
+SEARCHED_COLUMNS = ((Movie.__table__, 'title'), (Actor.__table__, 'name'))
+
+for table, column in SEARCHED_COLUMNS:
+    ddl = {
+        'postgresql': [
+            'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+            'CREATE INDEX ix_%(table)s_{0}_trgm ON %(table)s USING gist ({0} gist_trgm_ops)',
+        ],
+        'sqlite': [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %(table)s_fts USING fts5("
+            "{0}, content='%(table)s', content_rowid='id')",
+            'CREATE TRIGGER %(table)s_fts_insert AFTER INSERT ON %(table)s BEGIN '
+            'INSERT INTO %(table)s_fts (rowid, {0}) VALUES (new.id, new.{0}); END',
+            'CREATE TRIGGER %(table)s_fts_delete AFTER DELETE ON %(table)s BEGIN '
+            "INSERT INTO %(table)s_fts (%(table)s_fts, rowid, {0}) VALUES ('delete', old.id, old.{0}); END",
+            'CREATE TRIGGER %(table)s_fts_update AFTER UPDATE OF {0} ON %(table)s BEGIN '
+            "INSERT INTO %(table)s_fts (%(table)s_fts, rowid, {0}) VALUES ('delete', old.id, old.{0}); "
+            'INSERT INTO %(table)s_fts (rowid, {0}) VALUES (new.id, new.{0}); END',
+        ],
+    }
+    for dialect, statements in ddl.items():
+        for statement in statements:
+            event.listen(table, 'after_create', DDL(
+                statement.format(column)
+            ).execute_if(dialect=dialect))
+    event.listen(table, 'before_drop', DDL(
+        'DROP TABLE IF EXISTS %(table)s_fts'
+    ).execute_if(dialect='sqlite'))
@@ -0,0 +1,167 @@
+import os
+import json
+from flask import Response
+from cache import LRUCache
+
+STREAM_CHUNK_ROWS = int(os.getenv('STREAM_CHUNK_ROWS', 500))
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto').lower()
+# 0 turns the row fragment cache off
+ROW_FRAGMENT_CACHE_SIZE = int(os.getenv('ROW_FRAGMENT_CACHE_SIZE', 100000))
+
+
+'''
+    json encoders
+    an encoder turns a json-serializable value into compact utf-8 bytes, keys sorted like jsonify
+
+    OrjsonEncoder uses orjson, a compiled encoder several times faster than the stdlib one
+        (pip install orjson), handing the values it cannot encode over to the stdlib
+    StdlibEncoder uses the json module and is always available
+    JSON_ENCODER picks one: auto (orjson when it is installed), orjson or stdlib
+'''
+
+
+class StdlibEncoder(object):
+    """Encodes with the json module of the standard library"""
+    name = 'stdlib'
+
+    def __init__(self):
+        # one encoder for every call, json.dumps would build a new one each time
+        self.encode = json.JSONEncoder(separators=(',', ':'), sort_keys=True).encode
+
+    def dumps(self, value):
+        return self.encode(value).encode('utf-8')
+
+
+class OrjsonEncoder(object):
+    """Encodes with orjson, falling back to the standard library for unsupported types"""
+    name = 'orjson'
+
+    def __init__(self, orjson):
+        self.orjson = orjson
+        self.option = orjson.OPT_SORT_KEYS
+        self.fallback = StdlibEncoder()
+
+    def dumps(self, value):
+        try:
+            return self.orjson.dumps(value, option=self.option)
+        except TypeError:
+            return self.fallback.dumps(value)
+
+
+def build_encoder(name):
+    """Returns the json encoder selected by JSON_ENCODER"""
+    if name in ('auto', 'orjson'):
+        try:
+            # optional dependency, the stdlib encoder is used without it
+            import orjson
+        except ImportError:
+            if name == 'orjson':
+                raise
+        else:
+            return OrjsonEncoder(orjson)
+    return StdlibEncoder()
+
+
+json_encoder = build_encoder(JSON_ENCODER)
+
+
+'''
+    RowFragments
+    the encoded json of whole rows, as format() builds them, keyed by (table, id, version)
+
+    it should encode a row only once per version of its table, list responses being put
+        together from the cached fragments of their rows whatever the page, filter or sort
+    it should take the version (counter and updated_at, see models.get_versions) read
+        before the rows: a write landing in between leaves a fragment newer than its key,
+        never older, and the counters starting over after a reseed get a new updated_at
+    it should encode the whole list in one call when there is no version to cache under,
+        one call per row costing several times more
+    it should keep ROW_FRAGMENT_CACHE_SIZE fragments at most, older versions aging out
+'''
+
+
+class RowFragments(object):
+    """Cache of pre-encoded rows, bounded in size"""
+
+    def __init__(self, maxsize=ROW_FRAGMENT_CACHE_SIZE):
+        self.entries = LRUCache(maxsize=maxsize) if maxsize else None
+
+    def encode(self, table, version, rows, serialize, encoder=None):
+        """Returns the json array of serialize(row) for each row, from cached fragments when it can"""
+        encoder = encoder or json_encoder
+        if self.entries is None or version is None:
+            return encoder.dumps([serialize(row) for row in rows])
+        keys = [(table, row.id, version) for row in rows]
+        fragments = self.entries.get_many(keys)
+        for index, fragment in enumerate(fragments):
+            if fragment is None:
+                fragment = fragments[index] = encoder.dumps(serialize(rows[index]))
+                self.entries.set(keys[index], fragment)
+        return b'[' + b','.join(fragments) + b']'
+
+    def clear(self):
+        if self.entries is not None:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns the cache counters and the encoder in use"""
+        stats = self.entries.stats() if self.entries is not None else {'size': 0, 'maxsize': 0}
+        stats['encoder'] = json_encoder.name
+        return stats
+
+
+row_fragments = RowFragments()
+
+
+'''
+    envelope_response(key, items, **fields)
+    @INPUTS
+        key: the name of the list in the json body (i.e. 'movies')
+        items: the list, already encoded as a json array (see RowFragments.encode)
+        fields: the other members of the body (i.e. limit, next_cursor)
+
+    it should respond with the same document as jsonify({"success": True, key: items, **fields}),
+        byte for byte with the stdlib encoder and ascii values
+'''
+
+
+def envelope_response(key, items, **fields):
+    """Builds a 200 json response around an already encoded list"""
+    fields['success'] = True
+    members = []
+    # in the sorted key order jsonify writes
+    for name in sorted(list(fields) + [key]):
+        value = items if name == key else json_encoder.dumps(fields[name])
+        members.append(json_encoder.dumps(name) + b':' + value)
+    return Response(b'{' + b','.join(members) + b'}\n', status=200, mimetype='application/json')
+
+
+'''
+    stream_envelope(key, items) generator
+    @INPUTS
+        key: the name of the list in the json body (i.e. 'movies')
+        items: an iterable of json-serializable dicts, consumed lazily
+
+    it should emit a document equivalent to jsonify({"success": True, key: list(items)}),
+        with "success" first rather than in sorted key order
+    it should only hold STREAM_CHUNK_ROWS encoded items in memory at a time
+    yields the document in byte chunks
+'''
+
+
+def stream_envelope(key, items, chunk_rows=STREAM_CHUNK_ROWS):
+    """Encodes a {"success": true, key: [...]} body incrementally"""
+    dumps = json_encoder.dumps
+    yield b'{"success":true,' + dumps(key) + b':['
+    chunk = []
+    separator = b''
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_rows:
+            # one call per chunk, the brackets of the encoded list left out
+            yield separator + dumps(chunk)[1:-1]
+            separator = b','
+            chunk = []
+    if chunk:
+        yield separator + dumps(chunk)[1:-1]
+    yield b']}\n'
@@ -0,0 +1,72 @@
+import os
+import re
+from flask import request, abort
+from sqlalchemy import text
+from models import db
+
+SEARCH_MAX_QUERY_LENGTH = int(os.getenv('SEARCH_MAX_QUERY_LENGTH', 200))
+
+
+'''
+    ranked search over movie titles and actor names, used by GET /search
+
+    every query is answered from the search indexes declared in models.py,
+    only the best `limit` rows of each table are read back
+        postgres: pg_trgm word similarity, ordered by the `<<->` distance the
+            GiST index returns nearest first, so typos and partial words still match
+        sqlite: FTS5 full-text match of every word of q as a prefix, ordered by bm25
+
+    scores are higher for better matches, and only comparable within one backend
+'''
+SEARCHABLE = {
+    'movies': ('title', ('id', 'title', 'year')),
+    'actors': ('name', ('id', 'name', 'age', 'gender')),
+}
+
+
+def parse_query():
+    """Reads ?q= from the request, aborts with 400 if it is missing or too long"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        abort(400, 'q is required')
+    if len(q) > SEARCH_MAX_QUERY_LENGTH:
+        abort(400, 'q must be at most {} characters'.format(SEARCH_MAX_QUERY_LENGTH))
+    return q
+
+
+def fts_query(q):
+    """Turns free text into an FTS5 query matching every word as a prefix"""
+    # quoting each word keeps FTS5 operators and punctuation in q from being interpreted
+    return ' '.join('"{}"*'.format(word) for word in re.findall(r'\w+', q))
+
+
+def search_statement(table, dialect):
+    """Returns the ranked search query of table for dialect"""
+    column, fields = SEARCHABLE[table]
+    if dialect == 'postgresql':
+        return text(
+            'SELECT {fields}, 1 - (:q <<-> {column}) AS score FROM {table} '
+            'WHERE :q <% {column} ORDER BY :q <<-> {column} LIMIT :limit'.format(
+                fields=', '.join(fields), column=column, table=table))
+    return text(
+        'SELECT {fields}, -{table}_fts.rank AS score FROM {table}_fts '
+        'JOIN {table} ON {table}.id = {table}_fts.rowid '
+        'WHERE {table}_fts MATCH :q ORDER BY {table}_fts.rank LIMIT :limit'.format(
+            fields=', '.join('{}.{}'.format(table, name) for name in fields), table=table))
+
+
+def search(table, q, limit):
+    """Returns the best `limit` matches for q in table, best first"""
+    dialect = db.engine.dialect.name
+    if dialect != 'postgresql':
+        q = fts_query(q)
+        if not q:
+            return []
+    rows = db.session.execute(search_statement(table, dialect), {'q': q, 'limit': limit})
+    fields = SEARCHABLE[table][1]
+    results = []
+    for row in rows:
+        result = dict(zip(fields, row))
+        result['score'] = round(row[-1], 4)
+        results.append(result)
+    return results
@@ -0,0 +1,171 @@
+import os
+import time
+import random
+import click
+from flask.cli import with_appcontext
+from models import db, db_drop_and_create_all, bump_version
+from importer import copy_rows
+from cache import response_cache
+
+SEED_ACTORS = int(os.getenv('SEED_ACTORS', 1000))
+SEED_MOVIES = int(os.getenv('SEED_MOVIES', 500))
+SEED_CAST_PER_MOVIE = int(os.getenv('SEED_CAST_PER_MOVIE', 5))
+SEED_VALUE = int(os.getenv('SEED_VALUE', 1942))
+SEED_BATCH_SIZE = int(os.getenv('SEED_BATCH_SIZE', 50000))
+# GET /seed is public, so it cannot be asked for more rows than this; the CLI can
+SEED_MAX_ROWS = int(os.getenv('SEED_MAX_ROWS', 100000))
+
+SYLLABLES = ['ka', 'ro', 'mi', 'te', 'sun', 'val', 'dor', 'li', 'zen', 'pa', 'qua', 'ber', 'no', 'shi', 'tor',
+             'an', 'el', 'mar', 'vi', 'sa', 'go', 'ra', 'len', 'da', 'fi']
+
+
+'''
+    synthetic catalog
+
+    it should generate `actors` actors and `movies` movies, and cast each movie with
+        `cast_per_movie` actors on average, drawn with a skew towards low actor ids so a
+        few prolific actors play in many movies and most in a handful, as in real casts
+    it should generate the same catalog for the same seed value and sizes: each table
+        draws from a random.Random of its own, seeded with the seed value and its name
+    it should generate and load the rows SEED_BATCH_SIZE at a time, as tuples with
+        explicit ids, so nothing is read back and memory does not grow with the catalog
+    it should load them with COPY ... FROM STDIN on postgres, or one executemany
+        INSERT per batch through the raw DBAPI cursor elsewhere
+'''
+
+
+def table_random(seed, name):
+    return random.Random('{}:{}'.format(seed, name))
+
+
+def make_words(rng, count=5000):
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def batched(rows, size):
+    """Groups an iterable of rows into lists of `size` rows"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate_actors(count, seed):
+    """Yields (id, name, age, gender) rows"""
+    rng = table_random(seed, 'actors')
+    words = make_words(rng)
+    choice, randint, random_ = rng.choice, rng.randint, rng.random
+    for actor_id in range(1, count + 1):
+        name = '{} {}'.format(choice(words), choice(words)).title()
+        yield actor_id, name, randint(5, 90), 'f' if random_() < 0.5 else 'm'
+
+
+def generate_movies(count, seed):
+    """Yields (id, title, year) rows"""
+    rng = table_random(seed, 'movies')
+    words = make_words(rng)
+    choice, randint = rng.choice, rng.randint
+    for movie_id in range(1, count + 1):
+        title = ' '.join(choice(words) for _ in range(randint(1, 4))).capitalize()
+        yield movie_id, title, randint(1920, 2024)
+
+
+def generate_cast(movies, actors, per_movie, seed):
+    """Yields (movie_id, actor_id) rows, per_movie actors per movie on average"""
+    if not actors or not per_movie:
+        return
+    rng = table_random(seed, 'cast')
+    random_ = rng.random
+    most = min(actors, 2 * per_movie - 1)
+    for movie_id in range(1, movies + 1):
+        size = min(most, 1 + int(random_() * (2 * per_movie - 1)))
+        cast = set()
+        while len(cast) < size:
+            cast.add(1 + int(actors * random_() ** 2))
+        for actor_id in sorted(cast):
+            yield movie_id, actor_id
+
+
+def load(table_name, columns, rows, batch_size):
+    """Loads rows into a table, one COPY or executemany per batch; returns how many"""
+    connection = db.session.connection().connection
+    dialect = db.engine.dialect.name
+    statement = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+        table_name, ', '.join(columns), ', '.join(['?'] * len(columns)))
+    count = 0
+    for batch in batched(rows, batch_size):
+        if dialect == 'postgresql':
+            copy_rows(table_name, columns, batch)
+        else:
+            cursor = connection.cursor()
+            cursor.executemany(statement, batch)
+            cursor.close()
+        count += len(batch)
+    return count
+
+
+def seed_database(actors=SEED_ACTORS, movies=SEED_MOVIES, cast_per_movie=SEED_CAST_PER_MOVIE,
+                  seed=SEED_VALUE, batch_size=SEED_BATCH_SIZE):
+    """Replaces every table with a generated catalog; returns the counts and timings"""
+    started = time.perf_counter()
+    db.session.remove()
+    db_drop_and_create_all()
+    report = {
+        'actors': load('actors', ('id', 'name', 'age', 'gender'), generate_actors(actors, seed), batch_size),
+        'movies': load('movies', ('id', 'title', 'year'), generate_movies(movies, seed), batch_size),
+    }
+    report['cast'] = load('cast', ('movie_id', 'actor_id'),
+                          generate_cast(movies, actors, cast_per_movie, seed), batch_size)
+    if db.engine.dialect.name == 'postgresql':
+        # the ids were given explicitly, move the sequences past them
+        for table_name in ('actors', 'movies'):
+            db.session.execute(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), COALESCE(MAX(id), 0) + 1, false) "
+                "FROM {0}".format(table_name))
+    bump_version('actors', 'movies', 'cast')
+    db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('ANALYZE')
+        db.session.commit()
+    rows = report['actors'] + report['movies'] + report['cast']
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    report['rows_per_second'] = round(rows / report['seconds']) if report['seconds'] else 0
+    return report
+
+
+'''
+    flask seed [--actors N] [--movies N] [--cast-per-movie N] [--seed N]
+        drops every table and loads a generated catalog, without the GET /seed size cap
+        prints the number of rows and the rows per second
+'''
+
+
+@click.command('seed')
+@click.option('--actors', type=click.IntRange(min=0), default=SEED_ACTORS, show_default=True)
+@click.option('--movies', type=click.IntRange(min=0), default=SEED_MOVIES, show_default=True)
+@click.option('--cast-per-movie', type=click.IntRange(min=0), default=SEED_CAST_PER_MOVIE, show_default=True,
+              help='Average number of actors cast in each movie.')
+@click.option('--seed', 'seed', type=int, default=SEED_VALUE, show_default=True,
+              help='Seed value, the same seed and sizes generate the same catalog.')
+@with_appcontext
+def seed_command(actors, movies, cast_per_movie, seed):
+    """Replaces the database with a generated catalog"""
+    try:
+        report = seed_database(actors, movies, cast_per_movie, seed)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.close()
+    # only reaches the api's cached responses through a shared (redis) backend
+    for table in ('actors', 'movies', 'cast'):
+        response_cache.invalidate_all(table)
+    click.echo('seeded {} actors, {} movies and {} cast links in {:.2f}s ({} rows/s)'.format(
+        report['actors'], report['movies'], report['cast'], report['seconds'], report['rows_per_second']))
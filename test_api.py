@@ -1,9 +1,24 @@
 import os
+import time
+import gzip
+import tempfile
+import threading
 import unittest
 import json
+from flask import g, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from app import create_app
-from models import db, setup_db, Actor, Movie
+from sqlalchemy import event
+from models import db, setup_db, bump_version, Actor, Movie
+from cache import response_cache, ResponseCache, MemoryBackend, RedisBackend
+from listing import list_query, page_query, parse_limit, COMPILED_CACHE
+from graph import CastGraph, cast_graph
+from auth import token_cache, requires_include, AuthError
+from conditional import conditional
+from batch import BATCH_MAX_OPERATIONS
+from seed import seed_database
+from rendering import row_fragments, StdlibEncoder, OrjsonEncoder
+from idempotency import idempotent, idempotency_store, MemoryIdempotencyBackend, DatabaseIdempotencyBackend, StoredResponse, KeyInFlight
 from dotenv import load_dotenv
 # https://www.nylas.com/blog/making-use-of-environment-variables-in-python/
 load_dotenv()
@@ -52,6 +67,14 @@ class ApiTestCase(unittest.TestCase):
         self.asst_headers = {"Authorization": "Bearer {}".format(CAST_ASST_TOKEN)}
 
 
+        # responses cached by a previous test were built from another database
+        response_cache.backend = MemoryBackend()
+        response_cache.reset_stats()
+        cast_graph.reset()
+        idempotency_store.backend = DatabaseIdempotencyBackend()
+        idempotency_store.reset_stats()
+        row_fragments.clear()
+
         setup_db(self.app, database_path=database_path)
         # setup_db(self.app, database_path=prod_test_database_path)
 
@@ -448,5 +471,1275 @@ class ApiTestCase(unittest.TestCase):
         body = json.loads(res.data)
         self.assertEqual(res.status_code, 401)
 
+# ---------------------------------------------------------------------------------
+# ------------------------------- PERMISSIONS -------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_get_permissions_registry(self):
+        res = self.client().get('/api/permissions', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(body['success'], True)
+        routes = {(route['endpoint'], tuple(route['methods'])): route for route in body['routes']}
+        self.assertEqual(routes[('post_movie', ('POST',))]['all_of'], ['post:movies'])
+        self.assertEqual(body['allowed'], sorted(body['roles']['casting_assistant']))
+        self.assertIn('get_movies', body['allowed'])
+        self.assertNotIn('delete_movie', body['allowed'])
+        self.assertIn('delete_movie', body['roles']['executive_producer'])
+
+    def test_get_permissions_with_NO_HEADERS(self):
+        res = self.client().get('/api/permissions')
+        self.assertEqual(res.status_code, 401)
+
+# ---------------------------------------------------------------------------------
+# ------------------------------- PAGINATION --------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_get_movies_paginated(self):
+        res = self.client().get('/api/movies?limit=2', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in body['movies']], [1, 2])
+        self.assertIsNotNone(body['next_cursor'])
+
+        res = self.client().get(
+            '/api/movies?limit=2&cursor={}'.format(body['next_cursor']), headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual([movie['id'] for movie in body['movies']], [3])
+        self.assertIsNone(body['next_cursor'])
+
+    def test_get_actors_paginated_last_page_has_no_cursor(self):
+        res = self.client().get('/api/actors?limit=3', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(len(body['actors']), 3)
+        self.assertIsNone(body['next_cursor'])
+
+    def test_get_actors_unpaginated(self):
+        res = self.client().get('/api/actors?all=true', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(body['actors']), 3)
+        self.assertNotIn('next_cursor', body)
+
+    def test_get_movies_with_invalid_cursor(self):
+        res = self.client().get('/api/movies?cursor=not-a-cursor', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_with_invalid_limit(self):
+        res = self.client().get('/api/movies?limit=0', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 400)
+
+# ---------------------------------------------------------------------------------
+# -------------------------------- STREAMING --------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_get_movies_streamed(self):
+        res = self.client().get('/api/movies?stream=true', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        body = json.loads(res.data)
+        self.assertEqual(body['success'], True)
+        self.assertEqual([movie['id'] for movie in body['movies']], [1, 2, 3])
+
+    def test_get_actors_streamed_matches_unpaginated(self):
+        streamed = self.client().get('/api/actors?stream=true', headers=self.asst_headers)
+        unpaginated = self.client().get('/api/actors?all=true', headers=self.asst_headers)
+        self.assertEqual(json.loads(streamed.data), json.loads(unpaginated.data))
+
+    def test_stream_envelope_chunks(self):
+        from rendering import stream_envelope
+        items = [{'id': index} for index in range(5)]
+        chunks = list(stream_envelope('movies', iter(items), chunk_rows=2))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(json.loads(b''.join(chunks)), {'success': True, 'movies': items})
+        self.assertEqual(json.loads(b''.join(stream_envelope('movies', []))), {'success': True, 'movies': []})
+
+# ---------------------------------------------------------------------------------
+# ----------------------------- SPARSE FIELDSETS ----------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_get_movies_with_fields(self):
+        res = self.client().get('/api/movies?fields=id,title', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(body['movies'][0], {'id': 1, 'title': 'The Movie'})
+
+    def test_get_actors_with_fields_paginates_without_id(self):
+        res = self.client().get('/api/actors?fields=name&limit=2', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(body['actors'], [{'name': 'Sam Jones'}, {'name': 'Cynthia Jones'}])
+        res = self.client().get(
+            '/api/actors?fields=name&limit=2&cursor={}'.format(body['next_cursor']),
+            headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(body['actors'], [{'name': 'Vanna White'}])
+
+    def test_get_actors_with_fields_streamed(self):
+        res = self.client().get('/api/actors?fields=id,age&stream=true', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(body['actors'][2], {'id': 3, 'age': 32})
+
+    def test_get_movies_with_unknown_field(self):
+        res = self.client().get('/api/movies?fields=id,budget', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 400)
+
+# ---------------------------------------------------------------------------------
+# ----------------------------- CONDITIONAL GET -----------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_get_movies_not_modified(self):
+        res = self.client().get('/api/movies', headers=self.asst_headers)
+        etag = res.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        headers = dict(self.asst_headers, **{'If-None-Match': etag})
+        res = self.client().get('/api/movies', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_get_actor_modified_after_write(self):
+        res = self.client().get('/api/actors/2', headers=self.prod_headers)
+        etag = res.headers['ETag']
+        self.client().patch('/api/actors/2', headers=self.prod_headers, json={
+            'name': 'Jane Smith',
+            'age': 24,
+            'gender': 'f'
+        })
+        headers = dict(self.prod_headers, **{'If-None-Match': etag})
+        res = self.client().get('/api/actors/2', headers=headers)
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(body['actor']['name'], 'Jane Smith')
+        self.assertIn('Last-Modified', res.headers)
+
+    def test_delete_movie_bumps_movies_and_cast_versions(self):
+        from models import get_versions
+        self.client().delete('/api/movies/2', headers=self.prod_headers)
+        with self.app.app_context():
+            versions = get_versions('movies', 'cast', 'actors')
+        self.assertEqual(versions['movies'][0], 1)
+        self.assertEqual(versions['cast'][0], 1)
+        self.assertEqual(versions['actors'][0], 0)
+
+# ---------------------------------------------------------------------------------
+# ------------------------------ RESPONSE CACHE -----------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_get_movies_served_from_response_cache(self):
+        first = self.client().get('/api/movies?limit=2', headers=self.asst_headers)
+        second = self.client().get('/api/movies?limit=2', headers=self.asst_headers)
+        self.assertEqual(first.data, second.data)
+        stats = response_cache.stats()['gsprod-api.get_movies']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_memory_backend_item_generations_are_bounded(self):
+        backend = MemoryBackend(max_item_generations=2)
+        backend.bump('movies:item:1')
+        backend.bump('movies:item:2')
+        self.assertEqual(backend.generation('movies:items'), 0)
+        backend.bump('movies:item:3')
+        self.assertEqual(len(backend.item_generations), 2)
+        # item 1 reads as 0 again, entries cached under its old generation are dropped with :items
+        self.assertEqual(backend.generation('movies:item:1'), 0)
+        self.assertEqual(backend.generation('movies:items'), 1)
+        self.assertEqual(backend.generation('movies:item:3'), 1)
+
+    def test_item_response_not_stale_after_generation_eviction(self):
+        response_cache.backend = MemoryBackend(max_item_generations=1)
+        self.client().get('/api/movies/1', headers=self.asst_headers)
+        self.client().patch('/api/movies/1', headers=self.prod_headers, json={'title': 'Renamed', 'year': 2018})
+        self.client().get('/api/movies/1', headers=self.asst_headers)
+        self.client().patch('/api/movies/2', headers=self.prod_headers, json={'title': 'Other', 'year': 2018})
+        with self.app.app_context():
+            Movie.query.get(1).title = 'Renamed again'
+            db.session.commit()
+        response_cache.backend.bump('movies:item:1')
+        res = self.client().get('/api/movies/1', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['movie']['title'], 'Renamed again')
+
+    def test_response_cache_keyed_on_query_and_scope(self):
+        self.client().get('/api/actors?limit=1', headers=self.asst_headers)
+        self.client().get('/api/actors?limit=2', headers=self.asst_headers)
+        self.client().get('/api/actors?limit=1', headers=self.dir_headers)
+        self.assertEqual(response_cache.stats()['gsprod-api.get_actors']['hits'], 0)
+
+    def test_post_movie_invalidates_movie_list(self):
+        self.client().get('/api/movies', headers=self.prod_headers)
+        self.client().post('/api/movies', headers=self.prod_headers, json={
+            'title': 'The Movie 4',
+            'year': 2018
+        })
+        res = self.client().get('/api/movies', headers=self.prod_headers)
+        body = json.loads(res.data)
+        self.assertEqual(len(body['movies']), 4)
+
+    def test_patch_actor_invalidates_cached_actors(self):
+        self.client().get('/api/actors/1', headers=self.prod_headers)
+        self.client().get('/api/actors/2', headers=self.prod_headers)
+        self.client().patch('/api/actors/2', headers=self.prod_headers, json={
+            'name': 'Jane Smith',
+            'age': 24,
+            'gender': 'f'
+        })
+        # entries are keyed on the actors table version, like the ETag
+        self.client().get('/api/actors/1', headers=self.prod_headers)
+        self.client().get('/api/actors/1', headers=self.prod_headers)
+        res = self.client().get('/api/actors/2', headers=self.prod_headers)
+        self.assertEqual(json.loads(res.data)['actor']['name'], 'Jane Smith')
+        stats = response_cache.stats()['gsprod-api.get_actor']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 4)
+
+    def test_write_of_another_worker_is_not_served_from_cache(self):
+        first = self.client().get('/api/movies/1', headers=self.asst_headers)
+        with self.app.app_context():
+            # what another worker does: this one's generations never get bumped
+            Movie.query.get(1).title = 'Renamed elsewhere'
+            bump_version('movies')
+            db.session.commit()
+        res = self.client().get('/api/movies/1', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['movie']['title'], 'Renamed elsewhere')
+        self.assertNotEqual(res.headers['ETag'], first.headers['ETag'])
+
+    def test_shared_backend_invalidation_across_workers(self):
+        class RedisStandIn(object):
+            """the subset of the redis client used by RedisBackend"""
+            def __init__(self):
+                self.data = {}
+
+            def get(self, key):
+                return self.data.get(key)
+
+            def set(self, key, value, ex=None):
+                self.data[key] = value
+
+            def incr(self, key):
+                self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+
+        shared = RedisStandIn()
+        worker_a = ResponseCache(RedisBackend(shared))
+        worker_b = ResponseCache(RedisBackend(shared))
+        self.assertEqual(worker_b.generations(['movies:list']), '0')
+        worker_a.invalidate('movies', 7)
+        self.assertEqual(worker_b.generations(['movies:list', 'movies:item:7']), '1,1')
+
+        response_cache.backend = RedisBackend(shared)
+        self.client().get('/api/movies/1', headers=self.asst_headers)
+        res = self.client().get('/api/movies/1', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['movie']['id'], 1)
+        self.assertEqual(response_cache.stats()['gsprod-api.get_movie']['hits'], 1)
+
+# ---------------------------------------------------------------------------------
+# ---------------------------- FILTERS AND SORT -----------------------------------
+# ---------------------------------------------------------------------------------
+
+    def query_plan(self, model, key, path):
+        """Returns the query plan of the page query the list endpoint runs for path"""
+        with self.app.test_request_context(path):
+            query, serialize, sort = list_query(model, key)
+            query = page_query(query, model, parse_limit(), sort=sort)
+            sql = str(query.statement.compile(
+                dialect=self.db.engine.dialect, compile_kwargs={'literal_binds': True}))
+        if self.db.engine.dialect.name == 'postgresql':
+            # a handful of test rows always fit one page, make the planner show
+            # what it would do on a real table
+            self.db.session.execute('SET LOCAL enable_seqscan = off')
+            rows = self.db.session.execute('EXPLAIN ' + sql)
+        else:
+            rows = self.db.session.execute('EXPLAIN QUERY PLAN ' + sql)
+        plan = '\n'.join(str(column) for row in rows for column in row)
+        self.db.session.rollback()
+        return plan
+
+    def assertPlanUsesIndex(self, plan, index):
+        self.assertIn(index, plan)
+        self.assertNotIn('Seq Scan', plan)
+        self.assertNotRegex(plan, r'\bSCAN (movies|actors)\b')
+
+    def test_filter_plans_use_indexes(self):
+        plans = [
+            (Movie, 'movies', '/api/movies?year=2016', 'ix_movies_year'),
+            (Movie, 'movies', '/api/movies?year_min=2016&year_max=2017', 'ix_movies_year'),
+            (Movie, 'movies', '/api/movies?title=The%20Movie%202', 'ix_movies_title'),
+            (Movie, 'movies', '/api/movies?year_min=2016&sort=year', 'ix_movies_year'),
+            (Actor, 'actors', '/api/actors?age=22', 'ix_actors_age'),
+            (Actor, 'actors', '/api/actors?age_min=20&age_max=30', 'ix_actors_age'),
+            (Actor, 'actors', '/api/actors?gender=f', 'ix_actors_gender_age'),
+            (Actor, 'actors', '/api/actors?gender=f&age_min=20', 'ix_actors_gender_age'),
+            (Actor, 'actors', '/api/actors?name=Vanna', 'ix_actors_name'),
+            (Actor, 'actors', '/api/actors?name=Van&sort=-name', 'ix_actors_name'),
+        ]
+        with self.app.app_context():
+            for model, key, path, index in plans:
+                with self.subTest(path=path):
+                    self.assertPlanUsesIndex(self.query_plan(model, key, path), index)
+
+    def test_get_movies_filtered_by_year_range(self):
+        res = self.client().get('/api/movies?year_min=2016&year_max=2016', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['year'] for movie in body['movies']], [2016])
+
+    def test_get_movies_filtered_by_title_prefix(self):
+        res = self.client().get('/api/movies?title=The%20Movie%20', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual([movie['title'] for movie in body['movies']], ['The Movie 2', 'The Movie 3'])
+
+    def test_title_prefix_is_not_a_pattern(self):
+        res = self.client().get('/api/movies?title=The%25', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['movies'], [])
+
+    def test_get_actors_filtered_by_gender_and_age(self):
+        res = self.client().get('/api/actors?gender=f&age_min=25', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual([actor['name'] for actor in body['actors']], ['Vanna White'])
+
+    def test_get_actors_with_invalid_filter_value(self):
+        res = self.client().get('/api/actors?age_min=old', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_sorted_descending_across_pages(self):
+        res = self.client().get('/api/actors?sort=-age&limit=2&fields=name', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(body['actors'], [{'name': 'Vanna White'}, {'name': 'Sam Jones'}])
+        res = self.client().get(
+            '/api/actors?sort=-age&limit=2&fields=name&cursor={}'.format(body['next_cursor']),
+            headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(body['actors'], [{'name': 'Cynthia Jones'}])
+        self.assertIsNone(body['next_cursor'])
+
+    def test_get_movies_sorted_with_missing_values_last(self):
+        with self.app.app_context():
+            self.db.session.add(Movie(title=None, year=2014))
+            self.db.session.commit()
+        titles = []
+        cursor = ''
+        while cursor is not None:
+            res = self.client().get(
+                '/api/movies?sort=title&limit=1&cursor={}'.format(cursor), headers=self.asst_headers)
+            body = json.loads(res.data)
+            titles.extend(movie['title'] for movie in body['movies'])
+            cursor = body['next_cursor']
+        self.assertEqual(titles, ['The Movie', 'The Movie 2', 'The Movie 3', None])
+
+    def test_cursor_of_another_sort_is_rejected(self):
+        res = self.client().get('/api/movies?sort=year&limit=1', headers=self.asst_headers)
+        cursor = json.loads(res.data)['next_cursor']
+        res = self.client().get('/api/movies?sort=title&cursor={}'.format(cursor), headers=self.asst_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_with_unknown_sort(self):
+        res = self.client().get('/api/movies?sort=budget', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 400)
+
+# ---------------------------------------------------------------------------------
+# --------------------------------- SEARCH ----------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_search_ranks_movies_and_actors(self):
+        res = self.client().get('/api/search?q=jones', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(body['q'], 'jones')
+        self.assertEqual(sorted(actor['name'] for actor in body['actors']), ['Cynthia Jones', 'Sam Jones'])
+        self.assertEqual(body['movies'], [])
+        scores = [actor['score'] for actor in body['actors']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_search_matches_partial_words(self):
+        res = self.client().get('/api/search?q=vann&limit=1', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual([actor['name'] for actor in body['actors']], ['Vanna White'])
+
+    def test_search_follows_writes(self):
+        self.client().patch('/api/movies/2', headers=self.prod_headers, json={
+            'title': 'Casablanca',
+            'year': 1942
+        })
+        self.client().delete('/api/actors/1', headers=self.prod_headers)
+        res = self.client().get('/api/search?q=casablanca', headers=self.asst_headers)
+        self.assertEqual([movie['id'] for movie in json.loads(res.data)['movies']], [2])
+        res = self.client().get('/api/search?q=jones', headers=self.asst_headers)
+        self.assertEqual([actor['id'] for actor in json.loads(res.data)['actors']], [2])
+
+    def test_search_ignores_query_syntax(self):
+        res = self.client().get('/api/search?q=%22movie%22%20OR%20*', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_search_without_query(self):
+        res = self.client().get('/api/search?q=%20', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_search_without_token(self):
+        res = self.client().get('/api/search?q=movie')
+        self.assertEqual(res.status_code, 401)
+
+# ---------------------------------------------------------------------------------
+# ---------------------------------- CAST -----------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def cast_movies(self, casting):
+        """Links each movie id to the actor ids it lists"""
+        with self.app.app_context():
+            for movie_id, actor_ids in casting.items():
+                movie = Movie.query.get(movie_id)
+                movie.actors = Actor.query.filter(Actor.id.in_(actor_ids)).all()
+            bump_version('cast')
+            self.db.session.commit()
+
+    def count_queries(self, path, method='get', headers=None, **kwargs):
+        """Returns (response, number of SQL statements the request ran)"""
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = self.db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = getattr(self.client(), method)(path, headers=headers or self.asst_headers, **kwargs)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        return res, len(statements)
+
+    def test_get_movies_include_actors_costs_constant_queries(self):
+        self.cast_movies({1: [1, 2], 2: [3], 3: [1, 2, 3]})
+        res, few = self.count_queries('/api/movies?include=actors&limit=3')
+        body = json.loads(res.data)
+        self.assertEqual([movie['id'] for movie in body['movies']], [1, 2, 3])
+        self.assertEqual([actor['id'] for actor in body['movies'][2]['actors']], [1, 2, 3])
+
+        with self.app.app_context():
+            for index in range(20):
+                movie = Movie(title='Sequel {}'.format(index), year=2020)
+                movie.actors = Actor.query.all()
+                self.db.session.add(movie)
+            self.db.session.commit()
+        res, many = self.count_queries('/api/movies?include=actors&limit=23')
+        self.assertEqual(len(json.loads(res.data)['movies']), 23)
+        # table versions, one page of movies, and their actors
+        self.assertEqual(few, 3)
+        self.assertEqual(many, few)
+
+    def test_get_actors_include_movies_with_fields(self):
+        self.cast_movies({1: [2], 3: [2]})
+        res, queries = self.count_queries('/api/actors?include=movies&fields=name')
+        body = json.loads(res.data)
+        self.assertEqual(body['actors'][1], {
+            'name': 'Cynthia Jones',
+            'movies': [
+                {'id': 1, 'title': 'The Movie', 'year': 2015},
+                {'id': 3, 'title': 'The Movie 3', 'year': 2017}
+            ]
+        })
+        self.assertEqual(body['actors'][0]['movies'], [])
+        self.assertEqual(queries, 3)
+
+    def test_get_movies_include_actors_streamed(self):
+        self.cast_movies({2: [1, 3]})
+        streamed = self.client().get('/api/movies?include=actors&stream=true', headers=self.asst_headers)
+        unpaginated = self.client().get('/api/movies?include=actors&all=true', headers=self.asst_headers)
+        self.assertEqual(json.loads(streamed.data), json.loads(unpaginated.data))
+
+    def test_get_movies_with_invalid_include(self):
+        res = self.client().get('/api/movies?include=movies', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_include_permission_checked_before_304(self):
+        res = self.client().get('/api/movies?include=actors', headers=self.asst_headers)
+        etag = res.headers['ETag']
+        view = requires_include('get:actors')(conditional('movies', 'actors', 'cast')(lambda payload: 'body'))
+        with self.app.test_request_context('/api/movies?include=actors', headers={'If-None-Match': etag}):
+            with self.assertRaises(AuthError):
+                view({'permissions': ['get:movies']})
+            self.assertEqual(view({'permissions': ['get:movies', 'get:actors']}).status_code, 304)
+        with self.app.test_request_context('/api/movies', headers={'If-None-Match': etag}):
+            view({'permissions': ['get:movies']})
+
+    def test_get_movie_actors(self):
+        self.cast_movies({1: [3, 1]})
+        res, queries = self.count_queries('/api/movies/1/actors')
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in body['actors']], ['Sam Jones', 'Vanna White'])
+        self.assertEqual(queries, 3)
+
+    def test_get_actor_movies_follows_writes(self):
+        self.cast_movies({2: [1]})
+        self.client().get('/api/actors/1/movies', headers=self.asst_headers)
+        self.client().patch('/api/movies/2', headers=self.prod_headers, json={
+            'title': 'Casablanca',
+            'year': 1942
+        })
+        res = self.client().get('/api/actors/1/movies', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(body['movies'], [{'id': 2, 'title': 'Casablanca', 'year': 1942}])
+
+    def test_get_movie_actors_for_missing_movie(self):
+        res = self.client().get('/api/movies/1000/actors', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 404)
+
+# ---------------------------------------------------------------------------------
+# ------------------------------- BULK CAST ---------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def cast_of(self, movie_id):
+        res = self.client().get('/api/movies/{}/actors'.format(movie_id), headers=self.asst_headers)
+        return [actor['id'] for actor in json.loads(res.data)['actors']]
+
+    def test_put_movie_actors_replaces_cast(self):
+        self.cast_movies({1: [1, 2]})
+        res = self.client().put('/api/movies/1/actors', headers=self.prod_headers, json={'actors': [2, 3]})
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((body['added'], body['removed']), (1, 1))
+        self.assertEqual(self.cast_of(1), [2, 3])
+
+    def test_post_movie_actors_skips_existing(self):
+        self.cast_movies({1: [1]})
+        self.cast_of(1)
+        res = self.client().post('/api/movies/1/actors', headers=self.dir_headers, json={'actors': [1, 3, 3]})
+        body = json.loads(res.data)
+        self.assertEqual((body['added'], body['removed']), (1, 0))
+        self.assertEqual(self.cast_of(1), [1, 3])
+
+    def test_delete_movie_actors(self):
+        self.cast_movies({2: [1, 2, 3]})
+        res = self.client().delete('/api/movies/2/actors', headers=self.prod_headers, json={'actors': [1, 3, 1000]})
+        body = json.loads(res.data)
+        self.assertEqual((body['added'], body['removed']), (0, 2))
+        self.assertEqual(self.cast_of(2), [2])
+
+    def test_put_movie_actors_with_unknown_actor(self):
+        self.cast_movies({1: [1]})
+        res = self.client().put('/api/movies/1/actors', headers=self.prod_headers, json={'actors': [2, 1000]})
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(self.cast_of(1), [1])
+
+    def test_put_movie_actors_without_list(self):
+        res = self.client().put('/api/movies/1/actors', headers=self.prod_headers, json={'actors': '1,2'})
+        self.assertEqual(res.status_code, 400)
+
+    def test_put_movie_actors_as_assistant(self):
+        res = self.client().put('/api/movies/1/actors', headers=self.asst_headers, json={'actors': [1]})
+        self.assertEqual(res.status_code, 401)
+
+    def test_put_thousands_of_actors_in_a_handful_of_statements(self):
+        with self.app.app_context():
+            self.db.session.execute(Actor.__table__.insert(), [
+                {'name': 'Extra {}'.format(index), 'age': 30, 'gender': 'f'} for index in range(5000)])
+            self.db.session.commit()
+            actor_ids = [row[0] for row in self.db.session.query(Actor.id)]
+        res, statements = self.count_queries(
+            '/api/movies/3/actors', method='put', headers=self.prod_headers, json={'actors': actor_ids})
+        self.assertEqual(json.loads(res.data)['added'], 5003)
+        self.assertLess(statements, 25)
+        res, statements = self.count_queries(
+            '/api/movies/3/actors', method='put', headers=self.prod_headers, json={'actors': actor_ids[:10]})
+        self.assertEqual(json.loads(res.data)['removed'], 4993)
+        self.assertLess(statements, 25)
+        self.assertEqual(len(self.cast_of(3)), 10)
+
+# ---------------------------------------------------------------------------------
+# ------------------------------ CO-STAR GRAPH ------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_get_actor_costars(self):
+        self.cast_movies({1: [1, 2], 2: [1, 2, 3], 3: [3]})
+        res = self.client().get('/api/actors/1/costars', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(actor['name'], actor['shared_movies']) for actor in body['costars']],
+                         [('Cynthia Jones', 2), ('Vanna White', 1)])
+
+    def test_get_actor_costars_skips_actors_deleted_by_another_worker(self):
+        self.cast_movies({1: [1, 2], 2: [1, 2, 3]})
+        self.client().get('/api/actors/1/costars', headers=self.asst_headers)
+        with self.app.app_context():
+            # as seen from a worker whose cast_graph has not caught up yet
+            db.session.execute(Actor.__table__.delete().where(Actor.id == 3))
+            db.session.commit()
+        res = self.client().get('/api/actors/1/costars', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in json.loads(res.data)['costars']], [2])
+
+    def test_get_actor_costars_after_another_worker_reseeds(self):
+        self.client().get('/api/seed?actors=20&movies=10&cast_per_movie=3&seed=1')
+        self.client().get('/api/actors/1/costars?limit=100', headers=self.asst_headers)
+        with self.app.app_context():
+            # the cast version of the new catalog has the same counter as the old one
+            seed_database(actors=20, movies=10, cast_per_movie=3, seed=2)
+            expected = self.db.session.execute(
+                'SELECT SUM(1), b.actor_id FROM "cast" a JOIN "cast" b ON a.movie_id = b.movie_id '
+                'WHERE a.actor_id = 1 AND b.actor_id != 1 GROUP BY b.actor_id ORDER BY 1 DESC, 2').fetchall()
+        res = self.client().get('/api/actors/1/costars?limit=100', headers=self.asst_headers)
+        self.assertEqual([(actor['shared_movies'], actor['id']) for actor in json.loads(res.data)['costars']],
+                         [tuple(row) for row in expected])
+        self.assertEqual(cast_graph.stats()['rebuilds'], 2)
+
+    def test_get_actor_path(self):
+        self.cast_movies({1: [1, 2], 2: [2, 3]})
+        res = self.client().get('/api/actors/1/path/3', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertEqual(body['degrees'], 2)
+        self.assertEqual([actor['id'] for actor in body['actors']], [1, 2, 3])
+        self.assertEqual([movie['id'] for movie in body['movies']], [1, 2])
+
+    def test_get_actor_path_between_strangers(self):
+        self.cast_movies({1: [1, 2]})
+        res = self.client().get('/api/actors/1/path/3', headers=self.asst_headers)
+        body = json.loads(res.data)
+        self.assertIsNone(body['degrees'])
+        res = self.client().get('/api/actors/3/path/3', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['degrees'], 0)
+
+    def test_get_actor_path_for_missing_actor(self):
+        res = self.client().get('/api/actors/1/path/1000', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_cast_graph_follows_writes_without_rebuilding(self):
+        self.cast_movies({1: [1, 2]})
+        self.client().get('/api/actors/1/path/3', headers=self.asst_headers)
+        self.assertEqual(cast_graph.stats()['rebuilds'], 1)
+
+        self.client().put('/api/movies/2/actors', headers=self.prod_headers, json={'actors': [2, 3]})
+        res = self.client().get('/api/actors/1/path/3', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['degrees'], 2)
+
+        self.client().delete('/api/actors/2', headers=self.prod_headers)
+        res = self.client().get('/api/actors/1/path/3', headers=self.asst_headers)
+        self.assertIsNone(json.loads(res.data)['degrees'])
+        stats = cast_graph.stats()
+        self.assertEqual((stats['rebuilds'], stats['deltas']), (1, 2))
+
+    def test_cast_graph_compacts_its_overlay(self):
+        self.cast_movies({1: [1, 2]})
+        cast_graph.max_delta = 2
+        try:
+            self.client().get('/api/actors/1/costars', headers=self.asst_headers)
+            self.client().post('/api/movies/2/actors', headers=self.prod_headers, json={'actors': [2, 3]})
+            res = self.client().get('/api/actors/1/path/3', headers=self.asst_headers)
+            self.assertEqual(json.loads(res.data)['degrees'], 2)
+            self.assertEqual(cast_graph.stats()['compactions'], 1)
+            self.assertEqual(cast_graph.stats()['edges'], 4)
+        finally:
+            cast_graph.max_delta = CastGraph().max_delta
+
+    def test_cast_graph_paths_are_shortest(self):
+        import random
+        from array import array
+        rng = random.Random(7)
+        actors, movies = array('i'), array('i')
+        for movie_id in range(1, 300):
+            for actor_id in rng.sample(range(1, 1000), 3):
+                actors.append(actor_id)
+                movies.append(movie_id)
+        graph = CastGraph()
+        with self.app.app_context():
+            graph._build(0, actors, movies)
+            for source, target in [(rng.randint(1, 999), rng.randint(1, 999)) for _ in range(50)]:
+                # plain breadth first search from source
+                depths = {source: 0}
+                queue = [source]
+                for actor_id in queue:
+                    for movie_id in graph.movies_of(graph._state, actor_id):
+                        for costar_id in graph.actors_of(graph._state, movie_id):
+                            if costar_id not in depths:
+                                depths[costar_id] = depths[actor_id] + 1
+                                queue.append(costar_id)
+                chain = graph.path(source, target)
+                if target not in depths:
+                    self.assertIsNone(chain)
+                    continue
+                self.assertEqual((len(chain) - 1) // 2, depths[target])
+                for index in range(1, len(chain), 2):
+                    self.assertIn(chain[index - 1], graph.actors_of(graph._state, chain[index]))
+                    self.assertIn(chain[index + 1], graph.actors_of(graph._state, chain[index]))
+
+# ---------------------------------------------------------------------------------
+# ------------------------------ BULK CREATE --------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_post_movies_bulk(self):
+        res = self.client().post('/api/movies/bulk', headers=self.prod_headers, json={'movies': [
+            {'title': 'Sequel', 'year': 2019},
+            {'title': 'Prequel', 'year': 2012}
+        ]})
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(movie['id'], movie['title']) for movie in body['movies']], [(4, 'Sequel'), (5, 'Prequel')])
+        res = self.client().get('/api/movies?year_max=2012', headers=self.asst_headers)
+        self.assertEqual([movie['title'] for movie in json.loads(res.data)['movies']], ['Prequel'])
+
+    def test_post_actors_bulk_in_a_handful_of_statements(self):
+        actors = [{'name': 'Extra {}'.format(index), 'age': 30, 'gender': 'm'} for index in range(3000)]
+        res, statements = self.count_queries(
+            '/api/actors/bulk', method='post', headers=self.dir_headers, json={'actors': actors})
+        body = json.loads(res.data)
+        self.assertEqual(len(body['actors']), 3000)
+        self.assertEqual(body['actors'][-1], {'id': 3003, 'name': 'Extra 2999', 'age': 30, 'gender': 'm'})
+        with self.app.app_context():
+            if self.db.engine.dialect.name == 'postgresql':
+                self.assertLess(statements, 10)
+
+    def test_post_movies_bulk_reports_every_invalid_item(self):
+        res = self.client().post('/api/movies/bulk', headers=self.prod_headers, json={'movies': [
+            {'title': 'Fine', 'year': 2019},
+            {'title': 'No year'},
+            {'title': 7, 'year': '2019', 'budget': 1},
+            'not a movie'
+        ]})
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(body['errors'], [
+            {'index': 1, 'errors': {'year': 'is required'}},
+            {'index': 2, 'errors': {
+                'title': 'must be a string', 'year': 'must be an integer', 'budget': 'is not a field of movies'}},
+            {'index': 3, 'errors': {'item': 'must be an object'}}
+        ])
+        res = self.client().get('/api/movies', headers=self.asst_headers)
+        self.assertEqual(len(json.loads(res.data)['movies']), 3)
+
+    def test_post_movies_bulk_without_list(self):
+        res = self.client().post('/api/movies/bulk', headers=self.prod_headers, json={'movies': []})
+        self.assertEqual(res.status_code, 400)
+
+    def test_post_movies_bulk_as_director(self):
+        res = self.client().post('/api/movies/bulk', headers=self.dir_headers, json={'movies': [
+            {'title': 'Sequel', 'year': 2019}
+        ]})
+        self.assertEqual(res.status_code, 401)
+
+# ---------------------------------------------------------------------------------
+# -------------------------- BULK UPDATE AND DELETE -------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_patch_movies_bulk_by_ids(self):
+        self.client().get('/api/movies/1', headers=self.asst_headers)
+        res = self.client().patch('/api/movies/bulk', headers=self.prod_headers, json={
+            'ids': [3, 1, 1000],
+            'set': {'year': 1999}
+        })
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(body['updated'], [1, 3])
+        res = self.client().get('/api/movies/1', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['movie']['year'], 1999)
+        res = self.client().get('/api/movies?year=1999&fields=id', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['movies'], [{'id': 1}, {'id': 3}])
+
+    def test_patch_actors_bulk_by_filter(self):
+        res = self.client().patch('/api/actors/bulk?gender=f&age_max=30', headers=self.dir_headers, json={
+            'set': {'age': 23}
+        })
+        self.assertEqual(json.loads(res.data)['updated'], [2])
+
+    def test_patch_actors_bulk_with_invalid_values(self):
+        res = self.client().patch('/api/actors/bulk', headers=self.dir_headers, json={
+            'ids': [1],
+            'set': {'age': 'old', 'height': 180}
+        })
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(body['errors'], {'age': 'must be an integer', 'height': 'is not a field of actors'})
+
+    def test_delete_movies_bulk_by_filter_removes_cast(self):
+        self.cast_movies({1: [1, 2], 2: [2], 3: [3]})
+        self.client().get('/api/actors/2/movies', headers=self.asst_headers)
+        res, statements = self.count_queries(
+            '/api/movies/bulk?year_max=2016', method='delete', headers=self.prod_headers)
+        body = json.loads(res.data)
+        self.assertEqual(body['deleted'], [1, 2])
+        res = self.client().get('/api/actors/2/movies', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['movies'], [])
+        res = self.client().get('/api/actors/1/path/3', headers=self.asst_headers)
+        self.assertIsNone(json.loads(res.data)['degrees'])
+        self.assertLess(statements, 10)
+
+    def test_delete_actors_bulk_by_ids_and_filter(self):
+        self.cast_movies({1: [1, 2, 3]})
+        res = self.client().delete('/api/actors/bulk?gender=f', headers=self.prod_headers, json={'ids': [1, 2]})
+        self.assertEqual(json.loads(res.data)['deleted'], [2])
+        self.assertEqual(self.cast_of(1), [1, 3])
+
+    def test_delete_movies_bulk_many_ids_drops_cached_items(self):
+        self.client().get('/api/movies/2', headers=self.asst_headers)
+        with self.app.app_context():
+            self.db.session.execute(Movie.__table__.insert(), [
+                {'title': 'Extra {}'.format(index), 'year': 2000} for index in range(2000)])
+            self.db.session.commit()
+        res = self.client().delete('/api/movies/bulk', headers=self.prod_headers, json={
+            'ids': list(range(2, 2003))
+        })
+        self.assertEqual(len(json.loads(res.data)['deleted']), 2001)
+        res = self.client().get('/api/movies/2', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_delete_movies_bulk_without_target(self):
+        res = self.client().delete('/api/movies/bulk?unknown=1', headers=self.prod_headers)
+        self.assertEqual(res.status_code, 400)
+
+# ---------------------------------------------------------------------------------
+# ---------------------------------- BATCH ----------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_batch_returns_each_operation_result(self):
+        self.client().get('/api/movies/1', headers=self.asst_headers)
+        res = self.client().post('/api/batch', headers=self.prod_headers, json={'operations': [
+            {'method': 'PATCH', 'path': '/api/movies/1', 'body': {'title': 'Renamed'}},
+            {'method': 'GET', 'path': '/api/movies/1'},
+            {'method': 'GET', 'path': '/api/movies/1000'},
+            {'method': 'GET', 'path': '/api/movies?fields=id&limit=2'},
+        ]})
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['status'] for result in body['results']], [200, 200, 404, 200])
+        self.assertEqual(body['results'][1]['body']['movie']['title'], 'Renamed')
+        self.assertEqual(body['results'][3]['body']['movies'], [{'id': 1}, {'id': 2}])
+
+    def test_batch_verifies_token_once(self):
+        before = token_cache.stats()
+        res = self.client().post('/api/batch', headers=self.asst_headers, json={'operations': [
+            {'method': 'GET', 'path': '/api/movies/1'},
+            {'method': 'GET', 'path': '/api/actors/1'},
+            {'method': 'GET', 'path': '/api/actors'},
+        ]})
+        after = token_cache.stats()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(after['hits'] + after['misses'] - before['hits'] - before['misses'], 1)
+
+    def test_batch_checks_each_operation_permissions(self):
+        res = self.client().post('/api/batch', headers=self.asst_headers, json={'operations': [
+            {'method': 'GET', 'path': '/api/movies/1'},
+            {'method': 'DELETE', 'path': '/api/movies/1'},
+            {'method': 'POST', 'path': '/api/batch', 'body': {'operations': []}},
+        ]})
+        body = json.loads(res.data)
+        self.assertEqual([result['status'] for result in body['results']], [200, 401, 400])
+
+    def test_atomic_batch_rolls_back_on_failure(self):
+        res = self.client().post('/api/batch', headers=self.prod_headers, json={'atomic': True, 'operations': [
+            {'method': 'POST', 'path': '/api/movies', 'body': {'title': 'Kept?', 'year': 2020}},
+            {'method': 'PATCH', 'path': '/api/movies/1', 'body': {'year': 1999}},
+            {'method': 'DELETE', 'path': '/api/actors/1000'},
+            {'method': 'DELETE', 'path': '/api/actors/1'},
+        ]})
+        body = json.loads(res.data)
+        self.assertFalse(body['committed'])
+        self.assertEqual([result['status'] for result in body['results']], [200, 200, 404, 424])
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 3)
+            self.assertEqual(Movie.query.get(1).year, 2015)
+            self.assertIsNotNone(Actor.query.get(1))
+
+    def test_atomic_batch_commits_and_invalidates_once_done(self):
+        self.client().get('/api/movies?fields=id', headers=self.asst_headers)
+        res = self.client().post('/api/batch', headers=self.prod_headers, json={'atomic': True, 'operations': [
+            {'method': 'POST', 'path': '/api/movies', 'body': {'title': 'Sequel', 'year': 2020}},
+            {'method': 'PUT', 'path': '/api/movies/4/actors', 'body': {'actors': [1, 2]}},
+            {'method': 'GET', 'path': '/api/movies/4/actors'},
+        ]})
+        body = json.loads(res.data)
+        self.assertTrue(body['committed'])
+        self.assertEqual([actor['id'] for actor in body['results'][2]['body']['actors']], [1, 2])
+        res = self.client().get('/api/movies?fields=id', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['movies'][-1], {'id': 4})
+        res = self.client().get('/api/actors/1/costars', headers=self.asst_headers)
+        self.assertEqual([actor['id'] for actor in json.loads(res.data)['costars']], [2])
+
+    def test_atomic_batch_rows_are_in_the_database_after_commit(self):
+        res = self.client().post('/api/batch', headers=self.prod_headers, json={'atomic': True, 'operations': [
+            {'method': 'POST', 'path': '/api/movies', 'body': {'title': 'Sequel', 'year': 2020}},
+            {'method': 'PATCH', 'path': '/api/movies/1', 'body': {'title': 'Renamed', 'year': 2016}},
+        ]})
+        body = json.loads(res.data)
+        self.assertTrue(body['committed'])
+        self.assertEqual([result['status'] for result in body['results']], [200, 200])
+        with self.app.app_context():
+            self.assertEqual(Movie.query.filter_by(title='Sequel').count(), 1)
+            self.assertEqual(Movie.query.get(1).title, 'Renamed')
+
+    def test_batch_rejects_too_many_operations(self):
+        res = self.client().post('/api/batch', headers=self.prod_headers, json={'operations': [
+            {'method': 'GET', 'path': '/api/movies/1'}] * (BATCH_MAX_OPERATIONS + 1)})
+        self.assertEqual(res.status_code, 400)
+
+# ---------------------------------------------------------------------------------
+# ------------------------------- IDEMPOTENCY -------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_post_movie_replays_repeated_idempotency_key(self):
+        headers = dict(self.prod_headers, **{'Idempotency-Key': 'retry-1'})
+        first = self.client().post('/api/movies', headers=headers, json={'title': 'Once', 'year': 2020})
+        second = self.client().post('/api/movies', headers=headers, json={'title': 'Once', 'year': 2020})
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.filter(Movie.title == 'Once').count(), 1)
+        self.assertEqual(idempotency_store.stats()['replays'], 1)
+
+    def test_post_actor_without_idempotency_key_is_not_deduplicated(self):
+        actor = {'name': 'Twice', 'age': 30, 'gender': 'f'}
+        self.client().post('/api/actors', headers=self.dir_headers, json=actor)
+        self.client().post('/api/actors', headers=self.dir_headers, json=actor)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.filter(Actor.name == 'Twice').count(), 2)
+
+    def test_idempotency_key_reused_for_another_request(self):
+        headers = dict(self.prod_headers, **{'Idempotency-Key': 'retry-2'})
+        self.client().post('/api/movies', headers=headers, json={'title': 'First', 'year': 2020})
+        res = self.client().post('/api/movies', headers=headers, json={'title': 'Second', 'year': 2020})
+        self.assertEqual(res.status_code, 422)
+
+    def test_idempotency_key_is_released_after_a_failure(self):
+        headers = dict(self.prod_headers, **{'Idempotency-Key': 'retry-3'})
+        res = self.client().post('/api/movies/bulk', headers=headers, json={'movies': [{'title': 'No year'}]})
+        self.assertEqual(res.status_code, 422)
+        res = self.client().post('/api/movies/bulk', headers=headers, json={'movies': [{'title': 'No year'}]})
+        self.assertEqual(res.status_code, 422)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def test_idempotency_key_is_released_when_an_atomic_batch_rolls_back(self):
+        view = idempotent(lambda payload: jsonify({'success': True, 'created': 4}))
+        headers = {'Idempotency-Key': 'retry-4'}
+        for committed in (False, True):
+            with self.app.test_request_context('/api/movies', method='POST', headers=headers, json={}):
+                g.atomic_batch, g.atomic_rollback = [], []
+                # the second run gets the key the rolled back one released
+                response = view({'sub': 'producer'})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn('Idempotent-Replayed', response.headers)
+                key = idempotency_store.key(request.endpoint, 'producer', 'retry-4')
+                # nothing kept before the batch is over
+                self.assertRaises(KeyInFlight, idempotency_store.backend.claim, key, 'fingerprint', 0)
+                callbacks = g.atomic_batch if committed else g.atomic_rollback
+                g.atomic_batch = g.atomic_rollback = None
+                for callback, args, kwargs in callbacks:
+                    callback(*args, **kwargs)
+        # the rolled back response was never replayable, the committed one is
+        stored = idempotency_store.backend.claim(key, 'fingerprint', 0)
+        self.assertEqual(stored.status, 200)
+
+    def test_idempotency_backends_make_duplicates_wait(self):
+        for backend in (MemoryIdempotencyBackend(), DatabaseIdempotencyBackend(poll_interval=0.01)):
+            with self.app.app_context():
+                self.assertIsNone(backend.claim('key', 'print', wait=1))
+                with self.assertRaises(KeyInFlight):
+                    backend.claim('key', 'print', wait=0.05)
+            stored = StoredResponse('print', 200, 'application/json', b'{}')
+            replayed = []
+
+            def retry():
+                with self.app.app_context():
+                    replayed.append(backend.claim('key', 'print', wait=5))
+
+            waiter = threading.Thread(target=retry)
+            waiter.start()
+            time.sleep(0.1)
+            with self.app.app_context():
+                backend.complete('key', stored)
+            waiter.join()
+            self.assertEqual(replayed, [stored])
+
+    def test_idempotency_backends_sweep_expired_entries(self):
+        for backend in (MemoryIdempotencyBackend(ttl=0), DatabaseIdempotencyBackend(ttl=0)):
+            with self.app.app_context():
+                backend.claim('key', 'print', wait=0)
+                backend.complete('key', StoredResponse('print', 200, 'application/json', b'{}'))
+                self.assertEqual(backend.sweep(), 1)
+                self.assertIsNone(backend.claim('key', 'print', wait=0))
+
+# ---------------------------------------------------------------------------------
+# --------------------------------- IMPORT ----------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_import_movies_csv_reports_rejected_lines(self):
+        self.client().get('/api/movies?fields=id', headers=self.asst_headers)
+        body = b'title,year\nImported One,1999\nNo Year,\n"Imported, Two",2001\nBad Year,soon\n'
+        res = self.client().post('/api/import/movies', headers=self.prod_headers,
+                                 data=body, content_type='text/csv')
+        report = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((report['read'], report['imported'], report['rejected']), (4, 2, 2))
+        self.assertEqual(report['rejections'], [
+            {'line': 3, 'reason': 'year is required'},
+            {'line': 5, 'reason': 'year must be an integer'},
+        ])
+        res = self.client().get('/api/movies?fields=title&limit=10', headers=self.asst_headers)
+        titles = [movie['title'] for movie in json.loads(res.data)['movies']]
+        self.assertEqual(titles[-2:], ['Imported One', 'Imported, Two'])
+
+    def test_import_actors_ndjson(self):
+        body = b'{"name": "Nd One", "age": 40, "gender": "f"}\n\nnot json\n{"name": "Nd Two", "age": "41", "gender": "m"}\n'
+        res = self.client().post('/api/import/actors?format=ndjson', headers=self.dir_headers, data=body)
+        report = json.loads(res.data)
+        self.assertEqual((report['imported'], report['rejected']), (2, 1))
+        self.assertEqual(report['rejections'], [{'line': 3, 'reason': 'is not valid json'}])
+        with self.app.app_context():
+            self.assertEqual(Actor.query.filter(Actor.name.like('Nd %')).count(), 2)
+
+    def test_import_cast_resolves_ids_in_bulk(self):
+        self.cast_movies({1: [1]})
+        body = b'movie_id,actor_id\n1,1\n1,2\n2,3\n9,1\n2,9\n'
+        res, statements = self.count_queries('/api/import/cast', method='post', headers=self.prod_headers,
+                                             data=body, content_type='text/csv')
+        report = json.loads(res.data)
+        self.assertEqual((report['imported'], report['rejected']), (2, 2))
+        self.assertLess(statements, 10)
+        self.assertEqual(self.cast_of(1), [1, 2])
+        res = self.client().get('/api/actors/2/costars', headers=self.asst_headers)
+        self.assertEqual([actor['id'] for actor in json.loads(res.data)['costars']], [1])
+
+    def test_import_requires_a_known_format(self):
+        res = self.client().post('/api/import/movies', headers=self.prod_headers, data=b'title,year\n')
+        self.assertEqual(res.status_code, 400)
+
+    def test_import_requires_permission(self):
+        res = self.client().post('/api/import/movies', headers=self.dir_headers,
+                                 data=b'title,year\nX,2000\n', content_type='text/csv')
+        self.assertEqual(res.status_code, 401)
+
+    def test_import_catalog_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'movies.ndjson')
+        with open(path, 'w') as source:
+            for index in range(12):
+                source.write(json.dumps({'title': 'Cli {}'.format(index), 'year': 2000 + index}) + '\n')
+            source.write('{"title": "Cli without year"}\n')
+        result = self.app.test_cli_runner().invoke(args=['import-catalog', 'movies', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('imported 12 of 13 movies rows', result.output)
+        self.assertIn('1 rejected', result.output)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.filter(Movie.title.like('Cli %')).count(), 12)
+
+# ---------------------------------------------------------------------------------
+# --------------------------------- EXPORT ----------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_export_movies_csv(self):
+        res = self.client().get('/api/export/movies', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertTrue(res.is_streamed)
+        self.assertIn('movies.csv', res.headers['Content-Disposition'])
+        self.assertEqual(res.data.decode('utf-8').splitlines(), [
+            'id,title,year', '1,The Movie,2015', '2,The Movie 2,2016', '3,The Movie 3,2017'])
+
+    def test_export_actors_ndjson_gzipped(self):
+        res = self.client().get('/api/export/actors?format=ndjson', headers=dict(
+            self.asst_headers, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(res.data).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines][0],
+                         {'id': 1, 'name': 'Sam Jones', 'age': 25, 'gender': 'm'})
+        self.assertEqual(len(lines), 3)
+
+    def test_export_cast_can_be_imported_back(self):
+        self.cast_movies({1: [1, 2], 3: [3]})
+        res = self.client().get('/api/export/cast', headers=self.asst_headers)
+        self.assertEqual(res.data.decode('utf-8').splitlines(), ['movie_id,actor_id', '1,1', '1,2', '3,3'])
+        res = self.client().post('/api/import/cast', headers=self.prod_headers,
+                                 data=res.data, content_type='text/csv')
+        self.assertEqual(json.loads(res.data)['imported'], 0)
+
+    def test_export_answers_if_none_match(self):
+        res = self.client().get('/api/export/movies', headers=self.asst_headers)
+        res = self.client().get('/api/export/movies', headers=dict(
+            self.asst_headers, **{'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_export_rejects_unknown_format(self):
+        res = self.client().get('/api/export/movies?format=xml', headers=self.asst_headers)
+        self.assertEqual(res.status_code, 400)
+
+# ---------------------------------------------------------------------------------
+# ---------------------------------- SEED -----------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_seed_generates_requested_catalog(self):
+        self.client().get('/api/movies', headers=self.asst_headers)
+        res = self.client().get('/api/seed?actors=40&movies=30&cast_per_movie=4&seed=7')
+        body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((body['actors'], body['movies']), (40, 30))
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 40)
+            self.assertEqual(self.db.session.execute('SELECT COUNT(*) FROM "cast"').scalar(), body['cast'])
+        self.assertTrue(60 <= body['cast'] <= 180)
+        res = self.client().get('/api/movies?all=true', headers=self.asst_headers)
+        self.assertEqual(len(json.loads(res.data)['movies']), 30)
+        res = self.client().post('/api/movies', headers=self.prod_headers, json={'title': 'After seed', 'year': 2020})
+        self.assertEqual(json.loads(res.data)['movie']['id'], 31)
+
+    def test_seed_is_deterministic(self):
+        snapshots = []
+        for _ in range(2):
+            self.client().get('/api/seed?actors=20&movies=10&cast_per_movie=3&seed=11')
+            snapshots.append(self.client().get('/api/export/cast', headers=self.asst_headers).data
+                             + self.client().get('/api/export/actors', headers=self.asst_headers).data)
+        self.client().get('/api/seed?actors=20&movies=10&cast_per_movie=3&seed=12')
+        other = self.client().get('/api/export/cast', headers=self.asst_headers).data
+        self.assertEqual(snapshots[0], snapshots[1])
+        self.assertNotEqual(snapshots[0].split(b'id,name')[0], other)
+
+    def test_reseed_changes_etag(self):
+        self.client().get('/api/seed?actors=20&movies=10&cast_per_movie=3&seed=1')
+        res = self.client().get('/api/movies', headers=self.asst_headers)
+        headers = dict(self.asst_headers, **{'If-None-Match': res.headers['ETag']})
+        self.client().get('/api/seed?actors=20&movies=10&cast_per_movie=3&seed=2')
+        res = self.client().get('/api/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_reseed_drops_cached_items(self):
+        self.client().get('/api/seed?actors=20&movies=10&cast_per_movie=3&seed=1')
+        before = json.loads(self.client().get('/api/movies/1', headers=self.asst_headers).data)['movie']
+        self.client().get('/api/seed?actors=20&movies=10&cast_per_movie=3&seed=2')
+        after = json.loads(self.client().get('/api/movies/1', headers=self.asst_headers).data)['movie']
+        with self.app.app_context():
+            self.assertEqual(after['title'], Movie.query.get(1).title)
+        self.assertNotEqual(before['title'], after['title'])
+
+    def test_seed_caps_public_catalog_size(self):
+        res = self.client().get('/api/seed?actors=10&movies=100000&cast_per_movie=10')
+        self.assertEqual(res.status_code, 400)
+        res = self.client().get('/api/seed?actors=many')
+        self.assertEqual(res.status_code, 400)
+
+    def test_seed_only_in_development(self):
+        environment = os.environ.get('ENV')
+        os.environ['ENV'] = 'prod'
+        try:
+            res = self.client().get('/api/seed?actors=1&movies=1')
+        finally:
+            os.environ['ENV'] = environment
+        self.assertEqual(res.status_code, 404)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 3)
+
+    def test_seed_command(self):
+        result = self.app.test_cli_runner().invoke(args=[
+            'seed', '--actors', '50', '--movies', '25', '--cast-per-movie', '2', '--seed', '3'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('seeded 50 actors, 25 movies', result.output)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 25)
+
+# ---------------------------------------------------------------------------------
+# ------------------------------ CORE READ PATH -----------------------------------
+# ---------------------------------------------------------------------------------
+
+    def count_instances(self, path):
+        """Returns (response, number of ORM instances the request loaded)"""
+        loaded = []
+
+        def count(target, context):
+            loaded.append(target)
+
+        for model in (Movie, Actor):
+            event.listen(model, 'load', count)
+        try:
+            res = self.client().get(path, headers=self.asst_headers)
+        finally:
+            for model in (Movie, Actor):
+                event.remove(model, 'load', count)
+        return res, len(loaded)
+
+    def test_reads_build_no_orm_instances(self):
+        for path in ('/api/movies', '/api/actors?all=true', '/api/movies?stream=true&sort=-year',
+                     '/api/movies/2', '/api/actors/3'):
+            res, loaded = self.count_instances(path)
+            self.assertEqual(res.status_code, 200, path)
+            self.assertEqual(loaded, 0, path)
+        res = self.client().get('/api/actors/3', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['actor'], {'id': 3, 'name': 'Vanna White', 'age': 32, 'gender': 'f'})
+        res = self.client().get('/api/movies?limit=1', headers=self.asst_headers)
+        self.assertEqual(json.loads(res.data)['movies'], [{'id': 1, 'title': 'The Movie', 'year': 2015}])
+
+    def test_item_select_is_compiled_once(self):
+        response_cache.backend = None
+        try:
+            self.client().get('/api/movies/1', headers=self.asst_headers)
+            compiled = len(COMPILED_CACHE)
+            for movie_id in (2, 3, 1000):
+                self.client().get('/api/movies/{}'.format(movie_id), headers=self.asst_headers)
+            self.assertEqual(len(COMPILED_CACHE), compiled)
+        finally:
+            response_cache.backend = MemoryBackend()
+
+# ---------------------------------------------------------------------------------
+# ------------------------------ ROW FRAGMENTS ------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_list_reuses_encoded_rows(self):
+        response_cache.backend = None
+        try:
+            first = self.client().get('/api/movies?limit=2', headers=self.asst_headers)
+            size = row_fragments.stats()['size']
+            hits = row_fragments.stats()['hits']
+            again = self.client().get('/api/movies?all=true&sort=-year', headers=self.asst_headers)
+            self.assertEqual(row_fragments.stats()['size'], size + 1)
+            self.assertEqual(row_fragments.stats()['hits'], hits + 2)
+            self.assertEqual(first.status_code, 200)
+            body = json.loads(again.data)
+            self.assertEqual(body, {'success': True, 'movies': sorted(
+                body['movies'], key=lambda movie: (-movie['year'], -movie['id']))})
+        finally:
+            response_cache.backend = MemoryBackend()
+
+    def test_list_reencodes_rows_after_a_write(self):
+        response_cache.backend = None
+        try:
+            self.client().get('/api/movies', headers=self.asst_headers)
+            res = self.client().patch('/api/movies/2', headers=self.prod_headers, json={
+                'title': 'Renamed',
+                'year': 2018
+            })
+            self.assertEqual(res.status_code, 200)
+            res = self.client().get('/api/movies', headers=self.asst_headers)
+            titles = dict((movie['id'], movie['title']) for movie in json.loads(res.data)['movies'])
+            self.assertEqual(titles[2], 'Renamed')
+        finally:
+            response_cache.backend = MemoryBackend()
+
+    def test_sparse_lists_skip_fragments(self):
+        self.client().get('/api/movies?fields=id,title', headers=self.asst_headers)
+        self.client().get('/api/movies?include=actors', headers=self.prod_headers)
+        self.assertEqual(row_fragments.stats()['size'], 0)
+
+    def test_envelope_matches_jsonify(self):
+        from flask import Flask, jsonify
+        import rendering
+        original = rendering.json_encoder
+        rendering.json_encoder = StdlibEncoder()
+        try:
+            items = [{'id': 1, 'title': 'The Movie', 'year': 2015}]
+            # a production app: jsonify only indents in debug mode
+            with Flask(__name__).app_context():
+                for key in ('movies', 'zebras'):
+                    expected = jsonify({'success': True, key: items, 'limit': 1, 'next_cursor': None})
+                    response = rendering.envelope_response(
+                        key, rendering.json_encoder.dumps(items), limit=1, next_cursor=None)
+                    self.assertEqual(response.get_data(), expected.get_data())
+        finally:
+            rendering.json_encoder = original
+
+    def test_encoders_agree(self):
+        try:
+            import orjson
+        except ImportError:
+            self.skipTest('orjson is not installed')
+        fast = OrjsonEncoder(orjson)
+        for value in ({'year': 2015, 'title': 'The Movie', 'id': 1}, {'name': 'Zoë', 'age': None},
+                      {'big': 2 ** 70}, ['a', 1, True]):
+            self.assertEqual(json.loads(fast.dumps(value)), json.loads(StdlibEncoder().dumps(value)))
+        self.assertEqual(fast.dumps({'b': 1, 'a': 2}), StdlibEncoder().dumps({'b': 1, 'a': 2}))
+
 if __name__ == '__main__':
     unittest.main()
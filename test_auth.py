@@ -0,0 +1,454 @@
+import os
+import json
+import base64
+import time
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from Crypto.PublicKey import RSA
+from jose import jwt
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# the auth module reads its configuration on import
+os.environ.setdefault('AUTH0_DOMAIN', 'test.local')
+os.environ.setdefault('AUTH0_ALGORITHMS', 'RS256')
+os.environ.setdefault('AUTH0_AUDIENCE', 'casting')
+
+import auth  # noqa: E402
+from jwks import JWKSCache, JWKSUnavailable  # noqa: E402
+from cache import LRUCache  # noqa: E402
+
+
+def b64_uint(value):
+    """Encode an RSA integer as unpadded base64url, as JWKs expect"""
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def make_keypair(kid):
+    """Generate a local RSA keypair, returns (private pem, public jwk)"""
+    private_key = RSA.generate(2048)
+    public_jwk = {
+        'kty': 'RSA',
+        'kid': kid,
+        'use': 'sig',
+        'alg': 'RS256',
+        'n': b64_uint(private_key.n),
+        'e': b64_uint(private_key.e),
+    }
+    return private_key.exportKey().decode(), public_jwk
+
+
+def make_token(private_pem, kid, expires_in=3600, **claims):
+    """Sign a token the way Auth0 would for this API"""
+    now = int(time.time())
+    payload = {
+        'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+        'aud': auth.AUTH0_AUDIENCE,
+        'sub': 'auth0|tester',
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': ['get:movies', 'get:actors'],
+    }
+    payload.update(claims)
+    return jwt.encode(payload, private_pem, algorithm='RS256', headers={'kid': kid})
+
+
+class JWKSServer(object):
+    """Local stand-in for the Auth0 /.well-known/jwks.json endpoint"""
+
+    def __init__(self, keys, delay=0):
+        self.keys = keys
+        self.delay = delay
+        self.status = 200
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.delay)
+                if server.status != 200:
+                    self.send_error(server.status)
+                    return
+                body = json.dumps({'keys': server.keys}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/.well-known/jwks.json'.format(
+            self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+class FakeClock(object):
+    """Monotonic clock that only moves when the test says so"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class AuthTestCase(unittest.TestCase):
+    """ Represents the auth test case """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.public_jwk = make_keypair('key-1')
+        cls.rotated_pem, cls.rotated_jwk = make_keypair('key-2')
+
+    def setUp(self):
+        self.server = JWKSServer([self.public_jwk])
+        self.clock = FakeClock()
+        self.cache = JWKSCache(
+            self.server.url, ttl=600, min_refetch_interval=5, clock=self.clock)
+        self.original_cache = auth.jwks_cache
+        self.original_token_cache = auth.token_cache
+        auth.jwks_cache = self.cache
+        auth.token_cache = LRUCache(maxsize=4)
+        auth.rejected_token_cache.clear()
+        auth.rejections_by_code.clear()
+
+    def tearDown(self):
+        auth.jwks_cache = self.original_cache
+        auth.token_cache = self.original_token_cache
+        self.server.stop()
+
+# ---------------------------------------------------------------------------------
+# ------------------------------- JWKS CACHE --------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_jwks_fetched_once_within_ttl(self):
+        for _ in range(5):
+            self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        stats = self.cache.stats()
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 4)
+
+    def test_jwks_refetched_after_ttl(self):
+        self.cache.get_key('key-1')
+        self.clock.now += 601
+        self.cache.get_key('key-1')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_jwks_refetched_for_unknown_kid(self):
+        self.cache.get_key('key-1')
+        self.server.keys = [self.public_jwk, self.rotated_jwk]
+        self.clock.now += 10
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_jwks_unknown_kid_refetch_is_rate_limited(self):
+        self.cache.get_key('key-1')
+        for _ in range(10):
+            self.assertIsNone(self.cache.get_key('made-up'))
+        self.assertEqual(self.server.requests, 1)
+
+    def test_jwks_concurrent_refetches_collapse(self):
+        self.server.delay = 0.2
+        threads = [
+            threading.Thread(target=self.cache.get_key, args=('key-1',))
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(self.cache.stats()['refreshes'], 1)
+
+    def test_jwks_concurrent_misses_share_a_failed_refetch(self):
+        self.server.delay = 0.2
+        self.server.status = 503
+        outcomes = []
+
+        def lookup():
+            try:
+                outcomes.append(self.cache.get_key('key-1'))
+            except JWKSUnavailable as error:
+                outcomes.append(error)
+
+        threads = [threading.Thread(target=lookup) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the threads queued behind the failed refetch don't each try again
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(self.cache.stats()['refresh_errors'], 1)
+        self.assertEqual(len([outcome for outcome in outcomes if isinstance(outcome, JWKSUnavailable)]), 10)
+        self.clock.now += 5
+        self.server.status = 200
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+
+    def test_verify_decode_jwt_uses_cache(self):
+        token = make_token(self.private_pem, 'key-1')
+        for _ in range(3):
+            payload = auth.verify_decode_jwt(token)
+            self.assertEqual(payload['sub'], 'auth0|tester')
+        self.assertEqual(self.server.requests, 1)
+
+    def test_verify_decode_jwt_with_unknown_kid(self):
+        token = make_token(self.rotated_pem, 'key-2')
+        with self.assertRaises(auth.AuthError) as context:
+            auth.verify_decode_jwt(token)
+        self.assertEqual(context.exception.error['code'], 'invalid_header')
+
+    def test_signing_keys_prepared_once_per_key_set(self):
+        signing_key = self.cache.get_signing_key('key-1')
+        self.assertIsNotNone(signing_key)
+        self.clock.now += 601
+        self.assertIs(self.cache.get_signing_key('key-1'), signing_key)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_verify_decode_jwt_rejects_tampered_signature(self):
+        token = make_token(self.private_pem, 'key-1')
+        forged = make_token(self.rotated_pem, 'key-1')
+        tampered = token.rsplit('.', 1)[0] + '.' + forged.rsplit('.', 1)[1]
+        with self.assertRaises(auth.AuthError) as context:
+            auth.verify_decode_jwt(tampered)
+        self.assertEqual(context.exception.error['code'], 'invalid_header')
+
+    def test_verify_decode_jwt_rejects_expired_token(self):
+        token = make_token(self.private_pem, 'key-1', expires_in=-60)
+        with self.assertRaises(auth.AuthError) as context:
+            auth.verify_decode_jwt(token)
+        self.assertEqual(context.exception.error['code'], 'token_expired')
+
+    def test_jwks_failed_refetch_keeps_last_good_keys(self):
+        self.cache.get_key('key-1')
+        self.server.stop()
+        self.clock.now += 601
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.cache.stats()['refresh_errors'], 1)
+        self.assertIsNotNone(self.cache.stats()['last_error'])
+
+    def test_verify_decode_jwt_without_any_key_set(self):
+        self.server.stop()
+        token = make_token(self.private_pem, 'key-1')
+        with self.assertRaises(auth.AuthError) as context:
+            auth.verify_decode_jwt(token)
+        self.assertEqual(context.exception.error['code'], 'jwks_unavailable')
+        self.assertEqual(context.exception.status_code, 503)
+
+# ---------------------------------------------------------------------------------
+# --------------------------- BACKGROUND REFRESHER --------------------------------
+# ---------------------------------------------------------------------------------
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_refresher_renews_keys_before_ttl(self):
+        cache = JWKSCache(self.server.url, ttl=0.3)
+        cache.start_refresher()
+        self.addCleanup(cache.stop_refresher)
+        self.assertTrue(self.wait_for(lambda: self.server.requests >= 3))
+        # requests were never the ones going to the network
+        self.assertEqual(cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def test_refresher_serves_stale_keys_while_idp_is_down(self):
+        cache = JWKSCache(
+            self.server.url, ttl=0.3, stale_window=60, min_backoff=0.01, max_backoff=0.05)
+        cache.start_refresher()
+        self.addCleanup(cache.stop_refresher)
+        self.assertTrue(self.wait_for(lambda: cache.stats()['refreshes'] == 1))
+        # the IdP goes away and the TTL runs out
+        self.server.stop()
+        self.assertTrue(self.wait_for(lambda: cache.stats()['refresh_errors'] >= 2))
+        time.sleep(0.3)
+        self.assertEqual(cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(cache.stats()['stale_hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def test_stale_keys_served_within_the_stale_window_while_idp_is_down(self):
+        cache = JWKSCache(self.server.url, ttl=600, stale_window=60, min_refetch_interval=5, clock=self.clock)
+        cache.get_key('key-1')
+        self.server.stop()
+        # no refresher, past the TTL but within the stale window
+        self.clock.now += 620
+        for _ in range(5):
+            self.assertEqual(cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(cache.stats()['refresh_errors'], 1)
+        self.assertEqual(cache.stats()['stale_hits'], 4)
+        self.clock.now += 5
+        self.assertEqual(cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(cache.stats()['refresh_errors'], 2)
+
+    def test_stale_keys_not_served_past_the_stale_window(self):
+        cache = JWKSCache(self.server.url, ttl=600, stale_window=60, min_refetch_interval=5, clock=self.clock)
+        auth.jwks_cache = cache
+        token = make_token(self.private_pem, 'key-1')
+        auth.verify_decode_jwt(token)
+        self.server.stop()
+        self.clock.now += 655
+        self.assertEqual(cache.get_key('key-1')['kid'], 'key-1')
+        # the failed refetch no longer covers for keys past the window
+        self.clock.now += 10
+        with self.assertRaises(JWKSUnavailable):
+            cache.get_key('key-1')
+        with self.assertRaises(auth.AuthError) as context:
+            auth.verify_decode_jwt(token)
+        self.assertEqual(context.exception.error['code'], 'jwks_unavailable')
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_refresher_starts_once(self):
+        cache = JWKSCache(self.server.url, ttl=600)
+        self.assertTrue(cache.start_refresher())
+        self.addCleanup(cache.stop_refresher)
+        self.assertFalse(cache.start_refresher())
+
+# ---------------------------------------------------------------------------------
+# ------------------------------- TOKEN CACHE -------------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_verified_token_is_cached(self):
+        token = make_token(self.private_pem, 'key-1')
+        first = auth.get_verified_payload(token)
+        second = auth.get_verified_payload(token)
+        self.assertIs(first, second)
+        self.assertEqual(auth.token_cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_token_cache_is_keyed_by_digest(self):
+        token = make_token(self.private_pem, 'key-1')
+        auth.get_verified_payload(token)
+        self.assertIsNotNone(auth.token_cache.get(auth.token_digest(token)))
+        self.assertIsNone(auth.token_cache.get(token))
+
+    def test_token_about_to_expire_is_not_cached(self):
+        token = make_token(
+            self.private_pem, 'key-1', expires_in=auth.TOKEN_CACHE_LEEWAY - 5)
+        auth.get_verified_payload(token)
+        auth.get_verified_payload(token)
+        self.assertEqual(auth.token_cache.stats()['hits'], 0)
+
+    def test_token_cache_is_bounded(self):
+        for sub in range(10):
+            token = make_token(self.private_pem, 'key-1', sub=str(sub))
+            auth.get_verified_payload(token)
+        self.assertEqual(len(auth.token_cache), 4)
+
+    def test_key_rotation_invalidates_token_cache(self):
+        token = make_token(self.private_pem, 'key-1')
+        auth.get_verified_payload(token)
+        # the IdP rotates key-1 out, so its tokens must be verified again
+        self.server.keys = [self.rotated_jwk]
+        self.cache.refresh()
+        with self.assertRaises(auth.AuthError):
+            auth.get_verified_payload(token)
+
+# ---------------------------------------------------------------------------------
+# ---------------------------- REJECTED TOKEN CACHE -------------------------------
+# ---------------------------------------------------------------------------------
+
+    def assertRejected(self, token, code):
+        with self.assertRaises(auth.AuthError) as context:
+            auth.get_verified_payload(token)
+        self.assertEqual(context.exception.error['code'], code)
+
+    def test_expired_token_rejection_is_replayed(self):
+        token = make_token(self.private_pem, 'key-1', expires_in=-60)
+        for _ in range(5):
+            self.assertRejected(token, 'token_expired')
+        stats = auth.rejected_token_stats()
+        self.assertEqual(stats['hits'], 4)
+        self.assertEqual(stats['by_code'], {'token_expired': 4})
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_invalid_claims_rejection_is_replayed(self):
+        token = make_token(self.private_pem, 'key-1', aud='someone-else')
+        for _ in range(3):
+            self.assertRejected(token, 'invalid_claims')
+        self.assertEqual(auth.rejected_token_stats()['by_code'], {'invalid_claims': 2})
+
+    def test_malformed_token_rejection_is_replayed(self):
+        for _ in range(3):
+            self.assertRejected('not-a-jwt', 'invalid_header')
+        self.assertEqual(auth.rejected_token_stats()['by_code'], {'invalid_header': 2})
+        self.assertEqual(self.server.requests, 0)
+
+    def test_unknown_kid_rejection_is_not_replayed(self):
+        token = make_token(self.rotated_pem, 'key-2')
+        self.assertRejected(token, 'invalid_header')
+        # the IdP publishes the rotated key while refetches are still rate limited
+        self.server.keys = [self.public_jwk, self.rotated_jwk]
+        self.assertRejected(token, 'invalid_header')
+        self.clock.now += 5
+        self.assertEqual(auth.get_verified_payload(token)['sub'], 'auth0|tester')
+        self.assertEqual(len(auth.rejected_token_cache), 0)
+
+    def test_key_rotation_invalidates_rejections(self):
+        token = make_token(self.private_pem, 'key-1', aud='someone-else')
+        self.assertRejected(token, 'invalid_claims')
+        self.server.keys = [self.public_jwk, self.rotated_jwk]
+        self.clock.now += 601
+        self.cache.get_key('key-1')
+        self.assertRejected(token, 'invalid_claims')
+        self.assertEqual(auth.rejected_token_stats()['by_code'], {})
+
+    def test_rejected_token_cache_is_bounded(self):
+        for index in range(auth.NEGATIVE_CACHE_SIZE + 10):
+            self.assertRejected('malformed-{}'.format(index), 'invalid_header')
+        self.assertEqual(len(auth.rejected_token_cache), auth.NEGATIVE_CACHE_SIZE)
+
+# ---------------------------------------------------------------------------------
+# ---------------------------- PERMISSION POLICIES --------------------------------
+# ---------------------------------------------------------------------------------
+
+    def test_permissions_compiled_once_per_token(self):
+        token = make_token(self.private_pem, 'key-1')
+        verified = auth.get_verified_token(token)
+        self.assertEqual(verified.permissions, frozenset(['get:movies', 'get:actors']))
+        self.assertIs(auth.get_verified_token(token).permissions, verified.permissions)
+
+    def test_policy_all_of(self):
+        policy = auth.PermissionPolicy(all_of=['get:movies', 'get:actors'])
+        self.assertTrue(policy.allows(frozenset(['get:movies', 'get:actors', 'post:movies'])))
+        self.assertFalse(policy.allows(frozenset(['get:movies'])))
+
+    def test_policy_any_of(self):
+        policy = auth.PermissionPolicy(any_of=['patch:movies', 'patch:actors'])
+        self.assertTrue(policy.allows(frozenset(['patch:actors'])))
+        self.assertFalse(policy.allows(frozenset(['get:actors'])))
+
+    def test_requires_auth_exposes_policy(self):
+        @auth.requires_auth('get:movies', any_of=['patch:movies', 'post:movies'])
+        def view(payload):
+            return payload
+        policy = view.permission_policy
+        self.assertEqual(policy.all_of, frozenset(['get:movies']))
+        self.assertEqual(policy.any_of, frozenset(['patch:movies', 'post:movies']))
+
+    def test_check_policy_without_permissions_claim(self):
+        token = make_token(self.private_pem, 'key-1', permissions=None)
+        verified = auth.get_verified_token(token)
+        with self.assertRaises(auth.AuthError) as context:
+            auth.check_policy(auth.PermissionPolicy(['get:movies']), verified)
+        self.assertEqual(context.exception.error['code'], 'invalid_claims')
+
+
+if __name__ == "__main__":
+    unittest.main()